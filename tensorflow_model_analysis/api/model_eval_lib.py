@@ -435,6 +435,15 @@ def default_eval_shared_model(
       is_baseline=is_baseline)
 
 
+def _unbatch_extractors(
+    eval_config: Optional[config_pb2.EvalConfig]) -> List[extractor.Extractor]:
+  """Returns extractors for unbatching extracts prior to slicing (if any)."""
+  if eval_config and eval_config.options.batched_metrics_inputs.value:
+    # The extracts will be kept batched through slicing and metric computation.
+    return []
+  return [unbatch_extractor.UnbatchExtractor()]
+
+
 def default_extractors(  # pylint: disable=invalid-name
     eval_shared_model: Optional[types.MaybeMultipleEvalSharedModels] = None,
     eval_config: Optional[config_pb2.EvalConfig] = None,
@@ -442,7 +451,8 @@ def default_extractors(  # pylint: disable=invalid-name
     materialize: Optional[bool] = None,
     tensor_adapter_config: Optional[tensor_adapter.TensorAdapterConfig] = None,
     custom_predict_extractor: Optional[extractor.Extractor] = None,
-    config_version: Optional[int] = None) -> List[extractor.Extractor]:
+    config_version: Optional[int] = None,
+    prediction_cache_dir: Optional[str] = None) -> List[extractor.Extractor]:
   """Returns the default extractors for use in ExtractAndEvaluate.
 
   Args:
@@ -464,6 +474,9 @@ def default_extractors(  # pylint: disable=invalid-name
       be explicitly set by users. It is only intended to be used in cases where
       the provided eval_config was generated internally, and thus not a reliable
       indicator of user intent.
+    prediction_cache_dir: Optional directory used by the PredictionsExtractor to
+      persist the predictions computed for each example so that later runs with
+      the same models and data can skip inference for those examples.
 
   Raises:
     NotImplementedError: If eval_config contains mixed serving and eval models.
@@ -515,7 +528,7 @@ def default_extractors(  # pylint: disable=invalid-name
           (custom_predict_extractor or
            tflite_predict_extractor.TFLitePredictExtractor(
                eval_config=eval_config, eval_shared_model=eval_shared_model)),
-          unbatch_extractor.UnbatchExtractor(),
+          *_unbatch_extractors(eval_config),
           slice_key_extractor.SliceKeyExtractor(
               eval_config=eval_config, materialize=materialize)
       ]
@@ -533,7 +546,7 @@ def default_extractors(  # pylint: disable=invalid-name
           (custom_predict_extractor or
            tfjs_predict_extractor.TFJSPredictExtractor(
                eval_config=eval_config, eval_shared_model=eval_shared_model)),
-          unbatch_extractor.UnbatchExtractor(),
+          *_unbatch_extractors(eval_config),
           slice_key_extractor.SliceKeyExtractor(
               eval_config=eval_config, materialize=materialize)
       ]
@@ -578,8 +591,9 @@ def default_extractors(  # pylint: disable=invalid-name
            predictions_extractor.PredictionsExtractor(
                eval_config=eval_config,
                eval_shared_model=eval_shared_model,
-               tensor_adapter_config=tensor_adapter_config)),
-          unbatch_extractor.UnbatchExtractor(),
+               tensor_adapter_config=tensor_adapter_config,
+               prediction_cache_dir=prediction_cache_dir)),
+          *_unbatch_extractors(eval_config),
           slice_key_extractor.SliceKeyExtractor(
               eval_config=eval_config, materialize=materialize)
       ])
@@ -592,7 +606,7 @@ def default_extractors(  # pylint: disable=invalid-name
             eval_config=eval_config),
         predictions_extractor.PredictionsExtractor(eval_config=eval_config),
         sql_slice_key_extractor.SqlSliceKeyExtractor(eval_config),
-        unbatch_extractor.UnbatchExtractor(),
+        *_unbatch_extractors(eval_config),
         slice_key_extractor.SliceKeyExtractor(
             eval_config=eval_config, materialize=materialize)
     ]
@@ -989,7 +1003,8 @@ def ExtractEvaluateAndWriteResults(  # pylint: disable=invalid-name
     random_seed_for_testing: Optional[int] = None,
     tensor_adapter_config: Optional[tensor_adapter.TensorAdapterConfig] = None,
     schema: Optional[schema_pb2.Schema] = None,
-    config_version: Optional[int] = None) -> beam.pvalue.PDone:
+    config_version: Optional[int] = None,
+    prediction_cache_dir: Optional[str] = None) -> beam.pvalue.PDone:
   """PTransform for performing extraction, evaluation, and writing results.
 
   Users who want to construct their own Beam pipelines instead of using the
@@ -1066,6 +1081,9 @@ def ExtractEvaluateAndWriteResults(  # pylint: disable=invalid-name
       be explicitly set by users. It is only intended to be used in cases where
       the provided eval_config was generated internally, and thus not a reliable
       indicator of user intent.
+    prediction_cache_dir: Optional directory used to persist the predictions
+      computed for each example (see default_extractors). Only used if no
+      extractors are provided.
 
   Raises:
     ValueError: If EvalConfig invalid or matching Extractor not found for an
@@ -1094,7 +1112,8 @@ def ExtractEvaluateAndWriteResults(  # pylint: disable=invalid-name
         eval_config=eval_config,
         eval_shared_model=eval_shared_model,
         tensor_adapter_config=tensor_adapter_config,
-        config_version=config_version)
+        config_version=config_version,
+        prediction_cache_dir=prediction_cache_dir)
 
   if not evaluators:
     evaluators = default_evaluators(
@@ -1149,6 +1168,7 @@ def run_model_analysis(
     min_slice_size: int = 1,
     random_seed_for_testing: Optional[int] = None,
     schema: Optional[schema_pb2.Schema] = None,
+    prediction_cache_dir: Optional[str] = None,
 ) -> Union[view_types.EvalResult, view_types.EvalResults]:
   """Runs TensorFlow model analysis.
 
@@ -1187,6 +1207,10 @@ def run_model_analysis(
     min_slice_size: Deprecated (use EvalConfig).
     random_seed_for_testing: Provide for deterministic tests only.
     schema: Optional tf.Metadata schema of the input data.
+    prediction_cache_dir: Optional directory used to persist the predictions
+      computed for each example. Later runs with the same models and data
+      read the predictions from this directory instead of running inference.
+      Only used if no extractors are provided.
 
   Returns:
     An EvalResult that can be used with the TFMA visualization functions.
@@ -1266,7 +1290,8 @@ def run_model_analysis(
             random_seed_for_testing=random_seed_for_testing,
             tensor_adapter_config=tensor_adapter_config,
             schema=schema,
-            config_version=config_version))
+            config_version=config_version,
+            prediction_cache_dir=prediction_cache_dir))
       # pylint: enable=no-value-for-parameter
 
   if len(eval_config.model_specs) <= 1:
@@ -1457,6 +1457,81 @@ class EvaluateTest(testutil.TensorflowModelAnalysisTest,
     self.assertEqual(1.0, got_buckets[1]['lowerThresholdInclusive'])
     self.assertEqual(2.0, got_buckets[-2]['upperThresholdExclusive'])
 
+  def testRunModelAnalysisWithPredictionCache(self):
+    input_layer = tf.keras.layers.Input(shape=(2,), name='data')
+    output_layer = tf.keras.layers.Dense(1, activation=tf.nn.sigmoid)(
+        input_layer)
+    model = tf.keras.models.Model(input_layer, output_layer)
+    model.compile(loss=tf.keras.losses.binary_crossentropy)
+    model_location = os.path.join(self._getTempDir(), 'export_dir')
+    model.save(model_location, save_format='tf')
+    examples = [
+        self._makeExample(data=[0.0, 1.0], label=1.0),
+        self._makeExample(data=[1.0, 0.0], label=0.0),
+        self._makeExample(data=[1.0, 1.0], label=1.0),
+    ]
+    data_location = self._writeTFExamplesToTFRecords(examples)
+    schema = text_format.Parse(
+        """
+        tensor_representation_group {
+          key: ""
+          value {
+            tensor_representation {
+              key: "data"
+              value {
+                dense_tensor {
+                  column_name: "data"
+                  shape { dim { size: 2 } }
+                }
+              }
+            }
+          }
+        }
+        feature {
+          name: "data"
+          type: FLOAT
+        }
+        feature {
+          name: "label"
+          type: FLOAT
+        }
+        """, schema_pb2.Schema())
+    eval_config = config_pb2.EvalConfig(
+        model_specs=[config_pb2.ModelSpec(label_key='label')],
+        metrics_specs=[
+            config_pb2.MetricsSpec(metrics=[
+                config_pb2.MetricConfig(class_name='ExampleCount'),
+                config_pb2.MetricConfig(class_name='MeanPrediction'),
+            ])
+        ])
+    prediction_cache_dir = self._getTempDir()
+
+    def run_model_analysis():
+      eval_result = model_eval_lib.run_model_analysis(
+          eval_config=eval_config,
+          eval_shared_model=model_eval_lib.default_eval_shared_model(
+              eval_saved_model_path=model_location, eval_config=eval_config),
+          data_location=data_location,
+          output_path=self._getTempDir(),
+          schema=schema,
+          prediction_cache_dir=prediction_cache_dir)
+      cache_files = tf.io.gfile.glob(
+          os.path.join(prediction_cache_dir, '*', '*.parquet'))
+      return eval_result, cache_files
+
+    eval_result, cache_files = run_model_analysis()
+    self.assertNotEmpty(cache_files)
+    cached_eval_result, cached_files = run_model_analysis()
+    # All of the predictions were read from the cache so no new files were
+    # written.
+    self.assertCountEqual(cache_files, cached_files)
+    self.assertLen(eval_result.slicing_metrics, 1)
+    slice_key, metrics = eval_result.slicing_metrics[0]
+    self.assertEqual((), slice_key)
+    self.assertEqual({'doubleValue': 3.0}, metrics['']['']['example_count'])
+    self.assertMetricsAlmostEqual(cached_eval_result.slicing_metrics,
+                                  {(): metrics['']['']})
+
   def testRunModelAnalysisWithPlots(self):
     model_location = self._exportEvalSavedModel(
         fixed_prediction_estimator.simple_fixed_prediction_estimator)
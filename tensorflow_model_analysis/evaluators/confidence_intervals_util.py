@@ -15,13 +15,14 @@
 
 import collections
 import numbers
-from typing import Iterable, NamedTuple, Optional, Set, Sequence, Tuple
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Set, Sequence, Tuple
 import apache_beam as beam
 import numpy as np
 from tensorflow_model_analysis import constants
 from tensorflow_model_analysis import types
 from tensorflow_model_analysis.metrics import metric_types
 from tensorflow_model_analysis.post_export_metrics import metric_keys
+from tensorflow_model_analysis.slicer import slicer_lib as slicer
 
 SampleMetrics = NamedTuple('SampleMetrics',
                            [('metrics', metric_types.MetricsDict),
@@ -61,6 +62,63 @@ def mean_and_std(
   return mean, std
 
 
+@beam.ptransform_fn
+def SplitSampleOutputs(  # pylint: disable=invalid-name
+    sliced_sample_outputs: beam.PCollection[Tuple[
+        slicer.SliceKeyType, List[Optional[metric_types.MetricsDict]]]],
+    num_samples: int, full_sample_id: int,
+    derived_metrics_ptransform: beam.PTransform
+) -> beam.PCollection[Tuple[slicer.SliceKeyOrCrossSliceKeyType,
+                            SampleMetrics]]:
+  """Splits per-slice lists of sample outputs into sliced SampleMetrics.
+
+  Args:
+    sliced_sample_outputs: PCollection of (slice key, outputs) where outputs is
+      a list containing the computed metrics for each sample (or None if the
+      sample is missing for the slice) followed by the computed metrics for the
+      full (unsampled) data.
+    num_samples: The number of samples (not counting the full sample).
+    full_sample_id: The sample_id to use for the full sample.
+    derived_metrics_ptransform: A PTransform which adds derived metrics to the
+      computed metrics. This is applied to each sample separately.
+
+  Returns:
+    PCollection of (slice key, SampleMetrics) including derived metrics.
+  """
+
+  def split_samples(
+      slice_key: slicer.SliceKeyType,
+      sample_outputs: List[Optional[metric_types.MetricsDict]]
+  ) -> Iterator[Tuple[int, Tuple[slicer.SliceKeyType,
+                                 metric_types.MetricsDict]]]:
+    for sample_index, metrics in enumerate(sample_outputs):
+      if metrics is not None:
+        yield sample_index, (slice_key, metrics)
+
+  def add_sample_id(
+      slice_key: slicer.SliceKeyOrCrossSliceKeyType,
+      metrics: metric_types.MetricsDict, sample_id: int
+  ) -> Tuple[slicer.SliceKeyOrCrossSliceKeyType, SampleMetrics]:
+    return slice_key, SampleMetrics(metrics=metrics, sample_id=sample_id)
+
+  partitions = (
+      sliced_sample_outputs
+      | 'SplitSamples' >> beam.FlatMapTuple(split_samples)
+      | 'PartitionSamples' >> beam.Partition(lambda sample, _: sample[0],
+                                             num_samples + 1))
+  samples = []
+  for sample_index, partition in enumerate(partitions):
+    sample_id = (
+        sample_index if sample_index < num_samples else full_sample_id)
+    samples.append(
+        partition
+        | f'DropSampleIndex[{sample_index}]' >> beam.Values()
+        | f'AddDerivedMetrics[{sample_index}]' >> derived_metrics_ptransform
+        | f'AddSampleIdToValue[{sample_index}]' >> beam.MapTuple(
+            add_sample_id, sample_id=sample_id))
+  return samples | 'FlattenSamples' >> beam.Flatten()
+
+
 class SampleCombineFn(beam.CombineFn):
   """Computes the standard deviation for each metric from samples."""
 
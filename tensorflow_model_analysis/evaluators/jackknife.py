@@ -13,7 +13,7 @@
 # limitations under the License.
 """Helper methods for computing jackknife std error estimates on metrics."""
 
-from typing import Optional, Set, Tuple, TypeVar
+from typing import Any, Iterable, List, Optional, Set, Tuple, TypeVar
 
 import apache_beam as beam
 import numpy as np
@@ -29,45 +29,112 @@ _FULL_SAMPLE_ID = -1
 _AccumulatorType = TypeVar('_AccumulatorType')
 
 
-class _AccumulateOnlyCombineFn(beam_util.DelegatingCombineFn):
-  """A combine_fn wrapper which returns the accumulator as the output value.
+class _JackknifeCombineFn(beam_util.DelegatingCombineFn):
+  """CombineFn wrapper which computes all jackknife samples in a single pass.
 
-  This is intended to allow invoking CombineFns in settings where you might need
-  to subsequently merge the results before calling extract_output. A typical use
-  of a _AccumulateOnlyCombineFn might look like:
-
-      c = OtherCombineFn()
+  Each input element is assigned to one of num_jackknife_samples partitions
+  uniformly at random and the accumulator holds an accumulator of
+  the wrapped combine_fn for each partition (or None if the partition is
+  empty). The output is a list containing the combine_fn output for each
+  delete-d sample (i.e. all partitions except the one at the same index)
+  followed by the output for the unsampled data (i.e. all partitions). The
+  delete-d samples are computed from prefix and suffix merges of the partition
+  accumulators, which requires O(num_jackknife_samples) merges.
+  """
 
-      # combine per key, but don't call extract_output()
-      accumulators = [p | beam.CombinePerKey(_AccumulateOnlyCombineFn(c)
-                      for i in range(3)]
+  def __init__(self,
+               combine_fn: beam.CombineFn,
+               num_jackknife_samples: int,
+               random_seed: Optional[int] = None):
+    super().__init__(combine_fn)
+    self._num_jackknife_samples = num_jackknife_samples
+    self._random_seed = random_seed
 
-      # create two different lists of accumulator PCollections
-      even_accumulators = [a for i, a in enumerate(accumulators) if i % 2 == 0]
+  def setup(self, *args, **kwargs):
+    super().setup(*args, **kwargs)
+    self._random_state = np.random.RandomState(self._random_seed)
 
-      # extract output on the two different sets of accumulators without
-      # recomputing the even accumulators
-      even_output = (even_accumulators | beam.Flatten()
-          | beam.CombinePerKey(_AccumulatorCombineFn(c)))
-      all_output = (accumulators | beam.Flatten()
-          | beam.CombinePerKey(_AccumulatorCombineFn(c)))
-  """
-
-  def extract_output(self, accumulator: _AccumulatorType) -> _AccumulatorType:
+  def _merge(
+      self,
+      accumulators: Iterable[Optional[_AccumulatorType]]
+  ) -> Optional[_AccumulatorType]:
+    """Merges accumulators into a new accumulator (None values are skipped)."""
+    accumulators = [a for a in accumulators if a is not None]
+    if not accumulators:
+      return None
+    return self._combine_fn.merge_accumulators(
+        [self._combine_fn.create_accumulator()] + accumulators)
+
+  def create_accumulator(self) -> List[Optional[_AccumulatorType]]:
+    return [None] * self._num_jackknife_samples
+
+  def add_input(self, accumulator: List[Optional[_AccumulatorType]],
+                element: Any) -> List[Optional[_AccumulatorType]]:
+    return self.add_inputs(accumulator, [element])
+
+  def add_inputs(
+      self, accumulator: List[Optional[_AccumulatorType]],
+      elements: Iterable[Any]) -> List[Optional[_AccumulatorType]]:
+    elements = list(elements)
+    if not elements:
+      return accumulator
+    partitions = {}
+    for element, partition in zip(
+        elements,
+        self._random_state.randint(self._num_jackknife_samples,
+                                   size=len(elements)).tolist()):
+      partitions.setdefault(partition, []).append(element)
+    for partition, partition_elements in partitions.items():
+      if accumulator[partition] is None:
+        accumulator[partition] = self._combine_fn.create_accumulator()
+      accumulator[partition] = self._combine_fn.add_inputs(
+          accumulator[partition], partition_elements)
     return accumulator
 
+  def merge_accumulators(
+      self, accumulators: Iterable[List[Optional[_AccumulatorType]]]
+  ) -> List[Optional[_AccumulatorType]]:
+    result = []
+    for partition_accumulators in zip(*accumulators):
+      partition_accumulators = [
+          a for a in partition_accumulators if a is not None
+      ]
+      if partition_accumulators:
+        result.append(
+            self._combine_fn.merge_accumulators(partition_accumulators))
+      else:
+        result.append(None)
+    return result
 
-class _AccumulatorCombineFn(beam_util.DelegatingCombineFn):
-  """A CombineFn wrapper that takes accumulators as add_input elements.
-
-  In combination with _AccumulateOnlyCombineFn, this makes it possible to
-  operate on a CombineFn's accumulators prior to calling extract input. See the
-  _AccumulateOnlyCombineFn docstring for more details.
-  """
+  def compact(
+      self, accumulator: List[Optional[_AccumulatorType]]
+  ) -> List[Optional[_AccumulatorType]]:
+    return [
+        None if a is None else self._combine_fn.compact(a) for a in accumulator
+    ]
 
-  def add_input(self, accumulator: _AccumulatorType,
-                element: _AccumulatorType) -> _AccumulatorType:
-    return self._combine_fn.merge_accumulators([accumulator, element])
+  def extract_output(
+      self, accumulator: List[Optional[_AccumulatorType]]) -> List[Any]:
+    # prefixes[i] is the merge of partitions [0, i) and suffixes[i] is the
+    # merge of partitions [i, num_jackknife_samples).
+    prefixes = [None]
+    for a in accumulator:
+      prefixes.append(self._merge([prefixes[-1], a]))
+    suffixes = [None]
+    for a in reversed(accumulator):
+      suffixes.append(self._merge([a, suffixes[-1]]))
+    suffixes.reverse()
+    result = []
+    for i in range(len(accumulator)):
+      sample_accumulator = self._merge([prefixes[i], suffixes[i + 1]])
+      # A sample is missing if the slice only occurs in the deleted partition.
+      result.append(None if sample_accumulator is None else self._combine_fn
+                    .extract_output(sample_accumulator))
+    full_accumulator = prefixes[-1]
+    if full_accumulator is None:
+      full_accumulator = self._combine_fn.create_accumulator()
+    result.append(self._combine_fn.extract_output(full_accumulator))
+    return result
 
 
 class _JackknifeSampleCombineFn(confidence_intervals_util.SampleCombineFn):
@@ -125,49 +192,6 @@ class _JackknifeSampleCombineFn(confidence_intervals_util.SampleCombineFn):
     return result
 
 
-def _add_sample_id(slice_key,
-                   metrics_dict: metric_types.MetricsDict,
-                   sample_id: int = 0):
-  # sample_id has a default value in order to satisfy requirement of MapTuple
-  return slice_key, confidence_intervals_util.SampleMetrics(
-      metrics=metrics_dict, sample_id=sample_id)
-
-
-@beam.ptransform_fn
-def _ComputeJackknifeSample(  # pylint: disable=invalid-name
-    sample_accumulators: beam.PCollection[
-        confidence_intervals_util.SampleCombineFn.SampleAccumulator],
-    sample_id: int, computations_combine_fn: beam.CombineFn,
-    derived_metrics_ptransform: beam.PTransform
-) -> beam.PCollection[confidence_intervals_util.SampleMetrics]:
-  """Computes a single jackknife delete-d sample from partition accumulators.
-
-  Args:
-    sample_accumulators: A PCollections of combiner accumulators to be used for
-      a given sample.
-    sample_id: The sample_id to generate. This is used to determine which
-      partition accumulators to skip.
-    computations_combine_fn: a beam.CombineFn instance that takes input elements
-      of type Extracts and returns a MetricsDict. This will be invoked as part
-      of a CombinePerKey in which the key is a slice key.
-    derived_metrics_ptransform: A PTransform which adds derived metrics to the
-      results of the computations_combine_fn. This PTransform should both input
-      and output a single PCollection with elements of type MetricsDict where
-      the output MetricsDict includes additional derived metrics.
-
-  Returns:
-    A single sample tuple containing the sample_id and the metric dictionary for
-    that sample
-  """
-
-  return (sample_accumulators
-          | 'MergePartitionsPerSlice' >> beam.CombinePerKey(
-              _AccumulatorCombineFn(computations_combine_fn))
-          | 'AddDerivedMetrics' >> derived_metrics_ptransform
-          | 'AddSampleIdToValue' >> beam.MapTuple(
-              _add_sample_id, sample_id=sample_id))
-
-
 @beam.ptransform_fn
 def ComputeWithConfidenceIntervals(  # pylint: disable=invalid-name
     sliced_extracts: beam.pvalue.PCollection[Tuple[slicer.SliceKeyType,
@@ -195,64 +219,29 @@ def ComputeWithConfidenceIntervals(  # pylint: disable=invalid-name
       interval computation. For metric keys in this set, just the unsampled
       value will be returned.
     random_seed_for_testing: Seed to use for unit testing, because
-      nondeterministic tests stink. Each partition will use this value + i.
+      nondeterministic tests stink. This is used to seed the random assignment
+      of elements to partitions.
 
   Returns:
     A PCollection of sliced metrics containing standard error estimates for
     each numeric metric.
   """
 
-  random_state = np.random.RandomState(random_seed_for_testing)
-
-  def partition_fn(_, num_partitions):
-    return random_state.randint(num_partitions)
-
-  # Partition the data
-  # List[PCollection[Tuple[slicer.SliceKeyType, types.Extracts]]]
-  partitions = (
+  # PCollection[Tuple[slicer.SliceKeyType, List[metric_types.MetricsDict]]]
+  # containing the outputs for each delete-d sample followed by the output for
+  # the unsampled data.
+  sample_outputs = (
       sliced_extracts
-      | f'Partition({num_jackknife_samples})' >> beam.Partition(
-          partition_fn, num_jackknife_samples))
-
-  # Within each partition, partially combine per slice key to get accumulators
-  # and partition sizes; add partition_id for determinism.
-  # List[PCollection[Tuple[slicer.SliceKeyType, AccumulatorType]]]
-  partition_accumulators = []
-  for i, partition in enumerate(partitions):
-    partition_accumulators.append(
-        partition
-        | f'CombinePartitionPerSlice[{i}]' >> beam.CombinePerKey(
-            _AccumulateOnlyCombineFn(computations_combine_fn)))
-
-  unsampled_metrics = (
-      partition_accumulators
-      | 'FlattenPartitions' >> beam.Flatten()
-      | 'MergePartitionsPerSlice' >> beam.CombinePerKey(
-          _AccumulatorCombineFn(computations_combine_fn))
-      | 'AddDerivedMetrics' >> derived_metrics_ptransform
-      | 'AddSampleIdToValue' >> beam.MapTuple(
-          _add_sample_id, sample_id=_FULL_SAMPLE_ID))
-
-  # Compute the combine_fn output for the delete-d samples by merging all but
-  # one partitions.
-  # List[PCollection[Tuple[slicer.SliceKeyType, SampleMetrics]]]
-  delete_d_samples = []
-  for sample_id in range(num_jackknife_samples):
-    # TODO(b/194732335): push filter and Flatten into _ComputeJackknifeSample
-    sample_accumulators = [
-        acc for i, acc in enumerate(partition_accumulators) if i != sample_id
-    ]
-    delete_d_samples.append(
-        sample_accumulators
-        | f'FlattenPartitions[{sample_id}]' >> beam.Flatten()
-        | f'ComputeJackknifeSample[{sample_id}]' >> _ComputeJackknifeSample(  # pylint: disable=no-value-for-parameter
-            sample_id=sample_id,
-            computations_combine_fn=computations_combine_fn,
-            derived_metrics_ptransform=derived_metrics_ptransform))
+      | 'CombinePartitionsPerSlice' >> beam.CombinePerKey(
+          _JackknifeCombineFn(computations_combine_fn, num_jackknife_samples,
+                              random_seed_for_testing)))
 
   # PCollection[Tuple[slicer.SliceKeyType, metric_types.MetricsDict]]
-  return (delete_d_samples + [unsampled_metrics]
-          | 'FlattenSamples' >> beam.Flatten()
+  return (sample_outputs
+          | 'SplitSampleOutputs' >> confidence_intervals_util.SplitSampleOutputs(  # pylint: disable=no-value-for-parameter
+              num_samples=num_jackknife_samples,
+              full_sample_id=_FULL_SAMPLE_ID,
+              derived_metrics_ptransform=derived_metrics_ptransform)
           | 'CombineJackknifeSamplesPerSlice' >> beam.CombinePerKey(
               _JackknifeSampleCombineFn(num_jackknife_samples,
                                         skip_ci_metric_keys)))
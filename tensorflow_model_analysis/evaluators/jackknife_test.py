@@ -47,55 +47,27 @@ class ListCombineFn(beam.CombineFn):
       return accumulator
 
 
-class ListCombineFnExtractOutputNotImplemented(ListCombineFn):
-
-  def extract_output(self, accumulator):
-    raise NotImplementedError(
-        'extract_output intentionally not implement to verify behavior. We '
-        'would like to be able to mock a combine_fn and then call '
-        'combine_fn.extract_output.assert_not_called().')
-
-
-class ListCombineFnAddInputNotImplemented(ListCombineFn):
-
-  def add_input(self, accumulator, element):
-    raise NotImplementedError(
-        'add_input intentionally not implement to verify behavior. We would '
-        'like to be able to mock a combine_fn and then call '
-        'combine_fn.add_input.assert_not_called().')
-
-
 class JackknifeTest(absltest.TestCase):
 
-  def test_accumulate_only_combiner(self):
-    with beam.Pipeline() as pipeline:
-      result = (
-          pipeline
-          | 'Create' >> beam.Create([1, 2])
-          | 'AccumulateOnlyCombine' >> beam.CombineGlobally(
-              jackknife._AccumulateOnlyCombineFn(
-                  ListCombineFnExtractOutputNotImplemented(
-                      extract_output_append=3))))
-
-      def check_result(got_pcoll):
-        self.assertLen(got_pcoll, 1)
-        self.assertEqual(got_pcoll[0], [1, 2])
-
-      util.assert_that(result, check_result)
-
-  def test_accumulator_combiner(self):
+  def test_jackknife_combine_fn(self):
     with beam.Pipeline() as pipeline:
       result = (
           pipeline
-          | 'Create' >> beam.Create([[1], [2]])
-          | 'AccumulatorCombine' >> beam.CombineGlobally(
-              jackknife._AccumulatorCombineFn(
-                  ListCombineFnAddInputNotImplemented(extract_output_append=3)))
-      )
+          | 'Create' >> beam.Create(range(10), reshuffle=False)
+          | 'JackknifeCombine' >> beam.CombineGlobally(
+              jackknife._JackknifeCombineFn(
+                  ListCombineFn(), num_jackknife_samples=3, random_seed=0)))
 
       def check_result(got_pcoll):
         self.assertLen(got_pcoll, 1)
-        self.assertEqual(got_pcoll[0], [1, 2, 3])
+        outputs = got_pcoll[0]
+        self.assertLen(outputs, 4)
+        # The last output is computed from all of the (unsampled) inputs.
+        self.assertCountEqual(range(10), outputs[-1])
+        # Each input is left out of exactly one of the delete-d samples.
+        samples = [sample for sample in outputs[:-1] if sample is not None]
+        for element in range(10):
+          self.assertLen([s for s in samples if element in s], len(samples) - 1)
 
       util.assert_that(result, check_result)
 
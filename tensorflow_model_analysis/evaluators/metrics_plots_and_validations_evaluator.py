@@ -16,7 +16,7 @@
 import copy
 import datetime
 import numbers
-from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Type, TypeVar, Union
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Tuple, Type, TypeVar, Union
 import apache_beam as beam
 import numpy as np
 
@@ -31,11 +31,14 @@ from tensorflow_model_analysis.evaluators import keras_util
 from tensorflow_model_analysis.evaluators import metrics_validator
 from tensorflow_model_analysis.evaluators import poisson_bootstrap
 from tensorflow_model_analysis.extractors import slice_key_extractor
+from tensorflow_model_analysis.extractors import unbatch_extractor
 from tensorflow_model_analysis.metrics import metric_specs
 from tensorflow_model_analysis.metrics import metric_types
 from tensorflow_model_analysis.metrics import metric_util
 from tensorflow_model_analysis.proto import config_pb2
+from tensorflow_model_analysis.proto import validation_result_pb2
 from tensorflow_model_analysis.slicer import slicer_lib as slicer
+from tensorflow_model_analysis.utils import beam_util
 from tensorflow_model_analysis.utils import model_util
 from tensorflow_model_analysis.utils import util
 from tfx_bsl.tfxio import tensor_adapter
@@ -57,6 +60,26 @@ _DEFAULT_NUM_BOOTSTRAP_SAMPLES = 20
 # TODO(b/151283457): replace hard-coded value with dynamic estimate.
 _COMBINE_PER_SLICE_KEY_HOT_KEY_FANOUT = 8
 
+# When adaptive hot key fanout is enabled, each slice is spread across one
+# intermediate key per _ADAPTIVE_HOT_KEY_FANOUT_EXAMPLES_PER_KEY examples (up to
+# a maximum of _MAX_ADAPTIVE_HOT_KEY_FANOUT keys).
+_ADAPTIVE_HOT_KEY_FANOUT_EXAMPLES_PER_KEY = 10000
+_MAX_ADAPTIVE_HOT_KEY_FANOUT = 256
+
+# Cross slices are computed by joining the baseline and comparison slices of
+# each cross slicing spec by key. The comparison slices of each spec are spread
+# across _CROSS_SLICE_JOIN_NUM_SHARDS keys (with the baselines replicated to
+# every key) so the comparisons for a single spec are computed in parallel.
+_CROSS_SLICE_JOIN_NUM_SHARDS = 8
+_BROADCAST_BASELINES_TAG = 'broadcast_baselines'
+_BROADCAST_COMPARISONS_TAG = 'broadcast_comparisons'
+_KEYED_BASELINES_TAG = 'keyed_baselines'
+_KEYED_COMPARISONS_TAG = 'keyed_comparisons'
+
+# Output tags used when grouping batched extracts clustered by query key.
+_GROUPED_QUERIES_TAG = 'grouped_queries'
+_PARTIAL_QUERIES_TAG = 'partial_queries'
+
 
 def MetricsPlotsAndValidationsEvaluator(  # pylint: disable=invalid-name
     eval_config: config_pb2.EvalConfig,
@@ -227,6 +250,174 @@ def _GroupByQueryKey(  # pylint: disable=invalid-name
           | 'MergeExtracts' >> beam.Map(util.merge_extracts))
 
 
+def _slice_batched_value(value: Any, start: int, end: int) -> Any:
+  """Returns the values of a batched value for examples [start, end)."""
+  if isinstance(value, Mapping):
+    return {k: _slice_batched_value(v, start, end) for k, v in value.items()}
+  if isinstance(value, (list, tuple)) or (isinstance(value, np.ndarray) and
+                                          value.ndim):
+    return value[start:end]
+  # Values that are not batched are shared by all the examples.
+  return [value] * (end - start)
+
+
+def _concat_batched_values(values: List[Any]) -> Any:
+  """Concatenates batched values along the batch dimension."""
+  if all(isinstance(v, Mapping) for v in values):
+    keys = {}
+    for v in values:
+      keys.update(dict.fromkeys(v))
+    return {
+        k: _concat_batched_values([v[k] for v in values if k in v])
+        for k in keys
+    }
+  if (all(isinstance(v, np.ndarray) for v in values) and
+      all(v.shape[1:] == values[0].shape[1:] for v in values)):
+    return np.concatenate(values)
+  return [x for v in values for x in v]  # pylint: disable=g-complex-comprehension
+
+
+@beam.typehints.with_input_types(types.Extracts)
+@beam.typehints.with_output_types(Tuple[str, types.Extracts])
+class _GroupAdjacentQueriesDoFn(beam.DoFn):
+  """Groups adjacent examples with the same query key in batched extracts.
+
+  The examples of each run of adjacent examples with the same query key are
+  output as a batched extract keyed by query. Runs inside a batch (without
+  touching either end of the batch) are output under the main tag. Runs at
+  either end of a batch (which may continue in other batches) and examples
+  without a query key are output under the partial queries tag so they can be
+  grouped with the rest of the query.
+  """
+
+  def __init__(self, query_key: str):
+    self._query_key = query_key
+    self._missing_query_key_counter = beam.metrics.Metrics.counter(
+        constants.METRICS_NAMESPACE, 'missing_query_key')
+    self._num_partial_queries = beam.metrics.Metrics.counter(
+        constants.METRICS_NAMESPACE, 'num_partial_queries')
+
+  def _query_ids(self, features: Any, batch_size: int) -> List[str]:
+    """Returns the query id of each example in the batch."""
+    if isinstance(features, Mapping):
+      values = features.get(self._query_key)
+      if values is None:
+        values = [None] * batch_size
+    elif features is not None:
+      values = [f.get(self._query_key) for f in features]
+    else:
+      values = [None] * batch_size
+    query_ids = []
+    num_missing = 0
+    for value in values:
+      value = metric_util.to_scalar(value, tensor_name=self._query_key)
+      if value is None:
+        num_missing += 1
+        query_ids.append('')
+      else:
+        query_ids.append('{}'.format(value))
+    if num_missing:
+      self._missing_query_key_counter.inc(num_missing)
+    return query_ids
+
+  def process(self, batched_extract: types.Extracts) -> Iterator[Any]:
+    batched_extract = {
+        k: v
+        for k, v in batched_extract.items()
+        if k != constants.ARROW_RECORD_BATCH_KEY and
+        not (isinstance(v, Mapping) and not v)
+    }
+    batch_size = len(batched_extract[constants.SLICE_KEY_TYPES_KEY])
+    query_ids = self._query_ids(
+        batched_extract.get(constants.FEATURES_KEY), batch_size)
+    start = 0
+    while start < batch_size:
+      query_id = query_ids[start]
+      end = start + 1
+      while end < batch_size and query_ids[end] == query_id:
+        end += 1
+      if start == 0 and end == batch_size:
+        values = batched_extract
+      else:
+        values = {
+            k: _slice_batched_value(v, start, end)
+            for k, v in batched_extract.items()
+        }
+      if query_id and start > 0 and end < batch_size:
+        yield query_id, values
+      else:
+        self._num_partial_queries.inc()
+        yield beam.pvalue.TaggedOutput(_PARTIAL_QUERIES_TAG,
+                                       (query_id, values))
+      start = end
+
+
+@beam.ptransform_fn
+@beam.typehints.with_input_types(types.Extracts)
+@beam.typehints.with_output_types(types.Extracts)
+def _GroupClusteredQueryKey(  # pylint: disable=invalid-name
+    extracts: beam.pvalue.PCollection,
+    query_key: str,
+) -> beam.pvalue.PCollection:
+  """PTransform for grouping batched extracts clustered by a query key.
+
+  This is equivalent to unbatching the extracts and using _GroupByQueryKey, but
+  it expects the examples of each query to be adjacent in the input (e.g. the
+  input is sorted by query key). Adjacent examples of the same query are grouped
+  within each batch and only the queries that span multiple batches (along with
+  examples without a query key) are grouped by key. The query ids of all runs
+  of adjacent examples are counted so that queries whose examples are not
+  adjacent (e.g. a query found inside two batches) are also grouped by key.
+  Queries that are not clustered are therefore still grouped correctly, but
+  more of their examples are shuffled.
+
+  Args:
+    extracts: Incoming PCollection consisting of batched extracts.
+    query_key: Query key to group extracts by. Must be a member of the dict of
+      features stored under tfma.FEATURES_KEY.
+
+  Returns:
+    PCollection of merged extracts where each extract contains the examples
+    associated with the same query key.
+  """
+  grouped = (
+      extracts
+      | 'GroupAdjacentQueries' >> beam.ParDo(
+          _GroupAdjacentQueriesDoFn(query_key)).with_outputs(
+              _PARTIAL_QUERIES_TAG, main=_GROUPED_QUERIES_TAG))
+  # Queries with a run inside a batch and at least one other run (inside or at
+  # the edge of any batch) keyed by query id. Only the query ids are shuffled.
+  repeated_queries = (
+      (grouped[_GROUPED_QUERIES_TAG]
+       | 'CountGroupedRuns' >> beam.Map(lambda kv: (kv[0], (1, 1))),
+       grouped[_PARTIAL_QUERIES_TAG]
+       | 'CountPartialRuns' >> beam.Map(lambda kv: (kv[0], (0, 1))))
+      | 'FlattenRuns' >> beam.Flatten()
+      | 'SumRuns' >> beam.CombinePerKey(
+          lambda counts: tuple(sum(c) for c in zip(*counts)))
+      | 'FilterRepeatedQueries' >> beam.Filter(
+          lambda kv: kv[1][0] > 0 and kv[1][1] > 1))
+  grouped_queries, repeated_grouped_queries = (
+      grouped[_GROUPED_QUERIES_TAG]
+      | 'PartitionRepeatedQueries' >> beam.Partition(
+          lambda kv, num_partitions, repeated: int(kv[0] in repeated),
+          2,
+          repeated=beam.pvalue.AsDict(repeated_queries)))
+  merged_grouped_queries = (
+      grouped_queries
+      | 'MergeGroupedQueries' >> beam.Map(
+          lambda kv: util.merge_batched_extract(kv[1])))
+  merged_partial_queries = (
+      (grouped[_PARTIAL_QUERIES_TAG], repeated_grouped_queries)
+      | 'FlattenPartialQueries' >> beam.Flatten()
+      | 'GroupPartialQueries' >> beam.GroupByKey()
+      | 'MergePartialQueries' >> beam.Map(
+          lambda kv: util.merge_batched_extract(
+              _concat_batched_values(list(kv[1])))))
+  return ((merged_grouped_queries, merged_partial_queries)
+          | 'FlattenQueries' >> beam.Flatten())
+
+
 class _PreprocessorDoFn(beam.DoFn):
   """Do function that computes initial state from extracts.
 
@@ -249,10 +440,53 @@ class _PreprocessorDoFn(beam.DoFn):
   will be a merger of all unique _slice key_types across the extracts list
   and the _default_combiner_inputs will be a list of StandardMetricInputs (one
   for each example matching the query_key).
+
+  If batched is True, the incoming extracts are expected to be batched (i.e.
+  each key stores a list of values with one entry per example). In this case
+  the '_slice_key_types', '_combiner_inputs', and '_default_combiner_inputs'
+  outputs will also be lists with one entry per example.
   """
 
-  def __init__(self, computations: List[metric_types.MetricComputation]):
+  def __init__(self,
+               computations: List[metric_types.MetricComputation],
+               batched: bool = False):
     self._computations = computations
+    self._batched = batched
+    # Any combiner_inputs that are set to None will have the default
+    # StandardMetricInputs passed to the combiner's add_input method. Note
+    # that for efficiency a single StandardMetricInputs type is created that has
+    # an include_filter that is a merger of the include_filter values for all
+    # StandardMetricInputsProcessors used by all metrics. This avoids processing
+    # extracts more than once, but does mean metrics may contain
+    # StandardMetricInputs with keys that are not part of their preprocessing
+    # filters.
+    self._custom_preprocessors = []
+    standard_preprocessors = []
+    added_default_standard_preprocessor = False
+    for computation in computations:
+      if computation.preprocessor is None:
+        # In this case, the combiner is requesting to be passed the default
+        # StandardMetricInputs (i.e. labels, predictions, and example weights).
+        self._custom_preprocessors.append(None)
+        if not added_default_standard_preprocessor:
+          standard_preprocessors.append(
+              metric_types.StandardMetricInputsPreprocessor())
+          added_default_standard_preprocessor = True
+      elif (type(computation.preprocessor) ==  # pylint: disable=unidiomatic-typecheck
+            metric_types.StandardMetricInputsPreprocessor):
+        # In this case a custom filter was used, but it is still part of the
+        # StandardMetricInputs. This will be merged into a single preprocessor
+        # for efficiency, but we still use None to indicate that the shared
+        # StandardMetricInputs value should be passed to the combiner.
+        self._custom_preprocessors.append(None)
+        standard_preprocessors.append(computation.preprocessor)
+      else:
+        self._custom_preprocessors.append(computation.preprocessor)
+    self._standard_preprocessor = None
+    if standard_preprocessors:
+      self._standard_preprocessor = (
+          metric_types.StandardMetricInputsPreprocessorList(
+              standard_preprocessors))
     self._evaluate_num_instances = beam.metrics.Metrics.counter(
         constants.METRICS_NAMESPACE, 'evaluate_num_instances')
     self._timer = beam.metrics.Metrics.distribution(
@@ -278,95 +512,200 @@ class _PreprocessorDoFn(beam.DoFn):
       if computation.preprocessor is not None:
         computation.preprocessor.teardown()
 
+  def _combiner_inputs(self, extracts: types.Extracts) -> List[Any]:
+    """Returns the combiner inputs for an example (None for default inputs)."""
+    return [
+        None if p is None else next(p.process(extracts))
+        for p in self._custom_preprocessors
+    ]
+
+  def _default_combiner_input(
+      self, extracts: types.Extracts) -> metric_types.StandardMetricInputs:
+    """Returns the default combiner input for an example."""
+    include_filter = self._standard_preprocessor.include_filter
+    return metric_util.to_standard_metric_inputs(
+        extracts,
+        include_features=constants.FEATURES_KEY in include_filter,
+        include_transformed_features=(constants.TRANSFORMED_FEATURES_KEY
+                                      in include_filter),
+        include_attributions=constants.ATTRIBUTIONS_KEY in include_filter)
+
+  def _preprocess(
+      self, extracts: types.Extracts
+  ) -> Tuple[List[Any], Optional[metric_types.StandardMetricInputs]]:
+    """Returns combiner inputs and default combiner input for an example."""
+    combiner_inputs = self._combiner_inputs(extracts)
+    default_combiner_input = None
+    if self._standard_preprocessor is not None:
+      default_combiner_input = self._default_combiner_input(
+          copy.copy(extracts))
+    return combiner_inputs, default_combiner_input
+
+  def _preprocess_batch(
+      self, extracts: types.Extracts, batch_size: int
+  ) -> Tuple[List[List[Any]],
+             Optional[List[metric_types.StandardMetricInputs]]]:
+    """Returns combiner inputs and default combiner inputs for a batch."""
+    examples = unbatch_extractor.split_extracts(
+        {k: v for k, v in extracts.items() if v is not None}, batch_size)
+    if any(p is not None for p in self._custom_preprocessors):
+      combiner_inputs = [self._combiner_inputs(e) for e in examples]
+    else:
+      # The combiner inputs are only read, so all the examples can share them.
+      combiner_inputs = [[None] * len(self._custom_preprocessors)] * batch_size
+    default_combiner_inputs = None
+    if self._standard_preprocessor is not None:
+      # The batched extract is validated once and the per-example extracts
+      # created by the split are used directly (without copying).
+      self._default_combiner_input(extracts)
+      default_combiner_inputs = [
+          metric_types.StandardMetricInputs(e) for e in examples
+      ]
+    return combiner_inputs, default_combiner_inputs
+
   def process(self, extracts: types.Extracts) -> Iterable[Any]:
     start_time = datetime.datetime.now()
-    self._evaluate_num_instances.inc(1)
 
-    # Any combiner_inputs that are set to None will have the default
-    # StandardMetricInputs passed to the combiner's add_input method. Note
-    # that for efficiency a single StandardMetricInputs type is created that has
-    # an include_filter that is a merger of the include_filter values for all
-    # StandardMetricInputsProcessors used by all metrics. This avoids processing
-    # extracts more than once, but does mean metrics may contain
-    # StandardMetricInputs with keys that are not part of their preprocessing
-    # filters.
-    combiner_inputs = []
-    standard_preprocessors = []
-    added_default_standard_preprocessor = False
-    for computation in self._computations:
-      if computation.preprocessor is None:
-        # In this case, the combiner is requesting to be passed the default
-        # StandardMetricInputs (i.e. labels, predictions, and example weights).
-        combiner_inputs.append(None)
-        if not added_default_standard_preprocessor:
-          standard_preprocessors.append(
-              metric_types.StandardMetricInputsPreprocessor())
-          added_default_standard_preprocessor = True
-      elif (type(computation.preprocessor) ==  # pylint: disable=unidiomatic-typecheck
-            metric_types.StandardMetricInputsPreprocessor):
-        # In this case a custom filter was used, but it is still part of the
-        # StandardMetricInputs. This will be merged into a single preprocessor
-        # for efficiency later, but we still use None to indicate that the
-        # shared StandardMetricInputs value should be passed to the combiner.
-        combiner_inputs.append(None)
-        standard_preprocessors.append(computation.preprocessor)
-      else:
-        combiner_inputs.append(next(computation.preprocessor.process(extracts)))
+    slice_key_types = extracts[constants.SLICE_KEY_TYPES_KEY]
+    if self._batched:
+      batch_size = len(slice_key_types)
+      self._evaluate_num_instances.inc(batch_size)
+      combiner_inputs, default_combiner_inputs = self._preprocess_batch(
+          extracts, batch_size)
+    else:
+      self._evaluate_num_instances.inc(1)
+      combiner_inputs, default_combiner_inputs = self._preprocess(extracts)
 
     output = {
-        constants.SLICE_KEY_TYPES_KEY: extracts[constants.SLICE_KEY_TYPES_KEY],
+        constants.SLICE_KEY_TYPES_KEY: slice_key_types,
         _COMBINER_INPUTS_KEY: combiner_inputs
     }
-    if standard_preprocessors:
-      preprocessor = metric_types.StandardMetricInputsPreprocessorList(
-          standard_preprocessors)
-      extracts = copy.copy(extracts)
-      preprocessor.process(extracts)
-      default_combiner_input = metric_util.to_standard_metric_inputs(
-          extracts,
-          include_features=(constants.FEATURES_KEY
-                            in preprocessor.include_filter),
-          include_transformed_features=(constants.TRANSFORMED_FEATURES_KEY
-                                        in preprocessor.include_filter),
-          include_attributions=(constants.ATTRIBUTIONS_KEY
-                                in preprocessor.include_filter))
-      output[_DEFAULT_COMBINER_INPUT_KEY] = default_combiner_input
+    if default_combiner_inputs is not None:
+      output[_DEFAULT_COMBINER_INPUT_KEY] = default_combiner_inputs
     yield output
 
     self._timer.update(
         int((datetime.datetime.now() - start_time).total_seconds()))
 
 
+class _ValidateMetricsDoFn(beam.DoFn):
+  """Do function that validates the metrics computed for each slice.
+
+  The thresholds defined in the eval config are indexed once per DoFn instance
+  so that validating each slice only requires lookups and comparisons.
+  """
+
+  def __init__(self, eval_config: config_pb2.EvalConfig):
+    self._eval_config = eval_config
+    self._threshold_index = None
+
+  def setup(self):
+    self._threshold_index = metrics_validator.ThresholdIndex(self._eval_config)
+
+  def process(
+      self, sliced_metrics: Tuple[Union[slicer.SliceKeyType,
+                                        slicer.CrossSliceKeyType],
+                                  metric_types.MetricsDict]
+  ) -> Iterator[validation_result_pb2.ValidationResult]:
+    yield metrics_validator.validate_metrics(sliced_metrics, self._eval_config,
+                                             self._threshold_index)
+
+
+def _get_combiner_input(element: types.Extracts, i: int) -> Any:
+  """Returns input for the i-th combiner from a preprocessed extract."""
+  item = element[_COMBINER_INPUTS_KEY][i]
+  if item is None:
+    item = element[_DEFAULT_COMBINER_INPUT_KEY]
+  return item
+
+
+def _get_combiner_inputs(element: types.Extracts, i: int) -> List[Any]:
+  """Returns inputs for the i-th combiner from a batched extract."""
+  combiner_inputs = element[_COMBINER_INPUTS_KEY]
+  default_combiner_inputs = element.get(_DEFAULT_COMBINER_INPUT_KEY)
+  items = []
+  for j, inputs in enumerate(combiner_inputs):
+    item = inputs[i]
+    if item is None:
+      item = default_combiner_inputs[j]
+    items.append(item)
+  return items
+
+
 @beam.typehints.with_input_types(types.Extracts)
 @beam.typehints.with_output_types(metric_types.MetricsDict)
 class _ComputationsCombineFn(beam.combiners.SingleInputTupleCombineFn):
   """Combine function that computes metric using initial state from extracts."""
 
-  def __init__(self, computations: List[metric_types.MetricComputation]):
+  def __init__(self,
+               computations: List[metric_types.MetricComputation],
+               batched: bool = False):
     """Init.
 
 
     Args:
       computations: List of MetricComputations.
+      batched: True if the elements passed to add_input are batched (i.e. the
+        combiner inputs are stored as lists with one entry per example). In
+        this case the inputs are passed to each combiner using add_inputs.
     """
     super().__init__(*[c.combiner for c in computations])
+    self._batched = batched
     self._num_compacts = beam.metrics.Metrics.counter(
         constants.METRICS_NAMESPACE, 'num_compacts')
 
   def add_input(self, accumulator: Any, element: types.Extracts):
-
-    def get_combiner_input(element, i):
-      item = element[_COMBINER_INPUTS_KEY][i]
-      if item is None:
-        item = element[_DEFAULT_COMBINER_INPUT_KEY]
-      return item
+    if self._batched:
+      # Combiners that support vectorized updates override add_inputs, the
+      # default implementation falls back to calling add_input per example.
+      return tuple(
+          c.add_inputs(a, _get_combiner_inputs(element, i))
+          for i, (c, a) in enumerate(zip(self._combiners, accumulator)))
 
     results = []
     for i, (c, a) in enumerate(zip(self._combiners, accumulator)):
-      result = c.add_input(a, get_combiner_input(element, i))
+      result = c.add_input(a, _get_combiner_input(element, i))
       results.append(result)
     return tuple(results)
 
+  def add_inputs(self, accumulator: Any,
+                 elements: Iterable[types.Extracts]) -> Any:
+    if self._batched:
+      return super().add_inputs(accumulator, elements)
+    # Pass all the elements to each combiner at once so that combiners that
+    # support vectorized updates can make use of them.
+    elements = list(elements)
+    return tuple(
+        c.add_inputs(a, [_get_combiner_input(e, i) for e in elements])
+        for i, (c, a) in enumerate(zip(self._combiners, accumulator)))
+
+  def add_weighted_inputs(self, accumulator: Any,
+                          elements: Iterable[types.Extracts],
+                          weights: Iterable[int]) -> Any:
+    """Adds each element the given number of times (see add_inputs).
+
+    Args:
+      accumulator: Accumulator.
+      elements: Unbatched elements.
+      weights: Number of times each element is added.
+
+    Returns:
+      Updated accumulator.
+
+    Raises:
+      ValueError: If the elements are batched. Weighting a whole batch would
+        resample batches instead of examples.
+    """
+    if self._batched:
+      raise ValueError('weighted inputs are only supported for unbatched '
+                       'elements')
+    elements = list(elements)
+    weights = list(weights)
+    return tuple(
+        beam_util.add_weighted_inputs(
+            c, a, [_get_combiner_input(e, i) for e in elements], weights)
+        for i, (c, a) in enumerate(zip(self._combiners, accumulator)))
+
   def compact(self, accumulator: Any) -> Any:
     self._num_compacts.inc(1)
     return super().compact(accumulator)
@@ -400,25 +739,6 @@ def _AddCrossSliceMetrics(  # pylint: disable=invalid-name
                                    metric_types.MetricsDict]]:
   """Generates CrossSlice metrics from SingleSlices."""
 
-  def is_slice_applicable(
-      sliced_combiner_output: Tuple[slicer.SliceKeyType,
-                                    metric_types.MetricsDict],
-      slicing_specs: Union[config_pb2.SlicingSpec,
-                           Iterable[config_pb2.SlicingSpec]]
-  ) -> bool:
-    slice_key, _ = sliced_combiner_output
-    return any(
-        slicer.SingleSliceSpec(spec=slicing_spec).is_slice_applicable(slice_key)
-        for slicing_spec in slicing_specs)
-
-  def is_not_slice_applicable(
-      sliced_combiner_output: Tuple[slicer.SliceKeyType,
-                                    metric_types.MetricsDict],
-      slicing_specs: Union[config_pb2.SlicingSpec,
-                           Iterable[config_pb2.SlicingSpec]]
-  ) -> bool:
-    return not is_slice_applicable(sliced_combiner_output, slicing_specs)
-
   def compute_cross_slices(
       baseline_slice: Tuple[slicer.SliceKeyType, metric_types.MetricsDict],
       comparison_slices: Iterable[Tuple[slicer.SliceKeyType,
@@ -447,32 +767,102 @@ def _AddCrossSliceMetrics(  # pylint: disable=invalid-name
 
       yield ((baseline_slice_key, comparison_slice_key), result)
 
+  cross_slice_specs = list(cross_slice_specs or [])
+  baseline_matchers = [
+      slicer.get_slice_spec_matcher([spec.baseline_spec])
+      for spec in cross_slice_specs
+  ]
+  # When slicing_specs is not set, all available slices except the baseline
+  # are considered as candidates (indicated by a None matcher).
+  comparison_matchers = [
+      slicer.get_slice_spec_matcher(spec.slicing_specs)
+      if spec.slicing_specs else None for spec in cross_slice_specs
+  ]
+  # Baseline specs without feature keys match at most one slice, so their
+  # baselines are broadcast to the comparison slices instead of being joined.
+  broadcast_spec_indices = frozenset(
+      i for i, spec in enumerate(cross_slice_specs)
+      if not spec.baseline_spec.feature_keys)
+
+  def tag_cross_slice_specs(
+      sliced_combiner_output: Tuple[slicer.SliceKeyType,
+                                    metric_types.MetricsDict]
+  ) -> Iterator[beam.pvalue.TaggedOutput]:
+    """Tags the output with the indices of the specs it is used by."""
+    slice_key, _ = sliced_combiner_output
+    for i, (baseline_matcher, comparison_matcher) in enumerate(
+        zip(baseline_matchers, comparison_matchers)):
+      is_baseline = baseline_matcher.matches(slice_key)
+      if comparison_matcher is not None:
+        is_comparison = comparison_matcher.matches(slice_key)
+      else:
+        is_comparison = not is_baseline
+      if i in broadcast_spec_indices:
+        if is_baseline:
+          yield beam.pvalue.TaggedOutput(_BROADCAST_BASELINES_TAG,
+                                         (i, sliced_combiner_output))
+        if is_comparison:
+          yield beam.pvalue.TaggedOutput(_BROADCAST_COMPARISONS_TAG,
+                                         (i, sliced_combiner_output))
+      else:
+        if is_baseline:
+          # Baselines are joined with the comparisons in every shard.
+          for shard in range(_CROSS_SLICE_JOIN_NUM_SHARDS):
+            yield beam.pvalue.TaggedOutput(_KEYED_BASELINES_TAG,
+                                           ((i, shard), sliced_combiner_output))
+        if is_comparison:
+          shard = (
+              slicer.fingerprint_slice_key(slice_key) %
+              _CROSS_SLICE_JOIN_NUM_SHARDS)
+          yield beam.pvalue.TaggedOutput(_KEYED_COMPARISONS_TAG,
+                                         ((i, shard), sliced_combiner_output))
+
+  def compute_broadcast_cross_slices(
+      indexed_comparison_slice: Tuple[int, Tuple[slicer.SliceKeyType,
+                                                 metric_types.MetricsDict]],
+      baseline_slices: Dict[int, List[Tuple[slicer.SliceKeyType,
+                                            metric_types.MetricsDict]]]
+  ) -> Iterator[Tuple[slicer.CrossSliceKeyType, Dict[metric_types.MetricKey,
+                                                     Any]]]:
+    i, comparison_slice = indexed_comparison_slice
+    for baseline_slice in baseline_slices.get(i, []):
+      yield from compute_cross_slices(baseline_slice, [comparison_slice])
+
+  def compute_joined_cross_slices(
+      joined_slices: Tuple[Tuple[int, int], Dict[str, Iterable[Tuple[
+          slicer.SliceKeyType, metric_types.MetricsDict]]]]
+  ) -> Iterator[Tuple[slicer.CrossSliceKeyType, Dict[metric_types.MetricKey,
+                                                     Any]]]:
+    _, slices = joined_slices
+    comparison_slices = list(slices[_KEYED_COMPARISONS_TAG])
+    for baseline_slice in slices[_KEYED_BASELINES_TAG]:
+      yield from compute_cross_slices(baseline_slice, comparison_slices)
+
   cross_slice_outputs = []
-  for cross_slice_ind, cross_slice_spec in enumerate(cross_slice_specs):
-    baseline_slices = (
+  if cross_slice_specs:
+    tagged_slices = (
         sliced_combiner_outputs
-        | 'FilterBaselineSlices(%d)' % cross_slice_ind >> beam.Filter(
-            is_slice_applicable, [cross_slice_spec.baseline_spec]))
-
-    if cross_slice_spec.slicing_specs:
-      slicing_specs = list(cross_slice_spec.slicing_specs)
-      comparison_slices = (
-          sliced_combiner_outputs
-          | 'FilterToComparisonSlices(%d)' % cross_slice_ind >> beam.Filter(
-              is_slice_applicable, slicing_specs))
-    else:
-      # When slicing_specs is not set, consider all available slices except the
-      # baseline as candidates.
-      comparison_slices = (
-          sliced_combiner_outputs
-          | 'FilterOutBaselineSlices(%d)' % cross_slice_ind >> beam.Filter(
-              is_not_slice_applicable, [cross_slice_spec.baseline_spec]))
-
-    cross_slice_outputs.append(
-        baseline_slices
-        | 'GenerateCrossSlices(%d)' % cross_slice_ind >> beam.FlatMap(
-            compute_cross_slices,
-            comparison_slices=beam.pvalue.AsIter(comparison_slices)))
+        | 'TagCrossSliceSpecs' >> beam.FlatMap(
+            tag_cross_slice_specs).with_outputs(_BROADCAST_BASELINES_TAG,
+                                                _BROADCAST_COMPARISONS_TAG,
+                                                _KEYED_BASELINES_TAG,
+                                                _KEYED_COMPARISONS_TAG))
+    if broadcast_spec_indices:
+      cross_slice_outputs.append(
+          tagged_slices[_BROADCAST_COMPARISONS_TAG]
+          | 'GenerateBroadcastCrossSlices' >> beam.FlatMap(
+              compute_broadcast_cross_slices,
+              baseline_slices=beam.pvalue.AsMultiMap(
+                  tagged_slices[_BROADCAST_BASELINES_TAG])))
+    if len(broadcast_spec_indices) < len(cross_slice_specs):
+      cross_slice_outputs.append(
+          {
+              _KEYED_BASELINES_TAG: tagged_slices[_KEYED_BASELINES_TAG],
+              _KEYED_COMPARISONS_TAG: tagged_slices[_KEYED_COMPARISONS_TAG],
+          }
+          | 'JoinCrossSlices' >> beam.CoGroupByKey()
+          | 'GenerateJoinedCrossSlices' >> beam.FlatMap(
+              compute_joined_cross_slices))
 
   if cross_slice_outputs:
     cross_slice_outputs = (
@@ -661,8 +1051,8 @@ def _ComputeMetricsAndPlots(  # pylint: disable=invalid-name
     attributions_key: str = constants.ATTRIBUTIONS_KEY,
     schema: Optional[schema_pb2.Schema] = None,
     random_seed_for_testing: Optional[int] = None,
-    tensor_adapter_config: Optional[tensor_adapter.TensorAdapterConfig] = None
-) -> evaluator.Evaluation:
+    tensor_adapter_config: Optional[tensor_adapter.TensorAdapterConfig] = None,
+    batched_inputs: bool = False) -> evaluator.Evaluation:
   """Computes metrics and plots.
 
   Args:
@@ -684,6 +1074,9 @@ def _ComputeMetricsAndPlots(  # pylint: disable=invalid-name
       create an adapter based on the model's input signature otherwise the model
       will be invoked with raw examples (assuming a  signature of a single 1-D
       string tensor).
+    batched_inputs: True if the extracts are batched. Batched extracts are
+      sliced and combined per batch except when confidence intervals are used
+      in which case they are first unbatched.
 
   Returns:
     Evaluation containing dict of PCollections of (slice_key, results_dict)
@@ -714,17 +1107,28 @@ def _ComputeMetricsAndPlots(  # pylint: disable=invalid-name
             eval_saved_model_util.metric_computations_using_eval_saved_model(
                 model_name, eval_shared_model.model_loader))
   # Add metric computations from specs
-  metric_computations = _filter_and_separate_computations(
+  spec_computations, _ = metric_specs.merge_equivalent_computations(
       metric_specs.to_computations(
           metrics_specs, eval_config=eval_config, schema=schema))
+  metric_computations = _filter_and_separate_computations(spec_computations)
   computations.extend(metric_computations.non_derived_computations)
 
   # Find out which model is baseline.
   baseline_spec = model_util.get_baseline_model_spec(eval_config)
   baseline_model_name = baseline_spec.name if baseline_spec else None
 
+  ci_params = _get_confidence_interval_params(eval_config, metrics_specs)
+
   # pylint: disable=no-value-for-parameter
 
+  if batched_inputs and (ci_params.num_bootstrap_samples or
+                         ci_params.num_jackknife_samples):
+    # Resampling for confidence intervals is done per example.
+    extracts = (
+        extracts
+        | 'UnbatchInputs' >> unbatch_extractor.UnbatchExtractor().ptransform)
+    batched_inputs = False
+
   # Input: Single extract per example (or list of extracts if query_key used)
   #        where each item contains slice keys and other extracts from upstream
   #        extractors (e.g. labels, predictions, etc).
@@ -737,9 +1141,13 @@ def _ComputeMetricsAndPlots(  # pylint: disable=invalid-name
   # Note that the output of this step is extracts instead of just a tuple of
   # computation outputs because FanoutSlices takes extracts as input (and in
   # many cases a subset of the extracts themselves are what is fanned out).
+  #
+  # If batched_inputs is True, the input and output represent a batch of
+  # examples with one entry per example stored under each key.
   extracts = (
       extracts
-      | 'Preprocesss' >> beam.ParDo(_PreprocessorDoFn(computations)))
+      | 'Preprocesss' >> beam.ParDo(
+          _PreprocessorDoFn(computations, batched=batched_inputs)))
 
   # Input: Single extract containing slice keys and initial combiner inputs. If
   #        query_key is used the extract represents multiple examples with the
@@ -748,12 +1156,62 @@ def _ComputeMetricsAndPlots(  # pylint: disable=invalid-name
   #         example (or list or examples if query_key used) input extract turns
   #         into n logical extracts, references to which are replicated once per
   #         applicable slice key.
-  slices = extracts | 'FanoutSlices' >> slicer.FanoutSlices()
+  #         If batched_inputs is True, the examples in a batch are grouped by
+  #         slice key and only one batch is output per slice key.
+  #         If the fingerprint_slice_keys option is set, the slice keys are
+  #         replaced by their fingerprints until the metrics are combined.
+  #         If a rollup plan is used, examples whose slices can be rolled up
+  #         are output once keyed by a rollup key for their finest slice.
+  fingerprint_slice_keys = eval_config.options.fingerprint_slice_keys.value
+  rollup_plan = None
+  if (eval_config.options.rollup_slices.value and not fingerprint_slice_keys and
+      not ci_params.num_bootstrap_samples and
+      not ci_params.num_jackknife_samples and
+      not any(spec.query_key for spec in metrics_specs)):
+    rollup_plan = slicer.get_slice_rollup_plan([
+        slicer.SingleSliceSpec(spec=spec) for spec in eval_config.slicing_specs
+    ])
+  slices = (
+      extracts
+      | 'FanoutSlices' >> slicer.FanoutSlices(
+          batched=batched_inputs,
+          fingerprint_slice_keys=fingerprint_slice_keys,
+          rollup_plan=rollup_plan))
 
-  slices_count = (
-      slices
-      | 'ExtractSliceKeys' >> beam.Keys()
-      | 'CountPerSliceKey' >> beam.combiners.Count.PerElement())
+  if batched_inputs:
+    slices_count = (
+        slices
+        | 'ExtractSliceKeysAndBatchSizes' >> beam.MapTuple(
+            lambda k, v: (k, len(v[_COMBINER_INPUTS_KEY])))
+        | 'CountPerSliceKey' >> beam.CombinePerKey(sum))
+  else:
+    slices_count = (
+        slices
+        | 'ExtractSliceKeys' >> beam.Keys()
+        | 'CountPerSliceKey' >> beam.combiners.Count.PerElement())
+
+  hot_key_fanout = _COMBINE_PER_SLICE_KEY_HOT_KEY_FANOUT
+  if eval_config.options.adaptive_hot_key_fanout.value:
+    # Computed from the counts per key output by FanoutSlices (i.e. before the
+    # counts are translated to slice keys below).
+    hot_key_fanout = beam.pvalue.AsDict(
+        slices_count
+        | 'ComputeHotKeyFanouts' >> beam.FlatMapTuple(_hot_key_fanout))
+
+  if rollup_plan:
+    slices_count = (
+        slices_count
+        | 'ExpandSliceCountRollups' >> slicer.ExpandSliceRollups(rollup_plan)
+        | 'CombineSliceCountRollups' >> beam.CombinePerKey(sum))
+  elif fingerprint_slice_keys:
+    slice_keys_by_fingerprint = beam.pvalue.AsDict(
+        extracts
+        | 'SliceKeysByFingerprint' >> slicer.SliceKeysByFingerprint(
+            batched=batched_inputs))
+    slices_count = (
+        slices_count
+        | 'TranslateSliceCountFingerprints' >>
+        slicer.TranslateSliceKeyFingerprints(slice_keys_by_fingerprint))
 
   model_types = _get_model_types_for_logging(eval_shared_models)
 
@@ -765,14 +1223,19 @@ def _ComputeMetricsAndPlots(  # pylint: disable=invalid-name
       |
       'IncrementSliceSpecCounters' >> counter_util.IncrementSliceSpecCounters())
 
-  ci_params = _get_confidence_interval_params(eval_config, metrics_specs)
-
   cross_slice_specs = eval_config.cross_slicing_specs or []
-  computations_combine_fn = _ComputationsCombineFn(computations=computations)
+  computations_combine_fn = _ComputationsCombineFn(
+      computations=computations, batched=batched_inputs)
   derived_metrics_ptransform = _AddDerivedCrossSliceAndDiffMetrics(
       metric_computations.derived_computations,
       metric_computations.cross_slice_computations, cross_slice_specs,
       baseline_model_name)
+  if fingerprint_slice_keys:
+    # The derived (and in particular cross slice) metrics require the actual
+    # slice keys.
+    derived_metrics_ptransform = (
+        slicer.TranslateSliceKeyFingerprints(slice_keys_by_fingerprint)
+        | derived_metrics_ptransform)
 
   # Input: Tuple of (slice key, combiner input extracts).
   # Output: Tuple of (slice key, dict of computed metrics/plots/attributions).
@@ -781,15 +1244,17 @@ def _ComputeMetricsAndPlots(  # pylint: disable=invalid-name
   #         MetricComputation can perform computations for multiple keys, but
   #         the keys should be unique across computations.
   if ci_params.num_bootstrap_samples:
+    ci_options = eval_config.options.confidence_intervals
     sliced_metrics_plots_and_attributions = (
         slices | 'PoissonBootstrapConfidenceIntervals' >>
         poisson_bootstrap.ComputeWithConfidenceIntervals(
             computations_combine_fn=computations_combine_fn,
             derived_metrics_ptransform=derived_metrics_ptransform,
             num_bootstrap_samples=ci_params.num_bootstrap_samples,
-            hot_key_fanout=_COMBINE_PER_SLICE_KEY_HOT_KEY_FANOUT,
+            hot_key_fanout=hot_key_fanout,
             skip_ci_metric_keys=ci_params.skip_ci_metric_keys,
-            random_seed_for_testing=random_seed_for_testing))
+            random_seed_for_testing=random_seed_for_testing,
+            single_pass=ci_options.single_pass_bootstrap))
   elif ci_params.num_jackknife_samples:
     sliced_metrics_plots_and_attributions = (
         slices
@@ -800,13 +1265,26 @@ def _ComputeMetricsAndPlots(  # pylint: disable=invalid-name
             num_jackknife_samples=ci_params.num_jackknife_samples,
             skip_ci_metric_keys=ci_params.skip_ci_metric_keys,
             random_seed_for_testing=random_seed_for_testing))
-  else:
+  elif rollup_plan:
+    # The finest slices are combined into accumulators which are then merged
+    # into each of the slices that they roll up to.
     sliced_metrics_plots_and_attributions = (
         slices
-        |
-        'CombineMetricsPerSlice' >> beam.CombinePerKey(computations_combine_fn)
+        | 'AccumulateMetricsPerSlice' >>
+        beam_util.CombinePerKeyWithHotKeyFanout(
+            beam_util.AccumulateOnlyCombineFn(computations_combine_fn),
+            hot_key_fanout)
+        | 'ExpandSliceRollups' >> slicer.ExpandSliceRollups(rollup_plan)
+        | 'CombineMetricsPerSlice' >> beam.CombinePerKey(
+            beam_util.AccumulatorCombineFn(computations_combine_fn))
         .with_hot_key_fanout(_COMBINE_PER_SLICE_KEY_HOT_KEY_FANOUT)
         | 'AddDerivedCrossSliceAndDiffMetrics' >> derived_metrics_ptransform)
+  else:
+    sliced_metrics_plots_and_attributions = (
+        slices
+        | 'CombineMetricsPerSlice' >> beam_util.CombinePerKeyWithHotKeyFanout(
+            computations_combine_fn, hot_key_fanout)
+        | 'AddDerivedCrossSliceAndDiffMetrics' >> derived_metrics_ptransform)
 
   sliced_metrics_plots_and_attributions = (
       sliced_metrics_plots_and_attributions
@@ -866,7 +1344,8 @@ def _EvaluateMetricsPlotsAndValidations(  # pylint: disable=invalid-name
       include labels keyed by tfma.LABELS_KEY, predictions keyed by
       tfma.PREDICTIONS_KEY, and example weights keyed by
       tfma.EXAMPLE_WEIGHTS_KEY). Usually these will be added by calling the
-      default_extractors function.
+      default_extractors function. If options.batched_metrics_inputs is set in
+      the eval config then the extracts are expected to be batched.
     eval_config: Eval config.
     eval_shared_models: Optional dict of shared models keyed by model name. Only
       required if there are metrics to be computed in-graph using the model.
@@ -904,12 +1383,27 @@ def _EvaluateMetricsPlotsAndValidations(  # pylint: disable=invalid-name
 
   # pylint: disable=no-value-for-parameter
 
+  batched_inputs = eval_config.options.batched_metrics_inputs.value
+  clustered_query_keys = eval_config.options.clustered_query_keys.value
+
   evaluations = {}
   for query_key, metrics_specs in metrics_specs_by_query_key.items():
     query_key_text = query_key or ''
-    if query_key:
+    if query_key and batched_inputs and clustered_query_keys:
       extracts_for_evaluation = (
           extracts
+          | 'GroupClusteredQueryKey({})'.format(query_key_text) >>
+          _GroupClusteredQueryKey(query_key))
+      include_default_metrics = False
+    elif query_key:
+      extracts_for_evaluation = extracts
+      if batched_inputs:
+        extracts_for_evaluation = (
+            extracts_for_evaluation
+            | 'UnbatchInputs({})'.format(query_key_text) >>
+            unbatch_extractor.UnbatchExtractor().ptransform)
+      extracts_for_evaluation = (
+          extracts_for_evaluation
           | 'GroupByQueryKey({})'.format(query_key_text) >>
           _GroupByQueryKey(query_key))
       include_default_metrics = False
@@ -932,7 +1426,8 @@ def _EvaluateMetricsPlotsAndValidations(  # pylint: disable=invalid-name
             attributions_key=attributions_key,
             schema=schema,
             random_seed_for_testing=random_seed_for_testing,
-            tensor_adapter_config=tensor_adapter_config))
+            tensor_adapter_config=tensor_adapter_config,
+            batched_inputs=batched_inputs and not query_key))
 
     for k, v in evaluation.items():
       if k not in evaluations:
@@ -942,12 +1437,22 @@ def _EvaluateMetricsPlotsAndValidations(  # pylint: disable=invalid-name
 
   validations = (
       evaluation_results[metrics_key]
-      | 'ValidateMetrics' >> beam.Map(metrics_validator.validate_metrics,
-                                      eval_config))
+      | 'ValidateMetrics' >> beam.ParDo(_ValidateMetricsDoFn(eval_config)))
   evaluation_results[validations_key] = validations
   return evaluation_results
 
 
+def _hot_key_fanout(slice_key: Any,
+                    count: int) -> Iterator[Tuple[Any, int]]:
+  """Yields the (slice key, fanout) for slices that should be fanned out."""
+  fanout = min(_MAX_ADAPTIVE_HOT_KEY_FANOUT,
+               -(-count // _ADAPTIVE_HOT_KEY_FANOUT_EXAMPLES_PER_KEY))
+  if fanout > 1:
+    beam.metrics.Metrics.distribution(constants.METRICS_NAMESPACE,
+                                      'adaptive_hot_key_fanout').update(fanout)
+    yield (slice_key, fanout)
+
+
 def _get_model_types_for_logging(
     eval_shared_models: Dict[str, types.EvalSharedModel]):
   if eval_shared_models:
@@ -14,6 +14,7 @@
 """Test for MetricsPlotsAndValidationsEvaluator."""
 
 import os
+from unittest import mock
 
 from absl.testing import parameterized
 import apache_beam as beam
@@ -47,6 +48,7 @@ from tensorflow_model_analysis.metrics import ndcg
 from tensorflow_model_analysis.post_export_metrics import metrics as metric_fns
 from tensorflow_model_analysis.proto import config_pb2
 from tensorflow_model_analysis.proto import validation_result_pb2
+from tensorflow_model_analysis.slicer import slicer_lib as slicer
 from tfx_bsl.tfxio import raw_tf_record
 from tfx_bsl.tfxio import tensor_adapter
 from tfx_bsl.tfxio import test_util
@@ -2709,6 +2711,141 @@ class MetricsPlotsAndValidationsEvaluatorTest(
 
       util.assert_that(cross_sliced_metrics, check_result)
 
+  def testAddCrossSliceMetricsWithKeyedBaselines(self):
+    overall_slice_key = ()
+    slice_key1 = (('feature', 1),)
+    slice_key2 = (('feature', 2),)
+    other_slice_key = (('other_feature', 'a'),)
+    metric_key = metric_types.MetricKey(name='metric')
+    sliced_metrics = [(overall_slice_key, {
+        metric_key: 1.0
+    }), (slice_key1, {
+        metric_key: 2.0
+    }), (slice_key2, {
+        metric_key: 3.0
+    }), (other_slice_key, {
+        metric_key: 5.0
+    })]
+    with beam.Pipeline() as pipeline:
+      cross_sliced_metrics = (
+          pipeline | 'CreateSlicedMetrics' >> beam.Create(sliced_metrics)
+          | 'AddCrossSliceMetrics' >>
+          metrics_plots_and_validations_evaluator._AddCrossSliceMetrics(
+              cross_slice_specs=[
+                  config_pb2.CrossSlicingSpec(
+                      baseline_spec=config_pb2.SlicingSpec(
+                          feature_keys=['feature']),
+                      slicing_specs=[
+                          config_pb2.SlicingSpec(),
+                          config_pb2.SlicingSpec(feature_keys=['other_feature'])
+                      ]),
+                  config_pb2.CrossSlicingSpec(
+                      baseline_spec=config_pb2.SlicingSpec(
+                          feature_values={'feature': '1'}),
+                      slicing_specs=[
+                          config_pb2.SlicingSpec(feature_keys=['feature'])
+                      ]),
+              ],
+              cross_slice_computations=[]))
+
+      def check_result(got_sliced_metrics):
+        try:
+          got_cross_sliced_metrics = {
+              k: v[metric_key]
+              for k, v in got_sliced_metrics
+              if slicer.is_cross_slice_key(k)
+          }
+          self.assertEqual(
+              {
+                  (slice_key1, overall_slice_key): 1.0,
+                  (slice_key1, other_slice_key): -3.0,
+                  (slice_key2, overall_slice_key): 2.0,
+                  (slice_key2, other_slice_key): -2.0,
+                  (slice_key1, slice_key1): 0.0,
+                  (slice_key1, slice_key2): -1.0,
+              }, got_cross_sliced_metrics)
+          self.assertLen(got_sliced_metrics, 10)
+        except AssertionError as err:
+          raise util.BeamAssertException(err)
+
+      util.assert_that(cross_sliced_metrics, check_result)
+
+  def _assert_grouped_clustered_queries(self, batches, expected_labels):
+    with beam.Pipeline() as pipeline:
+      result = (
+          pipeline
+          | 'Create' >> beam.Create(batches, reshuffle=False)
+          | 'GroupClusteredQueryKey' >>
+          metrics_plots_and_validations_evaluator._GroupClusteredQueryKey(
+              'query'))
+
+      def check_result(got):
+        try:
+          got_labels = {}
+          for extracts in got:
+            query_ids = set(extracts[constants.FEATURES_KEY]['query'].tolist())
+            self.assertLen(query_ids, 1)
+            labels = extracts[constants.LABELS_KEY]
+            np.testing.assert_array_equal(labels,
+                                          extracts[constants.PREDICTIONS_KEY])
+            self.assertLen(extracts[constants.SLICE_KEY_TYPES_KEY], len(labels))
+            query_id = query_ids.pop()
+            # Each query is output as a single group.
+            self.assertNotIn(query_id, got_labels)
+            got_labels[query_id] = sorted(labels.tolist())
+          self.assertEqual(expected_labels, got_labels)
+        except AssertionError as err:
+          raise util.BeamAssertException(err)
+
+      util.assert_that(result, check_result)
+
+  def _make_query_batch(self, query_ids, labels):
+    return {
+        constants.FEATURES_KEY: [{
+            'query': np.array([q])
+        } for q in query_ids],
+        constants.LABELS_KEY: np.array(labels),
+        constants.PREDICTIONS_KEY: [np.array([l]) for l in labels],
+        constants.SLICE_KEY_TYPES_KEY: [[()] for _ in query_ids],
+    }
+
+  def testGroupClusteredQueryKey(self):
+    batches = [
+        self._make_query_batch([b'q1', b'q1', b'q2', b'q3', b'q3'],
+                               [1., 2., 3., 4., 5.]),
+        self._make_query_batch([b'q3', b'q4', b'q4', b'q5'], [6., 7., 8., 9.]),
+        # Queries that are not clustered are still grouped.
+        self._make_query_batch([b'q5', b'q1'], [10., 11.]),
+    ]
+    self._assert_grouped_clustered_queries(
+        batches, {
+            b'q1': [1., 2., 11.],
+            b'q2': [3.],
+            b'q3': [4., 5., 6.],
+            b'q4': [7., 8.],
+            b'q5': [9., 10.],
+        })
+
+  def testGroupClusteredQueryKeyWithRepeatedInteriorQueries(self):
+    batches = [
+        # q2 is found twice inside the batch and q3 is also found at the edge
+        # of the last batch.
+        self._make_query_batch([b'q1', b'q2', b'q3', b'q2', b'q4'],
+                               [1., 2., 3., 4., 5.]),
+        # q2 is also found inside another batch.
+        self._make_query_batch([b'q5', b'q2', b'q6'], [6., 7., 8.]),
+        self._make_query_batch([b'q6', b'q3'], [9., 10.]),
+    ]
+    self._assert_grouped_clustered_queries(
+        batches, {
+            b'q1': [1.],
+            b'q2': [2., 4., 7.],
+            b'q3': [3., 10.],
+            b'q4': [5.],
+            b'q5': [6.],
+            b'q6': [8., 9.],
+        })
+
   @parameterized.named_parameters(
       ('IntIsDiffable', 1, True),
       ('FloatIsDiffable', 1.0, True),
@@ -2732,6 +2869,350 @@ class MetricsPlotsAndValidationsEvaluatorTest(
         metrics_plots_and_validations_evaluator._is_metric_diffable(
             metric_value))
 
+  def _makeEvalConfigWithOptions(self,
+                                 metrics=None,
+                                 slicing_specs=None,
+                                 cross_slicing_specs=None,
+                                 **options):
+    """Returns an eval config using the prediction and label features.
+
+    Args:
+      metrics: Metrics to compute. Defaults to the mean label.
+      slicing_specs: Slicing specs. Defaults to the overall and gender slices.
+      cross_slicing_specs: Optional cross slicing specs.
+      **options: Values of the eval config options keyed by option name (e.g.
+        batched_metrics_inputs=True).
+    """
+    eval_config = config_pb2.EvalConfig(
+        model_specs=[
+            config_pb2.ModelSpec(
+                prediction_key='prediction', label_key='label')
+        ],
+        metrics_specs=metric_specs.specs_from_metrics(
+            metrics or [calibration.MeanLabel('mean_label')]),
+        slicing_specs=slicing_specs or [
+            config_pb2.SlicingSpec(),
+            config_pb2.SlicingSpec(feature_keys=['gender'])
+        ],
+        cross_slicing_specs=cross_slicing_specs or [])
+    for name, value in options.items():
+      getattr(eval_config.options, name).value = value
+    return eval_config
+
+  def _evaluateWithDefaultExtractors(self, eval_config, examples,
+                                     check_metrics):
+    """Evaluates the examples using the default extractors.
+
+    Args:
+      eval_config: Eval config.
+      examples: tf.Examples with label, prediction and optionally gender and
+        country features.
+      check_metrics: Function passed the list of (slice key, metrics) outputs.
+
+    Returns:
+      The result of the pipeline (e.g. to query its metrics).
+    """
+    schema = text_format.Parse(
+        """
+        feature {
+          name: "label"
+          type: FLOAT
+        }
+        feature {
+          name: "prediction"
+          type: FLOAT
+        }
+        feature {
+          name: "gender"
+          type: BYTES
+        }
+        feature {
+          name: "country"
+          type: BYTES
+        }
+        """, schema_pb2.Schema())
+
+    tfx_io = test_util.InMemoryTFExampleRecord(
+        schema=schema, raw_record_column_name=constants.ARROW_INPUT_COLUMN)
+
+    extractors = model_eval_lib.default_extractors(eval_config=eval_config)
+    evaluators = [
+        metrics_plots_and_validations_evaluator
+        .MetricsPlotsAndValidationsEvaluator(eval_config)
+    ]
+
+    pipeline = beam.Pipeline()
+    # pylint: disable=no-value-for-parameter
+    metrics = (
+        pipeline
+        | 'Create' >> beam.Create([e.SerializeToString() for e in examples])
+        | 'BatchExamples' >> tfx_io.BeamSource()
+        | 'InputsToExtracts' >> model_eval_lib.BatchedInputsToExtracts()
+        | 'ExtractEvaluate' >> model_eval_lib.ExtractAndEvaluate(
+            extractors=extractors, evaluators=evaluators))
+    # pylint: enable=no-value-for-parameter
+
+    util.assert_that(
+        metrics[constants.METRICS_KEY], check_metrics, label='metrics')
+    result = pipeline.run()
+    result.wait_until_finish()
+    return result
+
+  def _queryCounter(self, result, name):
+    metric_filter = beam.metrics.metric.MetricsFilter().with_namespace(
+        constants.METRICS_NAMESPACE).with_name(name)
+    [counter] = result.metrics().query(filter=metric_filter)['counters']
+    return counter.committed
+
+  def testEvaluateWithBatchedInputs(self):
+    examples = [
+        self._makeExample(label=1.0, prediction=0.7, gender='f'),
+        self._makeExample(label=0.0, prediction=0.3, gender='m'),
+        self._makeExample(label=1.0, prediction=0.5, gender='f'),
+    ]
+    eval_config = self._makeEvalConfigWithOptions(
+        metrics=[
+            calibration.MeanLabel('mean_label'),
+            calibration.MeanPrediction('mean_prediction')
+        ],
+        batched_metrics_inputs=True)
+
+    extractors = model_eval_lib.default_extractors(eval_config=eval_config)
+    self.assertNotIn(unbatch_extractor.UNBATCH_EXTRACTOR_STAGE_NAME,
+                     [x.stage_name for x in extractors])
+
+    def check_metrics(got):
+      try:
+        self.assertLen(got, 3)
+        slices = dict(got)
+        overall_slice = ()
+        f_slice = (('gender', 'f'),)
+        m_slice = (('gender', 'm'),)
+        self.assertCountEqual(
+            list(slices.keys()), [overall_slice, f_slice, m_slice])
+        example_count_key = metric_types.MetricKey(name='example_count')
+        label_key = metric_types.MetricKey(name='mean_label')
+        pred_key = metric_types.MetricKey(name='mean_prediction')
+        self.assertDictElementsAlmostEqual(
+            slices[overall_slice], {
+                example_count_key: 3,
+                label_key: 2.0 / 3.0,
+                pred_key: 1.5 / 3.0,
+            })
+        self.assertDictElementsAlmostEqual(
+            slices[f_slice], {
+                example_count_key: 2,
+                label_key: 1.0,
+                pred_key: 0.6,
+            })
+        self.assertDictElementsAlmostEqual(
+            slices[m_slice], {
+                example_count_key: 1,
+                label_key: 0.0,
+                pred_key: 0.3,
+            })
+      except AssertionError as err:
+        raise util.BeamAssertException(err)
+
+    self._evaluateWithDefaultExtractors(eval_config, examples, check_metrics)
+
+  @parameterized.named_parameters(('unbatched', False), ('batched', True))
+  def testEvaluateWithFingerprintSliceKeys(self, batched):
+    examples = [
+        self._makeExample(label=1.0, prediction=0.7, gender='f'),
+        self._makeExample(label=0.0, prediction=0.3, gender='m'),
+        self._makeExample(label=1.0, prediction=0.5, gender='f'),
+    ]
+    overall_slice = ()
+    f_slice = (('gender', 'f'),)
+    m_slice = (('gender', 'm'),)
+    example_count_key = metric_types.MetricKey(name='example_count')
+    label_key = metric_types.MetricKey(name='mean_label')
+
+    # The slice counts used to filter small slices are keyed by fingerprint and
+    # need to be translated back to the slice keys.
+    eval_config = self._makeEvalConfigWithOptions(
+        fingerprint_slice_keys=True,
+        min_slice_size=2,
+        batched_metrics_inputs=batched)
+
+    def check_metrics(got):
+      try:
+        self.assertCountEqual([k for k, _ in got],
+                              [overall_slice, f_slice, m_slice])
+        slices = dict(got)
+        self.assertDictElementsAlmostEqual(slices[overall_slice], {
+            example_count_key: 3,
+            label_key: 2.0 / 3.0,
+        })
+        self.assertDictElementsAlmostEqual(slices[f_slice], {
+            example_count_key: 2,
+            label_key: 1.0,
+        })
+        # The m slice is filtered out since it is smaller than min_slice_size.
+        self.assertNotIn(label_key, slices[m_slice])
+      except AssertionError as err:
+        raise util.BeamAssertException(err)
+
+    self._evaluateWithDefaultExtractors(eval_config, examples, check_metrics)
+
+    # The cross slice metrics are computed from the translated slice keys.
+    eval_config = self._makeEvalConfigWithOptions(
+        cross_slicing_specs=[
+            config_pb2.CrossSlicingSpec(
+                baseline_spec=config_pb2.SlicingSpec(),
+                slicing_specs=[config_pb2.SlicingSpec(feature_keys=['gender'])])
+        ],
+        fingerprint_slice_keys=True,
+        batched_metrics_inputs=batched)
+
+    def check_cross_slice_metrics(got):
+      try:
+        slices = dict(got)
+        self.assertCountEqual(slices.keys(), [
+            overall_slice, f_slice, m_slice, (overall_slice, f_slice),
+            (overall_slice, m_slice)
+        ])
+        self.assertDictElementsAlmostEqual(slices[(overall_slice, f_slice)], {
+            example_count_key: 1,
+            label_key: 2.0 / 3.0 - 1.0,
+        })
+        self.assertDictElementsAlmostEqual(slices[(overall_slice, m_slice)], {
+            example_count_key: 2,
+            label_key: 2.0 / 3.0,
+        })
+      except AssertionError as err:
+        raise util.BeamAssertException(err)
+
+    self._evaluateWithDefaultExtractors(eval_config, examples,
+                                        check_cross_slice_metrics)
+
+  @parameterized.named_parameters(('unbatched', False), ('batched', True))
+  def testEvaluateWithRollupSlices(self, batched):
+    examples = [
+        self._makeExample(label=1.0, prediction=0.7, gender='f', country='us'),
+        self._makeExample(label=0.0, prediction=0.3, gender='m', country='us'),
+        self._makeExample(label=1.0, prediction=0.5, gender='f', country='ca'),
+        # Examples without the finest slice columns can not be rolled up.
+        self._makeExample(label=0.0, prediction=0.1, country='us'),
+    ]
+    eval_config = self._makeEvalConfigWithOptions(
+        slicing_specs=[
+            config_pb2.SlicingSpec(),
+            config_pb2.SlicingSpec(feature_keys=['gender']),
+            config_pb2.SlicingSpec(feature_keys=['country']),
+            config_pb2.SlicingSpec(feature_keys=['country', 'gender']),
+        ],
+        rollup_slices=True,
+        min_slice_size=2,
+        batched_metrics_inputs=batched)
+
+    def check_metrics(got):
+      try:
+        overall_slice = ()
+        f_slice = (('gender', 'f'),)
+        m_slice = (('gender', 'm'),)
+        us_slice = (('country', 'us'),)
+        ca_slice = (('country', 'ca'),)
+        self.assertCountEqual([k for k, _ in got], [
+            overall_slice, f_slice, m_slice, us_slice, ca_slice,
+            us_slice + f_slice, us_slice + m_slice, ca_slice + f_slice
+        ])
+        slices = dict(got)
+        example_count_key = metric_types.MetricKey(name='example_count')
+        label_key = metric_types.MetricKey(name='mean_label')
+        self.assertDictElementsAlmostEqual(slices[overall_slice], {
+            example_count_key: 4,
+            label_key: 2.0 / 4.0,
+        })
+        self.assertDictElementsAlmostEqual(slices[f_slice], {
+            example_count_key: 2,
+            label_key: 1.0,
+        })
+        self.assertDictElementsAlmostEqual(slices[us_slice], {
+            example_count_key: 3,
+            label_key: 1.0 / 3.0,
+        })
+        # The other slices are filtered out since they are smaller than
+        # min_slice_size (which is checked against the rolled up counts).
+        for slice_key in (m_slice, ca_slice, us_slice + f_slice,
+                          us_slice + m_slice, ca_slice + f_slice):
+          self.assertNotIn(label_key, slices[slice_key])
+      except AssertionError as err:
+        raise util.BeamAssertException(err)
+
+    result = self._evaluateWithDefaultExtractors(eval_config, examples,
+                                                 check_metrics)
+    # Examples with a finest slice key are output once (instead of once per
+    # slice key) and the example without a gender is output for the overall
+    # and country slices.
+    self.assertEqual(5, self._queryCounter(result, 'post_slice_num_instances'))
+
+  def testHotKeyFanout(self):
+    examples_per_key = (
+        metrics_plots_and_validations_evaluator
+        ._ADAPTIVE_HOT_KEY_FANOUT_EXAMPLES_PER_KEY)
+    max_fanout = (
+        metrics_plots_and_validations_evaluator._MAX_ADAPTIVE_HOT_KEY_FANOUT)
+    hot_key_fanout = metrics_plots_and_validations_evaluator._hot_key_fanout
+    self.assertEqual([], list(hot_key_fanout((), 1)))
+    self.assertEqual([], list(hot_key_fanout((), examples_per_key)))
+    self.assertEqual([((), 2)], list(hot_key_fanout((), examples_per_key + 1)))
+    self.assertEqual(
+        [((), max_fanout)],
+        list(hot_key_fanout((), examples_per_key * max_fanout * 2)))
+
+  @parameterized.named_parameters(('unbatched', False), ('batched', True))
+  def testEvaluateWithAdaptiveHotKeyFanout(self, batched):
+    examples = [
+        self._makeExample(label=1.0, prediction=0.7, gender='f'),
+        self._makeExample(label=0.0, prediction=0.3, gender='m'),
+        self._makeExample(label=1.0, prediction=0.5, gender='f'),
+        self._makeExample(label=0.0, prediction=0.1),
+    ]
+    eval_config = self._makeEvalConfigWithOptions(
+        adaptive_hot_key_fanout=True,
+        min_slice_size=2,
+        batched_metrics_inputs=batched)
+
+    def check_metrics(got):
+      try:
+        overall_slice = ()
+        f_slice = (('gender', 'f'),)
+        m_slice = (('gender', 'm'),)
+        self.assertCountEqual([k for k, _ in got],
+                              [overall_slice, f_slice, m_slice])
+        slices = dict(got)
+        example_count_key = metric_types.MetricKey(name='example_count')
+        label_key = metric_types.MetricKey(name='mean_label')
+        self.assertDictElementsAlmostEqual(slices[overall_slice], {
+            example_count_key: 4,
+            label_key: 2.0 / 4.0,
+        })
+        self.assertDictElementsAlmostEqual(slices[f_slice], {
+            example_count_key: 2,
+            label_key: 1.0,
+        })
+        # The m slice is filtered out since it is smaller than min_slice_size.
+        self.assertNotIn(label_key, slices[m_slice])
+      except AssertionError as err:
+        raise util.BeamAssertException(err)
+
+    # With one example per intermediate key, the overall slice is fanned out
+    # to 4 keys and the f slice to 2 keys while the m slice is combined
+    # directly.
+    with mock.patch.object(metrics_plots_and_validations_evaluator,
+                           '_ADAPTIVE_HOT_KEY_FANOUT_EXAMPLES_PER_KEY', 1):
+      result = self._evaluateWithDefaultExtractors(eval_config, examples,
+                                                   check_metrics)
+
+    metric_filter = beam.metrics.metric.MetricsFilter().with_namespace(
+        constants.METRICS_NAMESPACE).with_name('adaptive_hot_key_fanout')
+    [fanouts] = result.metrics().query(filter=metric_filter)['distributions']
+    self.assertEqual(2, fanouts.committed.count)
+    self.assertEqual(2, fanouts.committed.min)
+    self.assertEqual(4, fanouts.committed.max)
+
   def testMetricsSpecsCountersInModelAgnosticMode(self):
     schema = text_format.Parse(
         """
@@ -2792,6 +3273,79 @@ class MetricsPlotsAndValidationsEvaluatorTest(
         filter=metric_filter)['counters'][0].committed
     self.assertEqual(actual_metrics_count, 1)
 
+  def testComputationsCombineFnRejectsWeightedBatchedInputs(self):
+    computation = metric_types.MetricComputation(
+        keys=[],
+        preprocessor=None,
+        combiner=beam.combiners.CountCombineFn())
+    combine_fn = metrics_plots_and_validations_evaluator._ComputationsCombineFn(
+        [computation], batched=True)
+    with self.assertRaisesRegex(ValueError, 'unbatched'):
+      combine_fn.add_weighted_inputs(combine_fn.create_accumulator(), [{}],
+                                     [2])
+
+
+  def testPreprocessorDoFnWithBatchedInputs(self):
+
+    class LabelPreprocessor(beam.DoFn):
+
+      def process(self, extracts):
+        yield extracts[constants.LABELS_KEY]['output1']
+
+    computations = [
+        metric_types.MetricComputation(
+            keys=[],
+            preprocessor=None,
+            combiner=beam.combiners.CountCombineFn()),
+        metric_types.MetricComputation(
+            keys=[],
+            preprocessor=metric_types.FeaturePreprocessor(
+                feature_keys=['gender']),
+            combiner=beam.combiners.CountCombineFn()),
+        metric_types.MetricComputation(
+            keys=[],
+            preprocessor=LabelPreprocessor(),
+            combiner=beam.combiners.CountCombineFn()),
+    ]
+    batched_extract = {
+        constants.ARROW_RECORD_BATCH_KEY: object(),
+        constants.FEATURES_KEY: {
+            'gender': np.array([b'f', b'm'], dtype=object)
+        },
+        constants.LABELS_KEY: {
+            'output1': np.array([1.0, 0.0]),
+            'output2': np.array([0.0, 1.0]),
+        },
+        constants.PREDICTIONS_KEY: {
+            'output1': np.array([[0.2], [0.4]]),
+            'output2': [np.array([0.6]), np.array([0.8])],
+        },
+        constants.EXAMPLE_WEIGHTS_KEY: None,
+        constants.SLICE_KEY_TYPES_KEY: [[()], [(), (('gender', 'm'),)]],
+    }
+
+    got = next(
+        metrics_plots_and_validations_evaluator._PreprocessorDoFn(
+            computations, batched=True).process(batched_extract))
+
+    self.assertEqual(got[constants.SLICE_KEY_TYPES_KEY],
+                     batched_extract[constants.SLICE_KEY_TYPES_KEY])
+    self.assertEqual(got['_combiner_inputs'],
+                     [[None, None, 1.0], [None, None, 0.0]])
+    default_inputs = got['_default_combiner_input']
+    self.assertLen(default_inputs, 2)
+    for i, default_input in enumerate(default_inputs):
+      self.assertIsInstance(default_input, metric_types.StandardMetricInputs)
+      self.assertNotIn(constants.ARROW_RECORD_BATCH_KEY, default_input)
+      self.assertNotIn(constants.EXAMPLE_WEIGHTS_KEY, default_input)
+      self.assertEqual(default_input[constants.FEATURES_KEY]['gender'],
+                       [b'f', b'm'][i])
+      self.assertEqual(default_input.label['output1'], [1.0, 0.0][i])
+      self.assertEqual(default_input.label['output2'], [0.0, 1.0][i])
+      self.assertAllClose(default_input.prediction['output1'],
+                          [[0.2], [0.4]][i])
+      self.assertAllClose(default_input.prediction['output2'],
+                          [[0.6], [0.8]][i])
 
 if __name__ == '__main__':
   tf.compat.v1.enable_v2_behavior()
@@ -15,7 +15,8 @@
 
 import math
 
-from typing import Any, Dict, Iterable, List, Tuple, Union
+from typing import (Any, Dict, Iterable, List, NamedTuple, Optional, Tuple,
+                    Union)
 import numpy as np
 
 from tensorflow_model_analysis.metrics import metric_specs
@@ -27,6 +28,81 @@ from tensorflow_model_analysis.utils import model_util
 
 _ThresholdType = Union[config_pb2.GenericValueThreshold,
                        config_pb2.GenericChangeThreshold]
+_SliceSpecType = Union[config_pb2.SlicingSpec, config_pb2.CrossSlicingSpec]
+
+
+class _IndexedThreshold(NamedTuple):
+  """Threshold with the values needed to check it precomputed."""
+  slice_spec: Optional[_SliceSpecType]
+  threshold: _ThresholdType
+  # Serialized threshold. Note that hashing by SerializeToString() is only safe
+  # if used within the same process.
+  threshold_hash: bytes
+  # SliceSpecMatcher or CrossSliceSpecMatcher for the slice_spec (if any).
+  matcher: Optional[Union[slicer.SliceSpecMatcher,
+                          slicer.CrossSliceSpecMatcher]]
+  # (lower_bound, upper_bound) for value thresholds and (direction, absolute,
+  # relative) for change thresholds. None if the direction is unknown.
+  bounds: Optional[Tuple[Any, ...]]
+
+
+def _threshold_bounds(threshold: _ThresholdType) -> Optional[Tuple[Any, ...]]:
+  """Returns the bounds used to check the threshold."""
+  if isinstance(threshold, config_pb2.GenericValueThreshold):
+    lower_bound, upper_bound = -np.inf, np.inf
+    if threshold.HasField('lower_bound'):
+      lower_bound = threshold.lower_bound.value
+    if threshold.HasField('upper_bound'):
+      upper_bound = threshold.upper_bound.value
+    return (lower_bound, upper_bound)
+  elif isinstance(threshold, config_pb2.GenericChangeThreshold):
+    if threshold.direction == config_pb2.MetricDirection.LOWER_IS_BETTER:
+      absolute, relative = np.inf, np.inf
+    elif threshold.direction == config_pb2.MetricDirection.HIGHER_IS_BETTER:
+      absolute, relative = -np.inf, -np.inf
+    else:
+      return None
+    if threshold.HasField('absolute'):
+      absolute = threshold.absolute.value
+    if threshold.HasField('relative'):
+      relative = threshold.relative.value
+    return (threshold.direction, absolute, relative)
+  else:
+    raise ValueError('Unknown threshold: {}'.format(threshold))
+
+
+class ThresholdIndex:
+  """Index of the metric thresholds defined in an EvalConfig.
+
+  The thresholds (along with compiled matchers for their slice specs and the
+  bounds used to check them) are computed once so that validating the metrics
+  for each slice only requires lookups and comparisons.
+  """
+
+  def __init__(self, eval_config: config_pb2.EvalConfig):
+    baseline_spec = model_util.get_baseline_model_spec(eval_config)
+    self.baseline_model_name = baseline_spec.name if baseline_spec else None
+    self.thresholds = metric_specs.metric_thresholds_from_metrics_specs(
+        eval_config.metrics_specs, eval_config=eval_config)
+    self.indexed_thresholds: Dict[metric_types.MetricKey,
+                                  List[_IndexedThreshold]] = {}
+    for metric_key, thresholds in self.thresholds.items():
+      indexed_thresholds = []
+      for slice_spec, threshold in thresholds:
+        if isinstance(slice_spec, config_pb2.SlicingSpec):
+          matcher = slicer.get_slice_spec_matcher([slice_spec])
+        elif isinstance(slice_spec, config_pb2.CrossSlicingSpec):
+          matcher = slicer.get_cross_slice_spec_matcher(slice_spec)
+        else:
+          matcher = None
+        indexed_thresholds.append(
+            _IndexedThreshold(
+                slice_spec=slice_spec,
+                threshold=threshold,
+                threshold_hash=threshold.SerializeToString(),
+                matcher=matcher,
+                bounds=_threshold_bounds(threshold)))
+      self.indexed_thresholds[metric_key] = indexed_thresholds
 
 
 # TODO(b/142683826): Beam type check error in
@@ -35,29 +111,38 @@ _ThresholdType = Union[config_pb2.GenericValueThreshold,
 # around metric_types.MetricKey below when fixed.
 def validate_metrics(
     sliced_metrics: Tuple[Union[slicer.SliceKeyType, slicer.CrossSliceKeyType],
-                          Dict['metric_types.MetricKey',
-                               Any]], eval_config: config_pb2.EvalConfig
+                          Dict['metric_types.MetricKey', Any]],
+    eval_config: config_pb2.EvalConfig,
+    threshold_index: Optional[ThresholdIndex] = None
 ) -> validation_result_pb2.ValidationResult:
-  """Check the metrics and check whether they should be validated."""
-  # Find out which model is baseline.
-  baseline_spec = model_util.get_baseline_model_spec(eval_config)
-  baseline_model_name = baseline_spec.name if baseline_spec else None
+  """Check the metrics and check whether they should be validated.
+
+  Args:
+    sliced_metrics: Slice key (or cross slice key) and metrics for the slice.
+    eval_config: Eval config.
+    threshold_index: Optional index of the thresholds in the eval_config. When
+      validating many slices, the index should be created once and passed to
+      each call.
+
+  Returns:
+    Validation result for the slice.
+  """
+  if threshold_index is None:
+    threshold_index = ThresholdIndex(eval_config)
+  baseline_model_name = threshold_index.baseline_model_name
+  thresholds = threshold_index.indexed_thresholds
 
   sliced_key, metrics = sliced_metrics
-  thresholds = metric_specs.metric_thresholds_from_metrics_specs(
-      eval_config.metrics_specs, eval_config=eval_config)
   is_cross_slice = slicer.is_cross_slice_key(sliced_key)
 
-  def _check_threshold(key: metric_types.MetricKey, threshold: _ThresholdType,
+  def _check_threshold(key: metric_types.MetricKey,
+                       indexed_threshold: _IndexedThreshold,
                        metric: Any) -> bool:
     """Verify a metric given its metric key and metric value."""
     metric = float(metric)
+    threshold = indexed_threshold.threshold
     if isinstance(threshold, config_pb2.GenericValueThreshold):
-      lower_bound, upper_bound = -np.inf, np.inf
-      if threshold.HasField('lower_bound'):
-        lower_bound = threshold.lower_bound.value
-      if threshold.HasField('upper_bound'):
-        upper_bound = threshold.upper_bound.value
+      lower_bound, upper_bound = indexed_threshold.bounds
       return metric >= lower_bound and metric <= upper_bound
     elif isinstance(threshold, config_pb2.GenericChangeThreshold):
       diff = metric
@@ -67,20 +152,13 @@ def validate_metrics(
         ratio = float('nan')
       else:
         ratio = diff / metric_baseline
-      if threshold.direction == config_pb2.MetricDirection.LOWER_IS_BETTER:
-        absolute, relative = np.inf, np.inf
-      elif threshold.direction == config_pb2.MetricDirection.HIGHER_IS_BETTER:
-        absolute, relative = -np.inf, -np.inf
-      else:
+      if indexed_threshold.bounds is None:
         raise ValueError(
             '"UNKNOWN" direction for change threshold: {}.'.format(threshold))
-      if threshold.HasField('absolute'):
-        absolute = threshold.absolute.value
-      if threshold.HasField('relative'):
-        relative = threshold.relative.value
-      if threshold.direction == config_pb2.MetricDirection.LOWER_IS_BETTER:
+      direction, absolute, relative = indexed_threshold.bounds
+      if direction == config_pb2.MetricDirection.LOWER_IS_BETTER:
         return diff <= absolute and ratio <= relative
-      elif threshold.direction == config_pb2.MetricDirection.HIGHER_IS_BETTER:
+      elif direction == config_pb2.MetricDirection.HIGHER_IS_BETTER:
         return diff >= absolute and ratio >= relative
     else:
       raise ValueError('Unknown threshold: {}'.format(threshold))
@@ -117,20 +195,22 @@ def validate_metrics(
       continue
     msg = ''
     existing_failures = set()
-    for slice_spec, threshold in thresholds[metric_key]:
+    for indexed_threshold in thresholds[metric_key]:
+      slice_spec = indexed_threshold.slice_spec
+      threshold = indexed_threshold.threshold
       if slice_spec is not None:
         if (isinstance(slice_spec, config_pb2.SlicingSpec) and
-            (is_cross_slice or not slicer.SingleSliceSpec(
-                spec=slice_spec).is_slice_applicable(sliced_key))):
+            (is_cross_slice or
+             not indexed_threshold.matcher.matches(sliced_key))):
           continue
         if (isinstance(slice_spec, config_pb2.CrossSlicingSpec) and
-            (not is_cross_slice or not slicer.is_cross_slice_applicable(
-                cross_slice_key=sliced_key, cross_slicing_spec=slice_spec))):
+            (not is_cross_slice or
+             not indexed_threshold.matcher.matches(sliced_key))):
           continue
       elif is_cross_slice:
         continue
       try:
-        check_result = _check_threshold(metric_key, threshold, metric)
+        check_result = _check_threshold(metric_key, indexed_threshold, metric)
       except ValueError:
         msg = """
           Invalid metrics or threshold for comparison: The type of the metric
@@ -142,10 +222,7 @@ def validate_metrics(
       if not check_result:
         # The same threshold values could be set for multiple matching slice
         # specs. Only store the first match.
-        #
-        # Note that hashing by SerializeToString() is only safe if used within
-        # the same process.
-        if not _add_to_set(existing_failures, threshold.SerializeToString()):
+        if not _add_to_set(existing_failures, indexed_threshold.threshold_hash):
           continue
         failure = validation_for_slice.failures.add()
         failure.metric_key.CopyFrom(metric_key.to_proto())
@@ -163,30 +240,28 @@ def validate_metrics(
         slicing_details.slicing_spec.CopyFrom(config_pb2.SlicingSpec())
       slicing_details.num_matching_slices = 1
   # All unchecked thresholds are considered failures.
-  for metric_key, thresholds in unchecked_thresholds.items():
+  for metric_key, indexed_thresholds in unchecked_thresholds.items():
     if metric_key.model_name == baseline_model_name:
       continue
     existing_failures = set()
-    for slice_spec, threshold in thresholds:
+    for indexed_threshold in indexed_thresholds:
+      slice_spec = indexed_threshold.slice_spec
       if slice_spec is not None:
         if is_cross_slice != isinstance(slice_spec,
                                         config_pb2.CrossSlicingSpec):
           continue
-        if (is_cross_slice and not slicer.is_cross_slice_applicable(
-            cross_slice_key=sliced_key, cross_slicing_spec=slice_spec)):
+        if (is_cross_slice and
+            not indexed_threshold.matcher.matches(sliced_key)):
           continue
       elif is_cross_slice:
         continue
       # The same threshold values could be set for multiple matching slice
       # specs. Only store the first match.
-      #
-      # Note that hashing by SerializeToString() is only safe if used within
-      # the same process.
-      if not _add_to_set(existing_failures, threshold.SerializeToString()):
+      if not _add_to_set(existing_failures, indexed_threshold.threshold_hash):
         continue
       failure = validation_for_slice.failures.add()
       failure.metric_key.CopyFrom(metric_key.to_proto())
-      _copy_threshold(threshold, failure.metric_threshold)
+      _copy_threshold(indexed_threshold.threshold, failure.metric_threshold)
       failure.message = 'Metric not found.'
   # Any failure leads to overall failure.
   if validation_for_slice.failures:
@@ -234,24 +309,25 @@ def merge_details(a: validation_result_pb2.ValidationResult,
 
 def get_missing_slices(
     slicing_details: Iterable[validation_result_pb2.SlicingDetails],
-    eval_config: config_pb2.EvalConfig
+    eval_config: config_pb2.EvalConfig,
+    threshold_index: Optional[ThresholdIndex] = None
 ) -> List[Union[config_pb2.SlicingSpec, config_pb2.CrossSlicingSpec]]:
   """Returns specs that are defined in the EvalConfig but not found in details.
 
   Args:
     slicing_details: Slicing details.
     eval_config: Eval config.
+    threshold_index: Optional index of the thresholds in the eval_config.
 
   Returns:
     List of missing slices or empty list if none are missing.
   """
+  if threshold_index is None:
+    threshold_index = ThresholdIndex(eval_config)
   hashed_details = _hashed_slicing_details(slicing_details)
-  thresholds = metric_specs.metric_thresholds_from_metrics_specs(
-      eval_config.metrics_specs, eval_config=eval_config)
-  baseline_spec = model_util.get_baseline_model_spec(eval_config)
-  baseline_model_name = baseline_spec.name if baseline_spec else None
+  baseline_model_name = threshold_index.baseline_model_name
   missing_slices = []
-  for metric_key, sliced_thresholds in thresholds.items():
+  for metric_key, sliced_thresholds in threshold_index.thresholds.items():
     # Skip baseline.
     if metric_key.model_name == baseline_model_name:
       continue
@@ -1015,6 +1015,61 @@ class MetricsValidatorTest(testutil.TensorflowModelAnalysisTest,
     self.assertProtoEquals(missing[0], slicing_specs[0])
     self.assertProtoEquals(missing[1], slicing_specs[2])
 
+  def testValidateMetricsWithThresholdIndex(self):
+    slicing_specs = [
+        config_pb2.SlicingSpec(feature_values={'feature1': 'value1'}),
+        config_pb2.SlicingSpec(feature_keys=['feature2'])
+    ]
+    eval_config = config_pb2.EvalConfig(
+        model_specs=[
+            config_pb2.ModelSpec(),
+        ],
+        slicing_specs=slicing_specs,
+        metrics_specs=[
+            config_pb2.MetricsSpec(
+                metrics=[
+                    config_pb2.MetricConfig(
+                        class_name='WeightedExampleCount',
+                        per_slice_thresholds=[
+                            config_pb2.PerSliceMetricThreshold(
+                                slicing_specs=slicing_specs,
+                                threshold=config_pb2.MetricThreshold(
+                                    value_threshold=config_pb2
+                                    .GenericValueThreshold(
+                                        upper_bound={'value': 1})))
+                        ]),
+                ],
+                model_names=[''],
+                example_weights=config_pb2.ExampleWeightOptions(weighted=True)),
+        ],
+    )
+    threshold_index = metrics_validator.ThresholdIndex(eval_config)
+    metric_key = metric_types.MetricKey(
+        name='weighted_example_count', example_weighted=True)
+    for slice_key, value, expected_ok in (
+        ((('feature1', 'value1'),), 0.5, True),
+        ((('feature1', 'value1'),), 1.5, False),
+        ((('feature2', 'value2'),), 1.5, False),
+        # Thresholds for unmatched slices are ignored.
+        ((('feature1', 'value2'),), 1.5, True),
+    ):
+      sliced_metrics = (slice_key, {metric_key: value})
+      result = metrics_validator.validate_metrics(sliced_metrics, eval_config,
+                                                  threshold_index)
+      self.assertEqual(expected_ok, result.validation_ok)
+      self.assertProtoEquals(
+          metrics_validator.validate_metrics(sliced_metrics, eval_config),
+          result)
+
+    result = metrics_validator.validate_metrics(
+        ((('feature1', 'value1'),), {metric_key: 0.5}), eval_config,
+        threshold_index)
+    missing = metrics_validator.get_missing_slices(
+        result.validation_details.slicing_details, eval_config,
+        threshold_index)
+    self.assertLen(missing, 1)
+    self.assertProtoEquals(missing[0], slicing_specs[1])
+
   @parameterized.named_parameters(_NO_SLICE_TEST, _SINGLE_CROSS_SLICE_TEST,
                                   _CROSS_SLICE_GLOBAL_TEST,
                                   _MULTIPLE_CROSS_SLICE_TEST,
@@ -13,7 +13,7 @@
 # limitations under the License.
 """Utils for performing poisson bootstrapping."""
 
-from typing import Any, Optional, Set, Tuple, TypeVar
+from typing import Any, Iterable, List, Optional, Set, Tuple, TypeVar, Union
 
 import apache_beam as beam
 import numpy as np
@@ -50,6 +50,71 @@ class _BootstrapCombineFn(beam_util.DelegatingCombineFn):
     return accumulator
 
 
+class _MultiSampleBootstrapCombineFn(beam_util.DelegatingCombineFn):
+  """CombineFn wrapper which computes all bootstrap samples in a single pass.
+
+  The accumulator is a list containing one accumulator of the wrapped combine_fn
+  per bootstrap sample followed by an accumulator for the unsampled data. The
+  poisson weights for all of the samples are drawn at once for each batch of
+  input elements and the elements and weights for a given sample are passed to
+  the wrapped combine_fn together (see beam_util.add_weighted_inputs). This
+  allows combiners that support weighted inputs (e.g. histograms) to apply the
+  weights directly rather than processing repeated copies of the elements.
+  """
+
+  def __init__(self,
+               combine_fn: beam.CombineFn,
+               num_bootstrap_samples: int,
+               random_seed: Optional[int] = None):
+    super().__init__(combine_fn)
+    self._num_bootstrap_samples = num_bootstrap_samples
+    self._random_seed = random_seed
+
+  def setup(self):
+    super().setup()
+    self._random_state = np.random.RandomState(self._random_seed)
+
+  def create_accumulator(self) -> List[_AccumulatorType]:
+    return [
+        self._combine_fn.create_accumulator()
+        for _ in range(self._num_bootstrap_samples + 1)
+    ]
+
+  def add_input(self, accumulator: List[_AccumulatorType],
+                element: Any) -> List[_AccumulatorType]:
+    return self.add_inputs(accumulator, [element])
+
+  def add_inputs(self, accumulator: List[_AccumulatorType],
+                 elements: Iterable[Any]) -> List[_AccumulatorType]:
+    elements = list(elements)
+    if not elements:
+      return accumulator
+    # Shape: (num_elements, num_bootstrap_samples)
+    weights = self._random_state.poisson(
+        1, (len(elements), self._num_bootstrap_samples))
+    for sample_id in range(self._num_bootstrap_samples):
+      accumulator[sample_id] = beam_util.add_weighted_inputs(
+          self._combine_fn, accumulator[sample_id], elements,
+          weights[:, sample_id].tolist())
+    accumulator[-1] = self._combine_fn.add_inputs(accumulator[-1], elements)
+    return accumulator
+
+  def merge_accumulators(
+      self, accumulators: Iterable[List[_AccumulatorType]]
+  ) -> List[_AccumulatorType]:
+    return [
+        self._combine_fn.merge_accumulators(sample_accumulators)
+        for sample_accumulators in zip(*accumulators)
+    ]
+
+  def compact(
+      self, accumulator: List[_AccumulatorType]) -> List[_AccumulatorType]:
+    return [self._combine_fn.compact(a) for a in accumulator]
+
+  def extract_output(self, accumulator: List[_AccumulatorType]) -> List[Any]:
+    return [self._combine_fn.extract_output(a) for a in accumulator]
+
+
 def _add_sample_id(  # pylint: disable=invalid-name
     slice_key,
     metrics_dict: metric_types.MetricsDict,
@@ -64,7 +129,8 @@ def _ComputeBootstrapSample(  # pylint disable=invalid-name
     sliced_extracts: beam.pvalue.PCollection[Tuple[slicer.SliceKeyType,
                                                    types.Extracts]],
     sample_id: int, computations_combine_fn: beam.CombineFn,
-    derived_metrics_ptransform: beam.PTransform, seed: int, hot_key_fanout: int
+    derived_metrics_ptransform: beam.PTransform, seed: int,
+    hot_key_fanout: Optional[Union[int, beam.pvalue.AsDict]]
 ) -> beam.PCollection[confidence_intervals_util.SampleMetrics]:
   """Computes a single bootstrap sample from SlicedExtracts.
 
@@ -82,10 +148,11 @@ def _ComputeBootstrapSample(  # pylint disable=invalid-name
     seed: The seed to use when doing resampling. Note that this is only useful
       in testing or when using a single worker, as otherwise Beam will introduce
       non-determinism in when using distributed computation.
-    hot_key_fanout: The hot key fanout factor to use when calling
-      beam.CombinePerKey with the computations_combine_fn on replicates. Note
-      that these replicates will in expectation have the same size as the input
-      PCollection of extracts and will use the normal set of slices keys.
+    hot_key_fanout: The hot key fanout factor (or AsDict side input of fanout
+      factors per slice key) to use when calling beam.CombinePerKey with the
+      computations_combine_fn on replicates. Note that these replicates will in
+      expectation have the same size as the input PCollection of extracts and
+      will use the normal set of slices keys.
 
   Returns:
     A PCollection of sliced SampleMetrics objects, containing the metrics dicts
@@ -94,9 +161,9 @@ def _ComputeBootstrapSample(  # pylint disable=invalid-name
   """
   return (
       sliced_extracts
-      | 'CombineSampledMetricsPerSlice' >> beam.CombinePerKey(
-          _BootstrapCombineFn(computations_combine_fn,
-                              seed)).with_hot_key_fanout(hot_key_fanout)
+      | 'CombineSampledMetricsPerSlice' >>
+      beam_util.CombinePerKeyWithHotKeyFanout(  # pylint: disable=no-value-for-parameter
+          _BootstrapCombineFn(computations_combine_fn, seed), hot_key_fanout)
       |
       'AddSampledDerivedCrossSliceAndDiffMetrics' >> derived_metrics_ptransform
       | 'AddSampleIdToValue' >> beam.MapTuple(
@@ -151,9 +218,10 @@ def ComputeWithConfidenceIntervals(  # pylint: disable=invalid-name
     computations_combine_fn: beam.CombineFn,
     derived_metrics_ptransform: beam.PTransform,
     num_bootstrap_samples: int,
-    hot_key_fanout: Optional[int] = None,
+    hot_key_fanout: Optional[Union[int, beam.pvalue.AsDict]] = None,
     skip_ci_metric_keys: Optional[Set[metric_types.MetricKey]] = None,
-    random_seed_for_testing: Optional[int] = None) -> beam.pvalue.PCollection[
+    random_seed_for_testing: Optional[int] = None,
+    single_pass: bool = False) -> beam.pvalue.PCollection[
         Tuple[slicer.SliceKeyOrCrossSliceKeyType, metric_types.MetricsDict]]:
   """PTransform for computing metrics using T-Distribution values.
 
@@ -168,15 +236,20 @@ def ComputeWithConfidenceIntervals(  # pylint: disable=invalid-name
       the output MetricsDict includes additional derived metrics.
     num_bootstrap_samples: The number of bootstrap replicates to use in
       computing the bootstrap standard error.
-    hot_key_fanout: The hot key fanout factor to use when calling
-      beam.CombinePerKey with the computations_combine_fn on replicates. Note
-      that these replicates will in expectation have the same size as the input
-      PCollection of extracts and will use the normal set of slices keys.
+    hot_key_fanout: The hot key fanout factor (or AsDict side input of fanout
+      factors per slice key) to use when calling beam.CombinePerKey with the
+      computations_combine_fn on replicates. Note that these replicates will in
+      expectation have the same size as the input PCollection of extracts and
+      will use the normal set of slices keys.
     skip_ci_metric_keys: Set of metric keys for which to skip confidence
       interval computation. For metric keys in this set, just the unsampled
       value will be returned.
     random_seed_for_testing: Seed to use for unit testing, because
       nondeterministic tests stink. Each partition will use this value + i.
+    single_pass: True to compute the unsampled metrics and all of the bootstrap
+      samples using a single CombinePerKey whose accumulator holds the
+      accumulators for every sample. Otherwise, a separate CombinePerKey is used
+      for each sample.
 
   Returns:
     PCollection of (slice key, dict of metrics)
@@ -185,10 +258,29 @@ def ComputeWithConfidenceIntervals(  # pylint: disable=invalid-name
     raise ValueError('num_bootstrap_samples should be > 0, got %d' %
                      num_bootstrap_samples)
 
+  if single_pass:
+    return (
+        sliced_extracts
+        | 'CombineSampledAndUnsampledMetricsPerSlice' >>
+        beam_util.CombinePerKeyWithHotKeyFanout(  # pylint: disable=no-value-for-parameter
+            _MultiSampleBootstrapCombineFn(computations_combine_fn,
+                                           num_bootstrap_samples,
+                                           random_seed_for_testing),
+            hot_key_fanout)
+        | 'SplitSampleOutputs' >> confidence_intervals_util.SplitSampleOutputs(  # pylint: disable=no-value-for-parameter
+            num_samples=num_bootstrap_samples,
+            full_sample_id=_FULL_SAMPLE_ID,
+            derived_metrics_ptransform=derived_metrics_ptransform)
+        | 'CombineSamplesPerSlice' >> beam.CombinePerKey(
+            _BootstrapSampleCombineFn(
+                num_bootstrap_samples=num_bootstrap_samples,
+                skip_ci_metric_keys=skip_ci_metric_keys)))
+
   unsampled_metrics = (
       sliced_extracts
-      | 'CombineUnsampledMetricsPerSlice' >> beam.CombinePerKey(
-          computations_combine_fn).with_hot_key_fanout(hot_key_fanout)
+      | 'CombineUnsampledMetricsPerSlice' >>
+      beam_util.CombinePerKeyWithHotKeyFanout(  # pylint: disable=no-value-for-parameter
+          computations_combine_fn, hot_key_fanout)
       | 'AddDerivedMetrics' >> derived_metrics_ptransform
       |
       'AddUnsampledSampleId' >> beam.MapTuple(_add_sample_id, _FULL_SAMPLE_ID))
@@ -41,6 +41,67 @@ class PoissonBootstrapTest(absltest.TestCase):
 
       util.assert_that(result, check_result)
 
+  def test_multi_sample_bootstrap_combine_fn(self):
+    with beam.Pipeline() as pipeline:
+      result = (
+          pipeline
+          | 'Create' >> beam.Create(range(5), reshuffle=False)
+          | 'BootstrapCombine' >> beam.CombineGlobally(
+              poisson_bootstrap._MultiSampleBootstrapCombineFn(
+                  combine_fn=beam.combiners.ToListCombineFn(),
+                  num_bootstrap_samples=3,
+                  random_seed=0)))
+
+      def check_result(got_pcoll):
+        self.assertLen(got_pcoll, 1)
+        samples = got_pcoll[0]
+        self.assertLen(samples, 4)
+        for sample in samples[:-1]:
+          self.assertContainsSubset(sample, range(5))
+        # The last output is computed from the unsampled inputs.
+        self.assertEqual(list(range(5)), sorted(samples[-1]))
+
+      util.assert_that(result, check_result)
+
+  def test_compute_with_confidence_intervals_single_pass(self):
+    metric_key = metric_types.MetricKey(name='example_count')
+
+    class _ExampleCountCombineFn(beam.CombineFn):
+
+      def create_accumulator(self):
+        return 0
+
+      def add_input(self, accumulator, element):
+        return accumulator + 1
+
+      def merge_accumulators(self, accumulators):
+        return sum(accumulators)
+
+      def extract_output(self, accumulator):
+        return {metric_key: accumulator}
+
+    with beam.Pipeline() as pipeline:
+      result = (
+          pipeline
+          | 'Create' >> beam.Create([((), i) for i in range(10)])
+          | 'ComputeWithConfidenceIntervals' >>
+          poisson_bootstrap.ComputeWithConfidenceIntervals(  # pylint: disable=no-value-for-parameter
+              computations_combine_fn=_ExampleCountCombineFn(),
+              derived_metrics_ptransform=beam.Map(lambda x: x),
+              num_bootstrap_samples=5,
+              random_seed_for_testing=0,
+              single_pass=True))
+
+      def check_result(got_pcoll):
+        self.assertLen(got_pcoll, 1)
+        slice_key, metrics = got_pcoll[0]
+        self.assertEqual((), slice_key)
+        self.assertIn(metric_key, metrics)
+        self.assertEqual(metrics[metric_key].unsampled_value, 10)
+        self.assertEqual(metrics[metric_key].sample_degrees_of_freedom, 4)
+
+      util.assert_that(result, check_result)
+
   def test_boostrap_sample_combine_fn(self):
     metric_key = metric_types.MetricKey(name='metric')
     samples = [
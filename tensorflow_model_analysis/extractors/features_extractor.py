@@ -14,7 +14,7 @@
 """Features extractor."""
 
 import copy
-from typing import Optional, Tuple
+from typing import Any, Dict, Iterator, MutableMapping, Optional, Set, Tuple
 
 import apache_beam as beam
 import numpy as np
@@ -101,6 +101,102 @@ def _DropUnsupportedColumnsAndFetchRawDataColumn(
                                      column_names), serialized_examples)
 
 
+class _RecordBatchFeatureColumns:
+  """List columns of a RecordBatch that are converted on first access.
+
+  Each column is converted once per batch into its list offsets, flattened
+  values and null mask as numpy arrays (zero-copy where Arrow allows it). Rows
+  are then served as slices (views) of the flattened values.
+  """
+
+  def __init__(self, record_batch: pa.RecordBatch):
+    self._columns = dict(zip(record_batch.schema.names, record_batch.columns))
+    # Dict[str, Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]]
+    self._converted = {}
+
+  def __contains__(self, name: str) -> bool:
+    return name in self._columns
+
+  def __iter__(self) -> Iterator[str]:
+    return iter(self._columns)
+
+  def __len__(self) -> int:
+    return len(self._columns)
+
+  def value(self, name: str, row: int) -> Optional[np.ndarray]:
+    """Returns the value of the named column for the given row."""
+    if name not in self._converted:
+      column = self._columns[name]
+      is_null = None
+      if column.null_count:
+        is_null = column.is_null().to_numpy(zero_copy_only=False)
+      # Note that the offsets of sliced list arrays are relative to the
+      # underlying (unsliced) values.
+      self._converted[name] = (np.asarray(column.offsets),
+                               column.values.to_numpy(zero_copy_only=False),
+                               is_null)
+    offsets, values, is_null = self._converted[name]
+    if is_null is not None and is_null[row]:
+      return None
+    return values[offsets[row]:offsets[row + 1]]
+
+
+class _LazyFeatures(MutableMapping[str, Any]):
+  """Features of a single row backed by the columns of its RecordBatch.
+
+  Values are only materialized (as numpy arrays) for the keys that are accessed
+  so columns that are never read are never converted. Values set on the mapping
+  take precedence over the values in the RecordBatch. When pickled (or copied)
+  the features are materialized into a regular dict.
+  """
+
+  def __init__(self, columns: _RecordBatchFeatureColumns, row: int):
+    self._columns = columns
+    self._row = row
+    self._values: Dict[str, Any] = {}
+    self._deleted: Set[str] = set()
+
+  def __getitem__(self, key: str) -> Any:
+    if key not in self._values:
+      if key in self._deleted or key not in self._columns:
+        raise KeyError(key)
+      self._values[key] = self._columns.value(key, self._row)
+    return self._values[key]
+
+  def __setitem__(self, key: str, value: Any):
+    self._deleted.discard(key)
+    self._values[key] = value
+
+  def __delitem__(self, key: str):
+    if key not in self:
+      raise KeyError(key)
+    self._values.pop(key, None)
+    if key in self._columns:
+      self._deleted.add(key)
+
+  def __contains__(self, key: Any) -> bool:
+    return key in self._values or (key in self._columns and
+                                   key not in self._deleted)
+
+  def __iter__(self) -> Iterator[str]:
+    for key in self._columns:
+      if key not in self._deleted:
+        yield key
+    for key in self._values:
+      if key not in self._columns:
+        yield key
+
+  def __len__(self) -> int:
+    return len(self._columns) - len(self._deleted) + sum(
+        1 for key in self._values if key not in self._columns)
+
+  def __reduce__(self):
+    return (dict, (list(self.items()),))
+
+  def __repr__(self) -> str:
+    return repr(dict(self.items()))
+
+
 @beam.ptransform_fn
 @beam.typehints.with_input_types(types.Extracts)
 @beam.typehints.with_output_types(types.Extracts)
@@ -128,8 +224,10 @@ def _ExtractFeatures(
     if record_batch.num_columns == 0:
       result[constants.FEATURES_KEY] = [dict() for _ in serialized_examples]
     else:
-      dataframe = record_batch.to_pandas()
-      result[constants.FEATURES_KEY] = dataframe.to_dict(orient='records')
+      columns = _RecordBatchFeatureColumns(record_batch)
+      result[constants.FEATURES_KEY] = [
+          _LazyFeatures(columns, i) for i in range(record_batch.num_rows)
+      ]
     # TODO(pachristopher): Consider avoiding setting this key if we don't need
     # this any further in the pipeline. This can avoid a potentially costly copy
     result[constants.INPUT_KEY] = serialized_examples
@@ -13,10 +13,13 @@
 # limitations under the License.
 """Test for features extractor."""
 
+import copy
+
 from absl.testing import parameterized
 import apache_beam as beam
 from apache_beam.testing import util
 import numpy as np
+import pyarrow as pa
 import tensorflow as tf
 from tensorflow_model_analysis import constants
 from tensorflow_model_analysis.api import model_eval_lib
@@ -149,6 +152,38 @@ class FeaturesExtractorTest(testutil.TensorflowModelAnalysisTest,
 
       util.assert_that(result, check_result, label='result')
 
+  def test_lazy_features(self):
+    record_batch = pa.RecordBatch.from_arrays([
+        pa.array([[1, 2], [3], None]),
+        pa.array([[b'a'], [b'b', b'c'], [b'd']]),
+    ], ['int_feature', 'bytes_feature'])
+    columns = features_extractor._RecordBatchFeatureColumns(record_batch)
+    features = [
+        features_extractor._LazyFeatures(columns, i)
+        for i in range(record_batch.num_rows)
+    ]
+
+    self.assertEqual(['int_feature', 'bytes_feature'], list(features[0]))
+    np.testing.assert_array_equal(features[1]['int_feature'], np.array([3]))
+    self.assertIsNone(features[2]['int_feature'])
+    # Columns that are never read are never converted.
+    self.assertEqual(['int_feature'], list(columns._converted))
+    np.testing.assert_array_equal(features[1]['bytes_feature'],
+                                  np.array([b'b', b'c'], dtype=object))
+
+    features[0]['new_feature'] = np.array([1.0])
+    del features[0]['bytes_feature']
+    self.assertEqual(['int_feature', 'new_feature'], list(features[0]))
+    self.assertNotIn('bytes_feature', features[0])
+    with self.assertRaises(KeyError):
+      _ = features[0]['bytes_feature']
+    copied = copy.deepcopy(features[0])
+    self.assertIsInstance(copied, dict)
+    self.assertDictElementsAlmostEqual(copied, {
+        'int_feature': np.array([1, 2]),
+        'new_feature': np.array([1.0]),
+    })
+
 
 if __name__ == '__main__':
   tf.test.main()
@@ -14,6 +14,7 @@
 """Batched predict extractor."""
 
 import copy
+import os
 
 from typing import Dict, Optional
 
@@ -23,6 +24,7 @@ from tensorflow_model_analysis import types
 from tensorflow_model_analysis.extractors import extractor
 from tensorflow_model_analysis.proto import config_pb2
 from tensorflow_model_analysis.utils import model_util
+from tensorflow_model_analysis.utils import prediction_cache
 from tfx_bsl.tfxio import tensor_adapter
 
 _PREDICTIONS_EXTRACTOR_STAGE_NAME = 'ExtractPredictions'
@@ -32,6 +34,7 @@ def PredictionsExtractor(
     eval_config: config_pb2.EvalConfig,
     eval_shared_model: Optional[types.MaybeMultipleEvalSharedModels] = None,
     tensor_adapter_config: Optional[tensor_adapter.TensorAdapterConfig] = None,
+    prediction_cache_dir: Optional[str] = None,
 ) -> extractor.Extractor:
   """Creates an extractor for performing predictions over a batch.
 
@@ -68,9 +71,16 @@ def PredictionsExtractor(
       create an adapter based on the model's input signature otherwise the model
       will be invoked with raw examples (assuming a  signature of a single 1-D
       string tensor).
+    prediction_cache_dir: Optional directory (e.g. a directory next to the
+      output path) used to persist the predictions computed for each example.
+      Later runs using the same models and data will read the predictions from
+      this directory instead of running inference.
 
   Returns:
     Extractor for extracting predictions.
+
+  Raises:
+    ValueError: If prediction_cache_dir is used with models without a path.
   """
   eval_shared_models = model_util.verify_and_update_eval_shared_models(
       eval_shared_model)
@@ -83,7 +93,8 @@ def PredictionsExtractor(
       ptransform=_ExtractPredictions(
           eval_config=eval_config,
           eval_shared_models=eval_shared_models,
-          tensor_adapter_config=tensor_adapter_config))
+          tensor_adapter_config=tensor_adapter_config,
+          prediction_cache_dir=prediction_cache_dir))
 
 
 @beam.ptransform_fn
@@ -94,6 +105,7 @@ def _ExtractPredictions(  # pylint: disable=invalid-name
     eval_config: config_pb2.EvalConfig,
     eval_shared_models: Optional[Dict[str, types.EvalSharedModel]],
     tensor_adapter_config: Optional[tensor_adapter.TensorAdapterConfig] = None,
+    prediction_cache_dir: Optional[str] = None,
 ) -> beam.pvalue.PCollection:
   """A PTransform that adds predictions and possibly other tensors to extracts.
 
@@ -105,9 +117,13 @@ def _ExtractPredictions(  # pylint: disable=invalid-name
     eval_shared_models: Shared model parameters keyed by model name or None.
     tensor_adapter_config: Tensor adapter config which specifies how to obtain
       tensors from the Arrow RecordBatch.
+    prediction_cache_dir: Optional directory used to persist predictions.
 
   Returns:
     PCollection of Extracts updated with the predictions.
+
+  Raises:
+    ValueError: If prediction_cache_dir is used with models without a path.
   """
 
   if eval_shared_models:
@@ -116,15 +132,36 @@ def _ExtractPredictions(  # pylint: disable=invalid-name
       model_name = '' if len(eval_config.model_specs) == 1 else spec.name
       signature_names[model_name] = [spec.signature_name]
 
-    return (
-        extracts
-        | 'Predict' >> beam.ParDo(
-            model_util.ModelSignaturesDoFn(
-                eval_config=eval_config,
-                eval_shared_models=eval_shared_models,
-                signature_names={constants.PREDICTIONS_KEY: signature_names},
-                prefer_dict_outputs=False,
-                tensor_adapter_config=tensor_adapter_config)))
+    predict = beam.ParDo(
+        model_util.ModelSignaturesDoFn(
+            eval_config=eval_config,
+            eval_shared_models=eval_shared_models,
+            signature_names={constants.PREDICTIONS_KEY: signature_names},
+            prefer_dict_outputs=False,
+            tensor_adapter_config=tensor_adapter_config))
+    if not prediction_cache_dir:
+      return extracts | 'Predict' >> predict
+
+    model_paths = {k: v.model_path for k, v in eval_shared_models.items()}
+    if not all(model_paths.values()):
+      raise ValueError('prediction_cache_dir requires the paths of all models: '
+                       f'model_paths={model_paths}')
+    settings = {
+        'signature_names': signature_names,
+        'tensor_representations': {
+            k: str(v) for k, v in (
+                tensor_adapter_config.tensor_representations.items()
+                if tensor_adapter_config is not None else [])
+        },
+    }
+    cache_dir = os.path.join(
+        prediction_cache_dir,
+        prediction_cache.cache_fingerprint(model_paths, settings))
+    return (extracts
+            | 'PredictWithCache' >> prediction_cache.ComputeWithCache(
+                compute=predict,
+                cache_dir=cache_dir,
+                extracts_keys=[constants.PREDICTIONS_KEY]))
   else:
 
     def extract_predictions(  # pylint: disable=invalid-name
@@ -15,7 +15,7 @@
 
 import copy
 
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 import apache_beam as beam
 
@@ -42,6 +42,9 @@ def SliceKeyExtractor(
   additional extract pointing at the list of SliceKeyType values keyed by
   tfma.SLICE_KEY_TYPES_KEY. If materialize is True then a materialized version
   of the slice keys will be added under the key tfma.MATERIALZED_SLICE_KEYS_KEY.
+  If the incoming Extracts are batched (i.e. they contain an Arrow RecordBatch
+  under tfma.ARROW_RECORD_BATCH_KEY), then a list of slice keys will be stored
+  for each example in the batch.
 
   Args:
     slice_spec: Deprecated (use EvalConfig).
@@ -87,13 +90,18 @@ class ExtractSliceKeysFn(beam.DoFn):
     self._duplicate_slice_keys_counter = beam.metrics.Metrics.counter(
         constants.METRICS_NAMESPACE, 'num_examples_with_duplicate_slice_keys')
 
-  def process(self, element: types.Extracts,
-              slice_spec: List[slicer.SingleSliceSpec]) -> List[types.Extracts]:
+  def _get_slice_keys(
+      self,
+      features: types.DictOfTensorValueMaybeDict,
+      transformed_features: Optional[types.DictOfTensorValueMaybeDict],
+      existing_slice_keys: Optional[List[slicer.SliceKeyType]],
+      slice_spec: List[slicer.SingleSliceSpec],
+      batched_slice_keys: Optional[List[slicer.SliceKeyType]] = None
+  ) -> List[slicer.SliceKeyType]:
+    """Returns the unique slice keys for a single example."""
     # Slice on transformed features if available.
     features_dicts = []
-    if (constants.TRANSFORMED_FEATURES_KEY in element and
-        element[constants.TRANSFORMED_FEATURES_KEY] is not None):
-      transformed_features = element[constants.TRANSFORMED_FEATURES_KEY]
+    if transformed_features is not None:
       # If only one model, the output is stored without keying on model name.
       if not self._eval_config or len(self._eval_config.model_specs) == 1:
         features_dicts.append(transformed_features)
@@ -102,37 +110,90 @@ class ExtractSliceKeysFn(beam.DoFn):
         features_dicts.extend(transformed_features[spec.name]
                               for spec in self._eval_config.model_specs
                               if spec.name in transformed_features)
+    # Slice keys already generated for the example from its record batch.
+    slice_keys = list(batched_slice_keys) if batched_slice_keys else []
     # Search for slices first in transformed features (if any). If a match is
     # not found there then search in raw features.
-    slice_keys = list(
-        slicer.get_slices_for_features_dicts(
-            features_dicts, util.get_features_from_extracts(element),
-            slice_spec))
+    if slice_spec:
+      slice_keys.extend(
+          slicer.get_slices_for_features_dicts(features_dicts, features,
+                                               slice_spec))
 
     # If SLICE_KEY_TYPES_KEY already exists, that means the
     # SqlSliceKeyExtractor has generated some slice keys. We need to add
     # them to current slice_keys list.
-    if (constants.SLICE_KEY_TYPES_KEY in element and
-        element[constants.SLICE_KEY_TYPES_KEY]):
-      slice_keys.extend(element[constants.SLICE_KEY_TYPES_KEY])
+    if existing_slice_keys:
+      slice_keys.extend(existing_slice_keys)
 
     unique_slice_keys = list(set(slice_keys))
     if len(slice_keys) != len(unique_slice_keys):
       self._duplicate_slice_keys_counter.inc()
+    return unique_slice_keys
+
+  def _materialize_slice_keys(
+      self,
+      slice_keys: List[slicer.SliceKeyType],
+      stringified_slice_keys: Optional[Dict[slicer.SliceKeyType, bytes]] = None
+  ) -> types.MaterializedColumn:
+    if stringified_slice_keys is None:
+      stringified_slice_keys = {}
+    value = []
+    for slice_key in slice_keys:
+      if slice_key not in stringified_slice_keys:
+        stringified_slice_keys[slice_key] = slicer.stringify_slice_key(
+            slice_key).encode('utf-8')
+      value.append(stringified_slice_keys[slice_key])
+    return types.MaterializedColumn(name=constants.SLICE_KEYS_KEY, value=value)
+
+  def process(self, element: types.Extracts,
+              slice_spec: List[slicer.SingleSliceSpec]) -> List[types.Extracts]:
+    transformed_features = element.get(constants.TRANSFORMED_FEATURES_KEY)
+    existing_slice_keys = element.get(constants.SLICE_KEY_TYPES_KEY)
 
     # Make a a shallow copy, so we don't mutate the original.
     element_copy = copy.copy(element)
 
+    if constants.ARROW_RECORD_BATCH_KEY in element:
+      # Batched extracts store a list of values (one per example) under each
+      # key, so the slice keys are also stored as a list of lists.
+      record_batch = element[constants.ARROW_RECORD_BATCH_KEY]
+      batch_size = record_batch.num_rows
+      features = element.get(constants.FEATURES_KEY) or [{}] * batch_size
+      batched_slice_keys = None
+      row_slice_spec = slice_spec
+      # The features are served from the record batch, so unless transformed
+      # features (which take precedence) are present, slices for specs on the
+      # record batch's columns are generated for the whole batch at once.
+      if not transformed_features and constants.FEATURES_KEY in element:
+        batched_slice_keys, row_slice_spec = (
+            slicer.get_slices_for_record_batch(record_batch, slice_spec))
+      slice_keys = [
+          self._get_slice_keys(
+              features[i],
+              transformed_features[i] if transformed_features else None,
+              existing_slice_keys[i] if existing_slice_keys else None,
+              row_slice_spec,
+              batched_slice_keys[i] if batched_slice_keys else None)
+          for i in range(batch_size)
+      ]
+      element_copy[constants.SLICE_KEY_TYPES_KEY] = slice_keys
+      if self._materialize:
+        # Slice keys are shared by many examples, so each is stringified once.
+        stringified_slice_keys = {}
+        element_copy[constants.SLICE_KEYS_KEY] = [
+            self._materialize_slice_keys(x, stringified_slice_keys)
+            for x in slice_keys
+        ]
+      return [element_copy]
+
+    unique_slice_keys = self._get_slice_keys(
+        util.get_features_from_extracts(element), transformed_features,
+        existing_slice_keys, slice_spec)
     element_copy[constants.SLICE_KEY_TYPES_KEY] = unique_slice_keys
     # Add a list of stringified slice keys to be materialized to output table.
     if self._materialize:
-      element_copy[constants.SLICE_KEYS_KEY] = types.MaterializedColumn(
-          name=constants.SLICE_KEYS_KEY,
-          value=[
-              slicer.stringify_slice_key(x).encode('utf-8')
-              for x in unique_slice_keys
-          ],
-      )
+      element_copy[constants.SLICE_KEYS_KEY] = self._materialize_slice_keys(
+          unique_slice_keys)
     return [element_copy]
 
 
@@ -17,6 +17,7 @@ from absl.testing import parameterized
 import apache_beam as beam
 from apache_beam.testing import util
 import numpy as np
+import pyarrow as pa
 import tensorflow as tf
 from tensorflow_model_analysis import constants
 from tensorflow_model_analysis import types
@@ -228,6 +229,47 @@ class SliceTest(testutil.TensorflowModelAnalysisTest, parameterized.TestCase):
 
       util.assert_that(slice_keys_extracts, check_result)
 
+  def testBatchedSliceKeys(self):
+    batched_extracts = {
+        constants.ARROW_RECORD_BATCH_KEY:
+            pa.RecordBatch.from_arrays(
+                [pa.array([['m'], ['f']], type=pa.list_(pa.binary()))],
+                ['gender']),
+        constants.FEATURES_KEY: [{
+            'gender': np.array([b'm'])
+        }, {
+            'gender': np.array([b'f'])
+        }],
+    }
+    with beam.Pipeline() as pipeline:
+      slice_keys_extracts = (
+          pipeline
+          | 'CreateTestInput' >> beam.Create([batched_extracts])
+          | 'ExtractSlices' >> slice_key_extractor.ExtractSliceKeys(
+              [
+                  slicer.SingleSliceSpec(),
+                  slicer.SingleSliceSpec(columns=['gender'])
+              ],
+              materialize=True))
+
+      def check_result(got):
+        try:
+          self.assertLen(got, 1)
+          slice_keys = got[0][constants.SLICE_KEY_TYPES_KEY]
+          self.assertLen(slice_keys, 2)
+          self.assertCountEqual(slice_keys[0], [(), (('gender', 'm'),)])
+          self.assertCountEqual(slice_keys[1], [(), (('gender', 'f'),)])
+          materialized_slice_keys = got[0][constants.SLICE_KEYS_KEY]
+          self.assertLen(materialized_slice_keys, 2)
+          self.assertCountEqual(materialized_slice_keys[0].value,
+                                [b'Overall', b'gender:m'])
+          self.assertCountEqual(materialized_slice_keys[1].value,
+                                [b'Overall', b'gender:f'])
+        except AssertionError as err:
+          raise util.BeamAssertException(err)
+
+      util.assert_that(slice_keys_extracts, check_result)
+
   def testLegacySliceKeys(self):
     with beam.Pipeline() as pipeline:
       fpls = create_fpls()
@@ -17,12 +17,11 @@ import collections
 import copy
 import json
 import os
+import shutil
 import subprocess
 import tempfile
 from typing import Dict, Union, Sequence
 
-import uuid
-
 import apache_beam as beam
 import numpy as np
 import tensorflow as tf
@@ -44,28 +43,38 @@ _DATA_JSON = 'data.json'
 _DTYPE_JSON = 'dtype.json'
 _SHAPE_JSON = 'shape.json'
 _TF_INPUT_NAME_JSON = 'tf_input_name.json'
+_OUTPUT_JSONS = (_DATA_JSON, _DTYPE_JSON, _SHAPE_JSON)
 
 
 # TODO(b/149981535) Determine if we should merge with RunInference.
 @beam.typehints.with_input_types(types.Extracts)
 @beam.typehints.with_output_types(types.Extracts)
 class _TFJSPredictionDoFn(model_util.BatchReducibleBatchedDoFnWithModels):
-  """A DoFn that loads tfjs models and predicts."""
+  """A DoFn that loads tfjs models and predicts.
+
+  The models are copied to a local working directory once in setup (along with
+  fixed input and output directories for each model that are reused by every
+  batch) and the working directory is removed in teardown.
+  """
 
   def __init__(self, eval_config: config_pb2.EvalConfig,
                eval_shared_models: Dict[str, types.EvalSharedModel]) -> None:
-    super().__init__({k: v.model_loader for k, v in eval_shared_models.items()})
+    super().__init__(
+        {k: v.model_loader for k, v in eval_shared_models.items()},
+        adaptive_batch_size=(
+            eval_config.options.adaptive_inference_batch_size.value))
     self._eval_config = eval_config
     self._src_model_paths = {
         k: v.model_path for k, v in eval_shared_models.items()
     }
+    self._base_path = None
 
   def setup(self):
     super().setup()
     self._binary_path = get_tfjs_binary()
 
-    base_path = tempfile.mkdtemp()
-    base_model_path = os.path.join(base_path, _MODELS_SUBDIR)
+    self._base_path = tempfile.mkdtemp()
+    base_model_path = os.path.join(self._base_path, _MODELS_SUBDIR)
 
     self._model_properties = {}
     for model_name, model_path in self._src_model_paths.items():
@@ -84,10 +93,16 @@ class _TFJSPredictionDoFn(model_util.BatchReducibleBatchedDoFnWithModels):
             for k, v in model_signature['outputs'].items()
         }
       cur_model_path = os.path.join(base_model_path, model_name)
+      inputs_dir = os.path.join(self._base_path, _EXAMPLES_SUBDIR, model_name)
+      outputs_dir = os.path.join(self._base_path, _OUTPUTS_SUBDIR, model_name)
+      os.makedirs(inputs_dir)
+      os.makedirs(outputs_dir)
       self._model_properties[model_name] = {
           'inputs': model_inputs,
           'outputs': model_outputs,
-          'path': cur_model_path
+          'path': cur_model_path,
+          'inputs_dir': inputs_dir,
+          'outputs_dir': outputs_dir,
       }
 
       # We copy models to local tmp storage so that the tfjs binary can
@@ -147,60 +162,18 @@ class _TFJSPredictionDoFn(model_util.BatchReducibleBatchedDoFnWithModels):
         batched_entries[_SHAPE_JSON].append(value.shape)
         batched_entries[_TF_INPUT_NAME_JSON].append(feature)
 
-      cur_subdir = str(uuid.uuid4())
-      cur_input_path = os.path.join(self._model_properties[model_name]['path'],
-                                    _EXAMPLES_SUBDIR, cur_subdir)
-      tf.io.gfile.makedirs(cur_input_path)
-      for entry, value in batched_entries.items():
-        with tf.io.gfile.GFile(os.path.join(cur_input_path, entry), 'w') as f:
-          f.write(json.dumps(value))
-
-      cur_output_path = os.path.join(self._model_properties[model_name]['path'],
-                                     _OUTPUTS_SUBDIR, cur_subdir)
-      tf.io.gfile.makedirs(cur_output_path)
-      inference_command = [
-          self._binary_path,
-          '--model_path=' + os.path.join(
-              self._model_properties[model_name]['path'], _MODEL_JSON),
-          f'--inputs_dir={cur_input_path}',
-          f'--outputs_dir={cur_output_path}',
-      ]
-
-      popen = subprocess.Popen(
-          inference_command,
-          stdin=subprocess.PIPE,
-          stdout=subprocess.PIPE,
-          stderr=subprocess.PIPE)
-      stdout, stderr = popen.communicate()
-      if popen.returncode != 0:
-        raise ValueError(
-            'Inference failed with status {}\nstdout:\n{}\nstderr:\n{}'.format(
-                popen.returncode, stdout, stderr))
-
-      try:
-        with tf.io.gfile.GFile(os.path.join(cur_output_path, _DATA_JSON)) as f:
-          data = json.load(f)
-        with tf.io.gfile.GFile(os.path.join(cur_output_path, _DTYPE_JSON)) as f:
-          dtype = json.load(f)
-        with tf.io.gfile.GFile(os.path.join(cur_output_path, _SHAPE_JSON)) as f:
-          shape = json.load(f)
-      except FileNotFoundError as e:
-        raise FileNotFoundError(
-            'Unable to find files containing inference result. This likely '
-            'means that inference did not succeed. Error {}'.format(e))
+      data, dtype, shape = self._run_inference(model_name, batched_entries)
 
       name = [
           n.split(':')[0]
           for n in self._model_properties[model_name]['outputs'].keys()
       ]
 
-      tf.io.gfile.rmtree(cur_input_path)
-      tf.io.gfile.rmtree(cur_output_path)
-
       outputs = {}
       for n, s, t, d in zip(name, shape, dtype, data):
-        d_val = [d[str(i)] for i in range(len(d))]
-        outputs[n] = np.reshape(np.array(d_val, t), s)
+        # Outputs are serialized as objects keyed by the (flat) index.
+        d_val = np.fromiter((d[str(i)] for i in range(len(d))), t, len(d))
+        outputs[n] = np.reshape(d_val, s)
 
       for v in outputs.values():
         if len(v) != len(feature_rows):
@@ -220,6 +193,65 @@ class _TFJSPredictionDoFn(model_util.BatchReducibleBatchedDoFnWithModels):
           result[constants.PREDICTIONS_KEY][i].update({spec.name: output})
     return [result]
 
+  def _run_inference(self, model_name: str, batched_entries: Dict[str, list]):
+    """Runs the tfjs binary on the entries and returns the data/dtypes/shapes.
+
+    Args:
+      model_name: Name of the model to run.
+      batched_entries: Input entries keyed by the name of the file they are
+        read from by the tfjs binary.
+
+    Returns:
+      Tuple of the output data, dtypes and shapes.
+    """
+    properties = self._model_properties[model_name]
+    inputs_dir = properties['inputs_dir']
+    outputs_dir = properties['outputs_dir']
+    # The input and output directories are local and reused by every batch, so
+    # outputs from previous batches are removed to avoid reading stale results.
+    for entry in _OUTPUT_JSONS:
+      path = os.path.join(outputs_dir, entry)
+      if os.path.exists(path):
+        os.remove(path)
+    for entry, value in batched_entries.items():
+      with open(os.path.join(inputs_dir, entry), 'w') as f:
+        json.dump(value, f, separators=(',', ':'))
+
+    inference_command = [
+        self._binary_path,
+        '--model_path=' + os.path.join(properties['path'], _MODEL_JSON),
+        f'--inputs_dir={inputs_dir}',
+        f'--outputs_dir={outputs_dir}',
+    ]
+
+    popen = subprocess.Popen(
+        inference_command,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    stdout, stderr = popen.communicate()
+    if popen.returncode != 0:
+      raise ValueError(
+          'Inference failed with status {}\nstdout:\n{}\nstderr:\n{}'.format(
+              popen.returncode, stdout, stderr))
+
+    try:
+      results = []
+      for entry in _OUTPUT_JSONS:
+        with open(os.path.join(outputs_dir, entry)) as f:
+          results.append(json.load(f))
+    except FileNotFoundError as e:
+      raise FileNotFoundError(
+          'Unable to find files containing inference result. This likely '
+          'means that inference did not succeed. Error {}'.format(e))
+    return tuple(results)
+
+  def teardown(self):
+    if self._base_path is not None:
+      shutil.rmtree(self._base_path, ignore_errors=True)
+      self._base_path = None
+    super().teardown()
+
 
 @beam.ptransform_fn
 @beam.typehints.with_input_types(types.Extracts)
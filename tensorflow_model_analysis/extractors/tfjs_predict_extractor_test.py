@@ -13,11 +13,17 @@
 # limitations under the License.
 """Tests for tfjs predict extractor."""
 
+import json
+import os
+import stat
+import sys
 import tempfile
+from unittest import mock
 
 from absl.testing import parameterized
 import apache_beam as beam
 from apache_beam.testing import util
+import numpy as np
 import tensorflow as tf
 from tensorflow_model_analysis import constants
 from tensorflow_model_analysis.api import model_eval_lib
@@ -36,6 +42,30 @@ try:
 except ModuleNotFoundError:
   _TFJS_IMPORTED = False
 
+# Stand-in for the tfjs binary that doubles the values of the single input.
+_FAKE_TFJS_BINARY = """#!{python}
+import json
+import os
+import sys
+
+args = dict(arg[2:].split('=', 1) for arg in sys.argv[1:])
+with open(os.path.join(args['inputs_dir'], 'data.json')) as f:
+  [data] = json.load(f)
+values = [2 * v for row in data for v in row]
+outputs = {{
+    'data.json': [{{str(i): v for i, v in enumerate(values)}}],
+    'dtype.json': ['float32'],
+    'shape.json': [[len(data), len(data[0])]],
+}}
+for name, value in outputs.items():
+  with open(os.path.join(args['outputs_dir'], name), 'w') as f:
+    json.dump(value, f)
+"""
+
+# Stand-in for a tfjs binary that succeeds without writing any outputs.
+_NO_OUTPUTS_TFJS_BINARY = """#!{python}
+"""
+
 
 class TFJSPredictExtractorTest(testutil.TensorflowModelAnalysisTest,
                                parameterized.TestCase):
@@ -175,6 +205,89 @@ class TFJSPredictExtractorTest(testutil.TensorflowModelAnalysisTest,
 
       util.assert_that(result, check_result, label='result')
 
+  def _create_fake_tfjs_model(self):
+    model_path = tempfile.mkdtemp()
+    dims = {'dim': [{'size': '-1'}, {'size': '1'}]}
+    with open(os.path.join(model_path, 'model.json'), 'w') as f:
+      json.dump(
+          {
+              'signature': {
+                  'inputs': {
+                      'input1:0': {
+                          'tensorShape': dims
+                      }
+                  },
+                  'outputs': {
+                      'Identity:0': {
+                          'tensorShape': dims
+                      }
+                  }
+              }
+          }, f)
+    return model_path
+
+  def _create_fake_tfjs_binary(self, contents):
+    path = os.path.join(tempfile.mkdtemp(), 'tfjs_binary')
+    with open(path, 'w') as f:
+      f.write(contents.format(python=sys.executable))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    return path
+
+  def _create_do_fn(self):
+    eval_config = config_pb2.EvalConfig(
+        model_specs=[config_pb2.ModelSpec(model_type='tf_js')])
+    eval_shared_model = self.createTestEvalSharedModel(
+        eval_saved_model_path=self._create_fake_tfjs_model(),
+        model_type='tf_js')
+    return tfjs_predict_extractor._TFJSPredictionDoFn(
+        eval_config=eval_config, eval_shared_models={'': eval_shared_model})
+
+  def testTFJSPredictionDoFnRunInference(self):
+    do_fn = self._create_do_fn()
+    binary_path = self._create_fake_tfjs_binary(_FAKE_TFJS_BINARY)
+    with mock.patch.object(
+        tfjs_predict_extractor, 'get_tfjs_binary', return_value=binary_path):
+      do_fn.setup()
+    try:
+      result = do_fn._batch_reducible_process({
+          constants.FEATURES_KEY: [{
+              'input1': np.array([1.0], dtype=np.float32)
+          }, {
+              'input1': np.array([3.0], dtype=np.float32)
+          }]
+      })
+      self.assertLen(result, 1)
+      predictions = result[0][constants.PREDICTIONS_KEY]
+      self.assertLen(predictions, 2)
+      self.assertAllClose([2.0], predictions[0])
+      self.assertAllClose([6.0], predictions[1])
+      self.assertEqual(np.float32, predictions[0].dtype)
+
+      # Outputs of the previous batch are removed before running inference so
+      # they are never returned for a batch whose inference did not succeed.
+      do_fn._binary_path = self._create_fake_tfjs_binary(
+          _NO_OUTPUTS_TFJS_BINARY)
+      with self.assertRaises(FileNotFoundError):
+        do_fn._run_inference('', {'data.json': [[[1.0]]]})
+    finally:
+      do_fn.teardown()
+
+  def testTFJSPredictionDoFnTeardownRemovesWorkingDirectory(self):
+    do_fn = self._create_do_fn()
+    with mock.patch.object(
+        tfjs_predict_extractor, 'get_tfjs_binary', return_value='tfjs_binary'):
+      do_fn.setup()
+    base_path = do_fn._base_path
+    self.assertTrue(
+        os.path.exists(os.path.join(base_path, 'Models', '', 'model.json')))
+
+    do_fn.teardown()
+
+    self.assertFalse(os.path.exists(base_path))
+    self.assertIsNone(do_fn._base_path)
+    # Teardown may be called more than once.
+    do_fn.teardown()
+
 
 if __name__ == '__main__':
   tf.compat.v1.enable_v2_behavior()
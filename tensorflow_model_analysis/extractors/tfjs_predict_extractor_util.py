@@ -18,13 +18,30 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import urllib
 
 import tensorflow as tf
 
+_TFJS_BINARY_LOCK = threading.Lock()
+_TFJS_BINARY_PATH = None
+
 
 def get_tfjs_binary():
-  """Download and return the path to the tfjs binary."""
+  """Download and return the path to the tfjs binary.
+
+  The binary is only downloaded once per process, later calls return the path
+  of the previously downloaded binary.
+  """
+  global _TFJS_BINARY_PATH
+  with _TFJS_BINARY_LOCK:
+    if _TFJS_BINARY_PATH is None or not os.path.exists(_TFJS_BINARY_PATH):
+      _TFJS_BINARY_PATH = _download_tfjs_binary()
+    return _TFJS_BINARY_PATH
+
+
+def _download_tfjs_binary():
+  """Download the tfjs binary and return its path."""
   if sys.platform == 'darwin':
     url = 'http://storage.googleapis.com/tfjs-inference/tfjs-inference-macos'
   else:
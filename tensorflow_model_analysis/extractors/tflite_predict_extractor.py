@@ -15,10 +15,13 @@
 
 import collections
 import copy
-from typing import Dict, Sequence, Union
+import functools
+import threading
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
 
 from absl import logging
 import apache_beam as beam
+from apache_beam.utils import shared
 import numpy as np
 import tensorflow as tf
 from tensorflow_model_analysis import constants
@@ -30,52 +33,166 @@ from tensorflow_model_analysis.utils import model_util
 _TFLITE_PREDICT_EXTRACTOR_STAGE_NAME = 'ExtractTFLitePredictions'
 
 
+_SERVING_DEFAULT_PREFIX = 'serving_default_'
+
+
+def _get_input_name_from_input_detail(input_detail):
+  """Get input name from input detail.
+
+  Args:
+    input_detail: the details for a model input.
+
+  Returns:
+    Input name. The signature key prefix and argument postfix will be removed.
+  """
+  input_name = input_detail['name']
+  # TFLite saved model converter inserts the signature key name at beginning
+  # of the input names. TFLite rewriter assumes that the default signature key
+  # ('serving_default') will be used as an exported name when saving.
+  if input_name.startswith(_SERVING_DEFAULT_PREFIX):
+    input_name = input_name[len(_SERVING_DEFAULT_PREFIX):]
+  # Remove argument that starts with ':'.
+  input_name = input_name.split(':')[0]
+  return input_name
+
+
+class _InputDetail(NamedTuple):
+  """Details of a model input (with the batch dimension removed)."""
+  index: int
+  name: str
+  row_shape: Tuple[int, ...]
+  dtype: Any
+
+
+class _TFLiteInterpreterPool:
+  """Per worker pool of tflite interpreters.
+
+  Interpreters are not thread safe, so each interpreter is used by one thread at
+  a time. Free interpreters are kept per model together with the batch size
+  their input tensors are currently allocated for. An interpreter allocated for
+  the requested batch size is preferred. Otherwise a free interpreter is resized
+  and re-allocated, so new interpreters are only created when all of the
+  existing ones are in use. The input and output details of each model are
+  computed once and shared.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._free_interpreters = collections.defaultdict(list)
+    self._details = {}
+
+  def details(
+      self, model_name: str, create_fn: Callable[[], tf.lite.Interpreter]
+  ) -> Tuple[List[_InputDetail], List[Dict[str, Any]]]:
+    """Returns the input and output details for the model."""
+    with self._lock:
+      if model_name in self._details:
+        return self._details[model_name]
+    interpreter = create_fn()
+    input_details = [
+        _InputDetail(
+            index=i['index'],
+            name=_get_input_name_from_input_detail(i),
+            row_shape=tuple(i['shape'])[1:],
+            dtype=i['dtype']) for i in interpreter.get_input_details()
+    ]
+    output_details = interpreter.get_output_details()
+    with self._lock:
+      return self._details.setdefault(model_name,
+                                      (input_details, output_details))
+
+  def acquire(self, model_name: str, batch_size: int,
+              create_fn: Callable[[], tf.lite.Interpreter],
+              input_details: List[_InputDetail]) -> tf.lite.Interpreter:
+    """Returns an interpreter allocated for the model and batch size."""
+    with self._lock:
+      free = self._free_interpreters[model_name]
+      for i in reversed(range(len(free))):
+        if free[i][0] == batch_size:
+          return free.pop(i)[1]
+      interpreter = free.pop()[1] if free else None
+    if interpreter is None:
+      interpreter = create_fn()
+    for i in input_details:
+      interpreter.resize_tensor_input(i.index, (batch_size,) + i.row_shape)
+    interpreter.allocate_tensors()
+    return interpreter
+
+  def release(self, model_name: str, batch_size: int,
+              interpreter: tf.lite.Interpreter):
+    """Returns an interpreter acquired for the model and batch size."""
+    with self._lock:
+      self._free_interpreters[model_name].append((batch_size, interpreter))
+
+
 # TODO(b/149981535) Determine if we should merge with RunInference.
 @beam.typehints.with_input_types(types.Extracts)
 @beam.typehints.with_output_types(types.Extracts)
 class _TFLitePredictionDoFn(model_util.BatchReducibleBatchedDoFnWithModels):
   """A DoFn that loads tflite models and predicts."""
 
-  def __init__(self, eval_config: config_pb2.EvalConfig,
-               eval_shared_models: Dict[str, types.EvalSharedModel]) -> None:
-    super().__init__({k: v.model_loader for k, v in eval_shared_models.items()})
+  def __init__(self,
+               eval_config: config_pb2.EvalConfig,
+               eval_shared_models: Dict[str, types.EvalSharedModel],
+               num_threads: Optional[int] = None) -> None:
+    super().__init__(
+        {k: v.model_loader for k, v in eval_shared_models.items()},
+        adaptive_batch_size=(
+            eval_config.options.adaptive_inference_batch_size.value))
     self._eval_config = eval_config
+    self._num_threads = num_threads
+    self._interpreter_pool_handle = shared.Shared()
+    self._interpreter_pool = None
 
   def setup(self):
     super().setup()
-    self._interpreters = {}
-
+    self._interpreter_pool = self._interpreter_pool_handle.acquire(
+        _TFLiteInterpreterPool)
+    self._details = {}
+    for model_name in self._loaded_models:
+      self._details[model_name] = self._interpreter_pool.details(
+          model_name, functools.partial(self._create_interpreter, model_name))
+
+  def _create_interpreter(self, model_name: str) -> tf.lite.Interpreter:
+    """Creates a new interpreter for the model."""
+    model_contents = self._loaded_models[model_name]
+    kwargs = {}
+    if self._num_threads is not None:
+      kwargs['num_threads'] = self._num_threads
     major, minor, _ = tf.version.VERSION.split('.')
-    for model_name, model_contents in self._loaded_models.items():
-      # TODO(b/207600661): drop BUILTIN_WITHOUT_DEFAULT_DELEGATES once the issue
-      # is fixed.
-      if int(major) > 2 or (int(major) == 2 and int(minor) >= 5):
-        self._interpreters[model_name] = tf.lite.Interpreter(
-            model_content=model_contents.contents,
-            experimental_op_resolver_type=tf.lite.experimental.OpResolverType
-            .BUILTIN_WITHOUT_DEFAULT_DELEGATES)
+    # TODO(b/207600661): drop BUILTIN_WITHOUT_DEFAULT_DELEGATES once the issue
+    # is fixed.
+    if int(major) > 2 or (int(major) == 2 and int(minor) >= 5):
+      kwargs['experimental_op_resolver_type'] = (
+          tf.lite.experimental.OpResolverType.BUILTIN_WITHOUT_DEFAULT_DELEGATES)
+    return tf.lite.Interpreter(model_content=model_contents.contents, **kwargs)
+
+  def _stage_inputs(self, interpreter: tf.lite.Interpreter,
+                    input_details: List[_InputDetail],
+                    feature_rows: Sequence[Any]):
+    """Copies the features of each row directly into the input tensors."""
+    for i in input_details:
+      string_input = np.dtype(i.dtype).kind in ('O', 'S', 'U')
+      if string_input:
+        # String tensors can not be accessed as views. An object array is used
+        # since a fixed width bytes array would truncate the values.
+        buffer = np.empty((len(feature_rows),) + i.row_shape, dtype=object)
       else:
-        self._interpreters[model_name] = tf.lite.Interpreter(
-            model_content=model_contents.contents)
-
-  def _get_input_name_from_input_detail(self, input_detail):
-    """Get input name from input detail.
-
-    Args:
-      input_detail: the details for a model input.
-
-    Returns:
-      Input name. The signature key prefix and argument postfix will be removed.
-    """
-    input_name = input_detail['name']
-    # TFLite saved model converter inserts the signature key name at beginning
-    # of the input names. TFLite rewriter assumes that the default signature key
-    # ('serving_default') will be used as an exported name when saving.
-    if input_name.startswith('serving_default_'):
-      input_name = input_name[len('serving_default_'):]
-    # Remove argument that starts with ':'.
-    input_name = input_name.split(':')[0]
-    return input_name
+        # The returned array is a view of the interpreter's input buffer. It
+        # must not be kept around while the interpreter is invoked.
+        buffer = interpreter.tensor(i.index)()
+      for row, r in enumerate(feature_rows):
+        value = r.get(i.name)
+        if value is None or np.any(np.equal(value, None)):
+          buffer[row] = b'' if string_input else -1
+          logging.log_every_n(logging.WARNING,
+                              'Feature %s not found. Setting default value.',
+                              100, i.name)
+        else:
+          buffer[row] = np.reshape(value, i.row_shape)
+      if string_input:
+        interpreter.set_tensor(i.index, buffer)
+      del buffer
 
   def _batch_reducible_process(
       self, element: types.Extracts) -> Sequence[types.Extracts]:
@@ -83,6 +200,7 @@ class _TFLitePredictionDoFn(model_util.BatchReducibleBatchedDoFnWithModels):
     result = copy.copy(element)
     result[constants.PREDICTIONS_KEY] = []
     feature_rows = element[constants.FEATURES_KEY]
+    batch_size = len(feature_rows)
 
     for spec in self._eval_config.model_specs:
       model_name = spec.name if len(self._eval_config.model_specs) > 1 else ''
@@ -90,46 +208,21 @@ class _TFLitePredictionDoFn(model_util.BatchReducibleBatchedDoFnWithModels):
         raise ValueError('model for "{}" not found: eval_config={}'.format(
             spec.name, self._eval_config))
 
-      interpreter = self._interpreters[model_name]
-
-      input_details = interpreter.get_input_details()
-      output_details = interpreter.get_output_details()
-
-      input_features = collections.defaultdict(list)
-      for i in input_details:
-        input_name = self._get_input_name_from_input_detail(i)
-        # The batch dimension is the specific batch size of the last time the
-        # model was invoked. Set it to 1 to "reset".
-        input_shape = [1] + list(i['shape'])[1:]
-        input_type = i['dtype']
-        for r in feature_rows:
-          value = r.get(input_name)
-          if value is None or np.any(np.equal(value, None)):
-            default = -1 if input_type in [np.float32, np.int64] else ''
-            value = np.empty(input_shape)
-            value.fill(default)
-            value = value.astype(input_type)
-            logging.log_every_n(logging.WARNING,
-                                'Feature %s not found. Setting default value.',
-                                100, input_name)
-          else:
-            value = np.reshape(value, input_shape)
-          input_features[input_name].append(value)
-        input_features[input_name] = tf.concat(
-            input_features[input_name], axis=0)
-        if np.shape(input_features[input_name]) != tuple(i['shape']):
-          interpreter.resize_tensor_input(i['index'],
-                                          np.shape(input_features[input_name]))
-      interpreter.allocate_tensors()
-
-      for i in input_details:
-        input_name = self._get_input_name_from_input_detail(i)
-        interpreter.set_tensor(i['index'], input_features[input_name])
-      interpreter.invoke()
-
-      outputs = {
-          o['name']: interpreter.get_tensor(o['index']) for o in output_details
-      }
+      input_details, output_details = self._details[model_name]
+      interpreter = self._interpreter_pool.acquire(
+          model_name, batch_size,
+          functools.partial(self._create_interpreter, model_name),
+          input_details)
+      try:
+        self._stage_inputs(interpreter, input_details, feature_rows)
+        interpreter.invoke()
+        # get_tensor returns a copy so the interpreter can be reused.
+        outputs = {
+            o['name']: interpreter.get_tensor(o['index'])
+            for o in output_details
+        }
+      finally:
+        self._interpreter_pool.release(model_name, batch_size, interpreter)
 
       for v in outputs.values():
         if len(v) != len(feature_rows):
@@ -154,9 +247,10 @@ class _TFLitePredictionDoFn(model_util.BatchReducibleBatchedDoFnWithModels):
 @beam.typehints.with_input_types(types.Extracts)
 @beam.typehints.with_output_types(types.Extracts)
 def _ExtractTFLitePredictions(  # pylint: disable=invalid-name
-    extracts: beam.pvalue.PCollection, eval_config: config_pb2.EvalConfig,
-    eval_shared_models: Dict[str,
-                             types.EvalSharedModel]) -> beam.pvalue.PCollection:
+    extracts: beam.pvalue.PCollection,
+    eval_config: config_pb2.EvalConfig,
+    eval_shared_models: Dict[str, types.EvalSharedModel],
+    num_threads: Optional[int] = None) -> beam.pvalue.PCollection:
   """A PTransform that adds predictions and possibly other tensors to extracts.
 
   Args:
@@ -164,6 +258,7 @@ def _ExtractTFLitePredictions(  # pylint: disable=invalid-name
       tfma.FEATURES_KEY.
     eval_config: Eval config.
     eval_shared_models: Shared model parameters keyed by model name.
+    num_threads: Number of threads used by each tflite interpreter.
 
   Returns:
     PCollection of Extracts updated with the predictions.
@@ -172,14 +267,16 @@ def _ExtractTFLitePredictions(  # pylint: disable=invalid-name
       extracts
       | 'Predict' >> beam.ParDo(
           _TFLitePredictionDoFn(
-              eval_config=eval_config, eval_shared_models=eval_shared_models)))
+              eval_config=eval_config,
+              eval_shared_models=eval_shared_models,
+              num_threads=num_threads)))
 
 
 def TFLitePredictExtractor(
     eval_config: config_pb2.EvalConfig,
-    eval_shared_model: Union[types.EvalSharedModel, Dict[str,
-                                                         types.EvalSharedModel]]
-) -> extractor.Extractor:
+    eval_shared_model: Union[types.EvalSharedModel,
+                             Dict[str, types.EvalSharedModel]],
+    num_threads: Optional[int] = None) -> extractor.Extractor:
   """Creates an extractor for performing predictions on tflite models.
 
   The extractor's PTransform loads and interprets the tflite flatbuffer against
@@ -188,10 +285,16 @@ def TFLitePredictExtractor(
   inputs are searched for under tfma.FEATURES_KEY. If multiple
   models are used the predictions will be stored in a dict keyed by model name.
 
+  The interpreters are pooled per worker so that concurrent threads on the same
+  worker each use their own interpreter. Pooled interpreters are resized when
+  the batch size changes.
+
   Args:
     eval_config: Eval config.
     eval_shared_model: Shared model (single-model evaluation) or dict of shared
       models keyed by model name (multi-model evaluation).
+    num_threads: Optional number of threads used by each tflite interpreter.
+      Defaults to the tflite default.
 
   Returns:
     Extractor for extracting predictions.
@@ -204,4 +307,5 @@ def TFLitePredictExtractor(
       stage_name=_TFLITE_PREDICT_EXTRACTOR_STAGE_NAME,
       ptransform=_ExtractTFLitePredictions(
           eval_config=eval_config,
-          eval_shared_models={m.model_name: m for m in eval_shared_models}))
+          eval_shared_models={m.model_name: m for m in eval_shared_models},
+          num_threads=num_threads))
@@ -19,6 +19,7 @@ import tempfile
 from absl.testing import parameterized
 import apache_beam as beam
 from apache_beam.testing import util
+import numpy as np
 import tensorflow as tf
 from tensorflow_model_analysis import constants
 from tensorflow_model_analysis.api import model_eval_lib
@@ -157,6 +158,87 @@ class TFLitePredictExtractorTest(testutil.TensorflowModelAnalysisTest,
 
         util.assert_that(result, check_result, label='result')
 
+  def testTFLiteInterpreterPool(self):
+
+    class FakeInterpreter:
+
+      def __init__(self):
+        self.input_shapes = {}
+        self.num_allocations = 0
+
+      def resize_tensor_input(self, index, shape):
+        self.input_shapes[index] = shape
+
+      def allocate_tensors(self):
+        self.num_allocations += 1
+
+    created = []
+
+    def create_fn():
+      created.append(FakeInterpreter())
+      return created[-1]
+
+    input_details = [
+        tflite_predict_extractor._InputDetail(
+            index=0, name='input1', row_shape=(1,), dtype=None)
+    ]
+    pool = tflite_predict_extractor._TFLiteInterpreterPool()
+    interpreter1 = pool.acquire('model', 2, create_fn, input_details)
+    interpreter2 = pool.acquire('model', 3, create_fn, input_details)
+    self.assertIsNot(interpreter1, interpreter2)
+    self.assertEqual({0: (2, 1)}, interpreter1.input_shapes)
+    self.assertEqual({0: (3, 1)}, interpreter2.input_shapes)
+    pool.release('model', 2, interpreter1)
+    pool.release('model', 3, interpreter2)
+
+    # Interpreters allocated for the requested batch size are reused without
+    # re-allocating their tensors.
+    self.assertIs(interpreter1,
+                  pool.acquire('model', 2, create_fn, input_details))
+    self.assertEqual(1, interpreter1.num_allocations)
+
+    # Free interpreters are resized for new batch sizes instead of creating new
+    # interpreters.
+    self.assertIs(interpreter2,
+                  pool.acquire('model', 5, create_fn, input_details))
+    self.assertEqual({0: (5, 1)}, interpreter2.input_shapes)
+    self.assertEqual(2, interpreter2.num_allocations)
+    self.assertLen(created, 2)
+
+    # New interpreters are only created when all of them are in use.
+    interpreter3 = pool.acquire('model', 2, create_fn, input_details)
+    self.assertEqual({0: (2, 1)}, interpreter3.input_shapes)
+    self.assertLen(created, 3)
+
+  def testTFLitePredictionDoFnStageStringInputs(self):
+
+    class FakeInterpreter:
+
+      def __init__(self):
+        self.tensors = {}
+
+      def set_tensor(self, index, value):
+        self.tensors[index] = value
+
+    input_details = [
+        tflite_predict_extractor._InputDetail(
+            index=0, name='input1', row_shape=(1,), dtype=np.bytes_)
+    ]
+    feature_rows = [{
+        'input1': np.array([b'hello'], dtype=object)
+    }, {
+        'input1': np.array([b'multi byte value'])
+    }, {}]
+    interpreter = FakeInterpreter()
+    do_fn = tflite_predict_extractor._TFLitePredictionDoFn(
+        eval_config=config_pb2.EvalConfig(), eval_shared_models={})
+    do_fn._stage_inputs(interpreter, input_details, feature_rows)
+
+    self.assertEqual([0], list(interpreter.tensors))
+    self.assertEqual((3, 1), interpreter.tensors[0].shape)
+    self.assertEqual([[b'hello'], [b'multi byte value'], [b'']],
+                     interpreter.tensors[0].tolist())
+
 
 if __name__ == '__main__':
   tf.compat.v1.enable_v2_behavior()
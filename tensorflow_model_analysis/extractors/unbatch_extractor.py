@@ -13,10 +13,10 @@
 # limitations under the License.
 """Unbatch extractor."""
 
-from typing import Mapping, Sequence
+from typing import Any, List, Mapping, Optional, Sequence
 
 import apache_beam as beam
-import pandas as pd
+import numpy as np
 from tensorflow_model_analysis import constants
 from tensorflow_model_analysis import types
 from tensorflow_model_analysis.extractors import extractor
@@ -39,18 +39,90 @@ def UnbatchExtractor() -> extractor.Extractor:
       stage_name=UNBATCH_EXTRACTOR_STAGE_NAME, ptransform=_UnbatchInputs())
 
 
-def _ExtractUnbatchedInputs(
-    batched_extract: types.Extracts) -> Sequence[types.Extracts]:
-  """Extract features, predictions, labels and weights from batched extract."""
-  keys_to_retain = set(batched_extract.keys())
-  if constants.ARROW_RECORD_BATCH_KEY in keys_to_retain:
-    keys_to_retain.remove(constants.ARROW_RECORD_BATCH_KEY)
-  dataframe = pd.DataFrame()
-  for key in keys_to_retain:
-    if isinstance(batched_extract[key], Mapping) and not batched_extract[key]:
+def _batch_size(value: Any) -> Optional[int]:
+  """Returns the batch size of a batched value (None if not batched)."""
+  if isinstance(value, Mapping):
+    for v in value.values():
+      batch_size = _batch_size(v)
+      if batch_size is not None:
+        return batch_size
+    return None
+  if isinstance(value, np.ndarray):
+    return len(value) if value.ndim else None
+  if isinstance(value, (list, tuple)):
+    return len(value)
+  return None
+
+
+def _split_batched_value(value: Any, batch_size: int) -> Sequence[Any]:
+  """Splits a batched value into a sequence of per-example values.
+
+  Lists and tuples are indexed directly and multi-dimensional arrays are split
+  into views of their rows so no values are copied. One dimensional arrays are
+  converted to lists of python values and values that are not batched are
+  shared by all the examples.
+
+  Args:
+    value: Batched value.
+    batch_size: Batch size.
+
+  Returns:
+    Sequence of per-example values of length batch_size.
+
+  Raises:
+    ValueError: If the value does not match the batch size.
+  """
+  if isinstance(value, Mapping):
+    values_by_key = {
+        k: _split_batched_value(v, batch_size) for k, v in value.items()
+    }
+    return [{k: v[i] for k, v in values_by_key.items()}
+            for i in range(batch_size)]
+  if isinstance(value, np.ndarray):
+    if not value.ndim:
+      return [value] * batch_size
+    value = value.tolist() if value.ndim == 1 else list(value)
+  elif not isinstance(value, (list, tuple)):
+    return [value] * batch_size
+  if len(value) != batch_size:
+    raise ValueError(
+        'Length of values ({}) does not match the batch size ({})'.format(
+            len(value), batch_size))
+  return value
+
+
+def split_extracts(batched_extract: types.Extracts,
+                   batch_size: Optional[int] = None) -> List[types.Extracts]:
+  """Splits a batched extract into per-example extracts.
+
+  Mapping valued keys (e.g. multi-output predictions) are split recursively so
+  each per-example extract has the same structure as the batched extract. The
+  Arrow RecordBatch and empty mappings are not included in the outputs.
+
+  Args:
+    batched_extract: Batched extract.
+    batch_size: Optional batch size. If unset, the batch size is inferred from
+      the batched values.
+
+  Returns:
+    List of per-example extracts (empty if the batch size can't be inferred).
+  """
+  batched_values = {}
+  for key, value in batched_extract.items():
+    if key == constants.ARROW_RECORD_BATCH_KEY:
+      continue
+    if isinstance(value, Mapping) and not value:
       continue
-    dataframe[key] = batched_extract[key]
-  return dataframe.to_dict(orient='records')
+    batched_values[key] = value
+    if batch_size is None:
+      batch_size = _batch_size(value)
+  if batch_size is None:
+    return []
+  values_by_key = {
+      k: _split_batched_value(v, batch_size) for k, v in batched_values.items()
+  }
+  return [{k: v[i] for k, v in values_by_key.items()}
+          for i in range(batch_size)]
 
 
 @beam.ptransform_fn
@@ -66,4 +138,4 @@ def _UnbatchInputs(
   Returns:
     PCollection of per-example extracts.
   """
-  return extracts | 'UnbatchInputs' >> beam.FlatMap(_ExtractUnbatchedInputs)
+  return extracts | 'UnbatchInputs' >> beam.FlatMap(split_extracts)
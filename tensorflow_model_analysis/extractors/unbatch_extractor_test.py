@@ -453,6 +453,55 @@ class UnbatchExtractorTest(testutil.TensorflowModelAnalysisTest):
 
       util.assert_that(result, check_result, label='result')
 
+  def testSplitExtracts(self):
+    batched_extract = {
+        constants.ARROW_RECORD_BATCH_KEY: object(),
+        constants.INPUT_KEY: np.array([b'example1', b'example2'], dtype=object),
+        constants.LABELS_KEY: [np.array([1.0]), np.array([0.0])],
+        constants.PREDICTIONS_KEY: {
+            'output1': np.array([[0.1, 0.9], [0.8, 0.2]]),
+            'output2': [np.array([0.5]), np.array([0.6])],
+        },
+        constants.EXAMPLE_WEIGHTS_KEY: np.array([0.5, 1.0]),
+        constants.SLICE_KEY_TYPES_KEY: [(), (('feature', 1),)],
+        constants.TRANSFORMED_FEATURES_KEY: {},
+    }
+
+    got = unbatch_extractor.split_extracts(batched_extract)
+
+    self.assertLen(got, 2)
+    for extracts in got:
+      self.assertNotIn(constants.ARROW_RECORD_BATCH_KEY, extracts)
+      self.assertNotIn(constants.TRANSFORMED_FEATURES_KEY, extracts)
+    self.assertEqual(got[0][constants.INPUT_KEY], b'example1')
+    self.assertEqual(got[1][constants.INPUT_KEY], b'example2')
+    np.testing.assert_array_equal(got[1][constants.LABELS_KEY], [0.0])
+    np.testing.assert_array_equal(
+        got[0][constants.PREDICTIONS_KEY]['output1'], [0.1, 0.9])
+    np.testing.assert_array_equal(
+        got[1][constants.PREDICTIONS_KEY]['output2'], [0.6])
+    self.assertEqual(got[1][constants.EXAMPLE_WEIGHTS_KEY], 1.0)
+    self.assertEqual(got[1][constants.SLICE_KEY_TYPES_KEY], (('feature', 1),))
+
+  def testSplitExtractsWithMismatchedBatchSizes(self):
+    with self.assertRaises(ValueError):
+      unbatch_extractor.split_extracts({
+          constants.LABELS_KEY: [1.0, 0.0],
+          constants.EXAMPLE_WEIGHTS_KEY: [1.0, 1.0, 1.0],
+      })
+
+  def testSplitExtractsWithBatchSize(self):
+    batched_extract = {constants.LABELS_KEY: {'output1': 1.0}}
+
+    # The batch size can't be inferred from values that are not batched, but
+    # such values are shared by all the examples when the batch size is given.
+    self.assertEqual([], unbatch_extractor.split_extracts(batched_extract))
+    self.assertEqual([{
+        constants.LABELS_KEY: {
+            'output1': 1.0
+        }
+    }] * 2, unbatch_extractor.split_extracts(batched_extract, batch_size=2))
+
 
 if __name__ == '__main__':
   tf.test.main()
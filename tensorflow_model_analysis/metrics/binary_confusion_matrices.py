@@ -13,9 +13,11 @@
 # limitations under the License.
 """Binary confusion matrices."""
 
+import itertools
 from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
 
 import apache_beam as beam
+import numpy as np
 from tensorflow_model_analysis import types
 from tensorflow_model_analysis.metrics import calibration_histogram
 from tensorflow_model_analysis.metrics import metric_types
@@ -431,16 +433,60 @@ def _histogram_to_binary_confusion_matrices(
 
 _BINARY_CONFUSION_MATRIX_NAME = '_binary_confusion_matrix'
 
-Matrix = NamedTuple('Matrix', [('tp', float), ('tn', float), ('fp', float),
-                               ('fn', float)])
 
-_ThresholdEntry = NamedTuple('_ThresholdEntry', [('matrix', Matrix),
-                                                 ('tp_examples', List[str]),
-                                                 ('tn_examples', List[str]),
-                                                 ('fp_examples', List[str]),
-                                                 ('fn_examples', List[str])])
+class _ExampleIdSample:
+  """Bounded sample of example ids for one confusion matrix cell.
 
-MatrixAccumulator = Dict[float, _ThresholdEntry]
+  The ids[i] list holds up to max_ids example ids for the threshold at index i.
+  The full array tracks which of these lists have already reached max_ids so
+  that subsequent updates only touch the thresholds that still need samples.
+  """
+  __slots__ = ['ids', 'full']
+
+  def __init__(self, num_thresholds: int):
+    self.ids = [[] for _ in range(num_thresholds)]
+    self.full = np.zeros(num_thresholds, dtype=bool)
+
+  def add(self, example_id: Any, matches: np.ndarray, max_ids: int):
+    """Adds example_id at each threshold where matches is true."""
+    for i in np.flatnonzero(matches & ~self.full):
+      self.ids[i].append(example_id)
+      self.full[i] = len(self.ids[i]) >= max_ids
+
+  def merge(self, other: '_ExampleIdSample', max_ids: int):
+    """Merges the ids from other into this sample."""
+    for i in np.flatnonzero(~self.full):
+      if other.ids[i]:
+        self.ids[i].extend(other.ids[i][:max_ids - len(self.ids[i])])
+        self.full[i] = len(self.ids[i]) >= max_ids
+
+
+class _MatrixAccumulator:
+  """Binary confusion matrix accumulator.
+
+  The tp, tn, fp, and fn arrays hold the weighted counts for each threshold in
+  the order the thresholds were provided. The example samples are None when
+  example ids are not being sampled.
+  """
+  __slots__ = [
+      'tp', 'tn', 'fp', 'fn', 'tp_examples', 'tn_examples', 'fp_examples',
+      'fn_examples'
+  ]
+
+  def __init__(self, num_thresholds: int, sample_example_ids: bool):
+    self.tp = np.zeros(num_thresholds, dtype=np.float64)
+    self.tn = np.zeros(num_thresholds, dtype=np.float64)
+    self.fp = np.zeros(num_thresholds, dtype=np.float64)
+    self.fn = np.zeros(num_thresholds, dtype=np.float64)
+    self.tp_examples = None
+    self.tn_examples = None
+    self.fp_examples = None
+    self.fn_examples = None
+    if sample_example_ids:
+      self.tp_examples = _ExampleIdSample(num_thresholds)
+      self.tn_examples = _ExampleIdSample(num_thresholds)
+      self.fp_examples = _ExampleIdSample(num_thresholds)
+      self.fn_examples = _ExampleIdSample(num_thresholds)
 
 
 def _binary_confusion_matrix_computation(
@@ -514,145 +560,204 @@ class _BinaryConfusionMatrixCombiner(beam.CombineFn):
     self._class_weights = class_weights
     self._example_weighted = example_weighted
     self._fractional_labels = fractional_labels
-
-  def _merge_example_ids(self, list_1: List[str],
-                         list_2: List[str]) -> List[str]:
-    result = list_1[:self._example_ids_count]
-    result.extend(list_2[:self._example_ids_count - len(result)])
-    return result
-
-  def _merge_entry(self, result: MatrixAccumulator, threshold: float,
-                   entry: _ThresholdEntry):
-    if threshold not in result:
-      return entry
-
-    return _ThresholdEntry(
-        matrix=Matrix(
-            tp=result[threshold].matrix.tp + entry.matrix.tp,
-            tn=result[threshold].matrix.tn + entry.matrix.tn,
-            fp=result[threshold].matrix.fp + entry.matrix.fp,
-            fn=result[threshold].matrix.fn + entry.matrix.fn),
-        tp_examples=self._merge_example_ids(result[threshold].tp_examples,
-                                            entry.tp_examples),
-        tn_examples=self._merge_example_ids(result[threshold].tn_examples,
-                                            entry.tn_examples),
-        fp_examples=self._merge_example_ids(result[threshold].fp_examples,
-                                            entry.fp_examples),
-        fn_examples=self._merge_example_ids(result[threshold].fn_examples,
-                                            entry.fn_examples))
-
-  def create_accumulator(self) -> MatrixAccumulator:
-    return {}
+    # Counts are computed against the sorted thresholds and then scattered back
+    # into the order the thresholds were provided in.
+    self._threshold_order = np.argsort(thresholds, kind='stable')
+    self._sorted_thresholds = np.asarray(
+        thresholds, dtype=np.float64)[self._threshold_order]
+
+  def _searchsorted(self, values: np.ndarray) -> np.ndarray:
+    """Returns number of (sorted) thresholds strictly less than each value."""
+    indices = np.searchsorted(self._sorted_thresholds, values, side='left')
+    # NaN sorts last, but NaN > threshold is always false.
+    indices[np.isnan(values)] = 0
+    return indices
+
+  def _weighted_counts(
+      self, labels: np.ndarray, predictions: np.ndarray,
+      example_weights: np.ndarray
+  ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Returns (tp, tn, fp, fn) weighted counts indexed by threshold."""
+    num_thresholds = len(self._sorted_thresholds)
+    # A prediction is positive at (sorted) threshold i iff i < prediction_index.
+    # Likewise for labels, except that when fractional labels are used the label
+    # is either positive at all thresholds (1.0) or at none of them.
+    prediction_index = self._searchsorted(predictions)
+    if self._fractional_labels:
+      label_index = np.where(labels == 1.0, num_thresholds, 0)
+    else:
+      label_index = self._searchsorted(labels)
+    # Below lower both the label and prediction are positive (tp) and at or
+    # above upper both are negative (tn). In between, the label and prediction
+    # disagree (fn if the label is the positive one, otherwise fp).
+    lower = np.minimum(prediction_index, label_index)
+    upper = np.maximum(prediction_index, label_index)
+    positive_label = label_index > prediction_index
+
+    def cumulative_weight(indices: np.ndarray,
+                          weights: np.ndarray) -> np.ndarray:
+      # Sum of weights where index <= i for each threshold i.
+      return np.cumsum(
+          np.bincount(indices, weights=weights,
+                      minlength=num_thresholds + 1))[:num_thresholds]
+
+    tp = np.sum(example_weights) - cumulative_weight(lower, example_weights)
+    tn = cumulative_weight(upper, example_weights)
+    fn_weights = np.where(positive_label, example_weights, 0.0)
+    fp_weights = np.where(positive_label, 0.0, example_weights)
+    fn = (
+        cumulative_weight(lower, fn_weights) -
+        cumulative_weight(upper, fn_weights))
+    fp = (
+        cumulative_weight(lower, fp_weights) -
+        cumulative_weight(upper, fp_weights))
+
+    def unsort(values: np.ndarray) -> np.ndarray:
+      result = np.empty_like(values)
+      result[self._threshold_order] = values
+      return result
+
+    return unsort(tp), unsort(tn), unsort(fp), unsort(fn)
+
+  def _get_example_id(self, element: metric_types.StandardMetricInputs) -> Any:
+    if (self._example_id_key and element.features and
+        self._example_id_key in element.features):
+      return element.features[self._example_id_key]
+    return None
+
+  def create_accumulator(self) -> _MatrixAccumulator:
+    return _MatrixAccumulator(
+        len(self._thresholds), sample_example_ids=bool(self._example_id_key))
 
   def add_input(
-      self, accumulator: MatrixAccumulator,
-      element: metric_types.StandardMetricInputs) -> MatrixAccumulator:
-    example_id = None
-    if self._example_id_key and self._example_id_key in element.features:
-      example_id = element.features[self._example_id_key]
+      self, accumulator: _MatrixAccumulator,
+      element: metric_types.StandardMetricInputs) -> _MatrixAccumulator:
+    return self.add_inputs(accumulator, [element])
+
+  def add_inputs(
+      self, accumulator: _MatrixAccumulator,
+      elements: Iterable[metric_types.StandardMetricInputs]
+  ) -> _MatrixAccumulator:
+    return self._add_weighted_inputs(accumulator, elements, None)
+
+  def add_weighted_inputs(
+      self, accumulator: _MatrixAccumulator,
+      elements: Iterable[metric_types.StandardMetricInputs],
+      weights: Iterable[int]) -> _MatrixAccumulator:
+    """Adds each element to the matrices the given number of times.
+
+    This is equivalent to calling add_inputs with each element repeated by its
+    weight (e.g. the poisson weights of a bootstrap sample), but the weights are
+    applied to the counts instead of processing the copies.
+
+    Args:
+      accumulator: Accumulator.
+      elements: Elements to add.
+      weights: Number of times to add each element.
 
+    Returns:
+      Updated accumulator.
+    """
+    return self._add_weighted_inputs(accumulator, elements, weights)
+
+  def _add_weighted_inputs(
+      self, accumulator: _MatrixAccumulator,
+      elements: Iterable[metric_types.StandardMetricInputs],
+      weights: Optional[Iterable[int]]) -> _MatrixAccumulator:
+    """Adds the weighted elements (weights of 1 if None) to the matrices."""
+    if weights is None:
+      weights = itertools.repeat(1)
     labels = []
     predictions = []
     example_weights = []
-
-    for label, prediction, example_weight in self._extract_label_prediction_and_weight(
-        element,
-        eval_config=self._eval_config,
-        model_name=self._key.model_name,
-        output_name=self._key.output_name,
-        sub_key=self._key.sub_key,
-        fractional_labels=self._fractional_labels,
-        flatten=True,
-        aggregation_type=self._aggregation_type,
-        class_weights=self._class_weights,
-        example_weighted=self._example_weighted):
-      example_weights.append(float(example_weight))
-      labels.append(float(label))
-      predictions.append(float(prediction))
-    result = accumulator
-    for threshold in self._thresholds:
-      tp = 0.0
-      tn = 0.0
-      fp = 0.0
-      fn = 0.0
-      tp_example = None
-      tn_example = None
-      fp_example = None
-      fn_example = None
-      for i, _ in enumerate(labels):
-        if (labels[i] == 1.0
-            if self._fractional_labels else labels[i] > threshold):
-          if predictions[i] > threshold:
-            tp += example_weights[i]
-            tp_example = example_id
-          else:
-            fn += example_weights[i]
-            fn_example = example_id
-        elif predictions[i] > threshold:
-          fp += example_weights[i]
-          fp_example = example_id
-        else:
-          tn += example_weights[i]
-          tn_example = example_id
-
-      result[threshold] = self._merge_entry(
-          result, threshold,
-          _ThresholdEntry(
-              Matrix(tp=tp, tn=tn, fp=fp, fn=fn),
-              tp_examples=[tp_example] if tp_example else [],
-              tn_examples=[tn_example] if tn_example else [],
-              fp_examples=[fp_example] if fp_example else [],
-              fn_examples=[fn_example] if fn_example else []))
-
-    return result
+    for element, weight in zip(elements, weights):
+      if not weight:
+        continue
+      start = len(labels)
+      for label, prediction, example_weight in self._extract_label_prediction_and_weight(
+          element,
+          eval_config=self._eval_config,
+          model_name=self._key.model_name,
+          output_name=self._key.output_name,
+          sub_key=self._key.sub_key,
+          fractional_labels=self._fractional_labels,
+          flatten=True,
+          aggregation_type=self._aggregation_type,
+          class_weights=self._class_weights,
+          example_weighted=self._example_weighted):
+        example_weights.append(float(example_weight) * weight)
+        labels.append(float(label))
+        predictions.append(float(prediction))
+      if accumulator.tp_examples is None or len(labels) == start:
+        continue
+      example_id = self._get_example_id(element)
+      if example_id is None:
+        continue
+      # An example is sampled for each cell that any of its (flattened) values
+      # fall into, regardless of the weights.
+      tp, tn, fp, fn = self._weighted_counts(
+          np.array(labels[start:]), np.array(predictions[start:]),
+          np.ones(len(labels) - start))
+      accumulator.tp_examples.add(example_id, tp > 0, self._example_ids_count)
+      accumulator.tn_examples.add(example_id, tn > 0, self._example_ids_count)
+      accumulator.fp_examples.add(example_id, fp > 0, self._example_ids_count)
+      accumulator.fn_examples.add(example_id, fn > 0, self._example_ids_count)
+
+    if labels:
+      tp, tn, fp, fn = self._weighted_counts(
+          np.array(labels), np.array(predictions), np.array(example_weights))
+      accumulator.tp += tp
+      accumulator.tn += tn
+      accumulator.fp += fp
+      accumulator.fn += fn
+    return accumulator
 
   def merge_accumulators(
-      self, accumulators: Iterable[MatrixAccumulator]) -> MatrixAccumulator:
+      self, accumulators: Iterable[_MatrixAccumulator]) -> _MatrixAccumulator:
     accumulators = iter(accumulators)
     result = next(accumulators)
     for accumulator in accumulators:
-      for threshold in self._thresholds:
-        if threshold not in accumulator:
-          continue
-        result[threshold] = self._merge_entry(result, threshold,
-                                              accumulator[threshold])
+      result.tp += accumulator.tp
+      result.tn += accumulator.tn
+      result.fp += accumulator.fp
+      result.fn += accumulator.fn
+      if result.tp_examples is not None:
+        result.tp_examples.merge(accumulator.tp_examples,
+                                 self._example_ids_count)
+        result.tn_examples.merge(accumulator.tn_examples,
+                                 self._example_ids_count)
+        result.fp_examples.merge(accumulator.fp_examples,
+                                 self._example_ids_count)
+        result.fn_examples.merge(accumulator.fn_examples,
+                                 self._example_ids_count)
     return result
 
   def extract_output(
-      self, accumulator: MatrixAccumulator
-  ) -> Dict[metric_types.MetricKey, MatrixAccumulator]:
-    for threshold in self._thresholds:
-      if threshold not in accumulator:
-        accumulator[threshold] = _ThresholdEntry(
-            Matrix(tp=0.0, tn=0.0, fp=0.0, fn=0.0),
-            tp_examples=[],
-            tn_examples=[],
-            fp_examples=[],
-            fn_examples=[])
+      self, accumulator: _MatrixAccumulator
+  ) -> Dict[metric_types.MetricKey, _MatrixAccumulator]:
     return {self._key: accumulator}
 
 
 def _accumulator_to_matrices_and_examples(
     thresholds: List[float],
-    acc: MatrixAccumulator) -> Tuple[Matrices, Examples]:
-  """Converts MatrixAccumulator to binary confusion matrices."""
-  matrices = Matrices(thresholds=[], tp=[], tn=[], fp=[], fn=[])
+    acc: _MatrixAccumulator) -> Tuple[Matrices, Examples]:
+  """Converts _MatrixAccumulator to binary confusion matrices."""
+  matrices = Matrices(
+      thresholds=list(thresholds),
+      tp=acc.tp.tolist(),
+      tn=acc.tn.tolist(),
+      fp=acc.fp.tolist(),
+      fn=acc.fn.tolist())
+
+  def example_ids(sample: Optional[_ExampleIdSample]) -> List[List[str]]:
+    if sample is None:
+      return [[] for _ in thresholds]
+    return [list(ids) for ids in sample.ids]
+
   examples = Examples(
-      thresholds=[],
-      tp_examples=[],
-      tn_examples=[],
-      fp_examples=[],
-      fn_examples=[])
-  for threshold in thresholds:
-    matrices.thresholds.append(threshold)
-    matrices.tp.append(acc[threshold].matrix.tp)
-    matrices.tn.append(acc[threshold].matrix.tn)
-    matrices.fp.append(acc[threshold].matrix.fp)
-    matrices.fn.append(acc[threshold].matrix.fn)
-
-    examples.thresholds.append(threshold)
-    examples.tp_examples.append(acc[threshold].tp_examples)
-    examples.tn_examples.append(acc[threshold].tn_examples)
-    examples.fp_examples.append(acc[threshold].fp_examples)
-    examples.fn_examples.append(acc[threshold].fn_examples)
+      thresholds=list(thresholds),
+      tp_examples=example_ids(acc.tp_examples),
+      tn_examples=example_ids(acc.tn_examples),
+      fp_examples=example_ids(acc.fp_examples),
+      fn_examples=example_ids(acc.fn_examples))
   return matrices, examples
@@ -463,6 +463,85 @@ class BinaryConfusionMatricesTest(testutil.TensorflowModelAnalysisTest,
 
       util.assert_that(result, check_result, label='result')
 
+  def testBinaryConfusionMatricesUnsortedThresholdsWithAddInputs(self):
+    computations = binary_confusion_matrices.binary_confusion_matrices(
+        thresholds=[0.75, 0.25],
+        example_id_key='example_id_key',
+        example_ids_count=1)
+    matrices_computation = computations[0]
+    derived_computation = computations[1]
+    combiner = matrices_computation.combiner
+
+    examples = []
+    for i, (label, prediction) in enumerate([(0.0, 0.0), (0.0, 0.5),
+                                             (1.0, 0.3), (1.0, 0.9)]):
+      examples.append(
+          metric_util.to_standard_metric_inputs({
+              'labels': np.array([label]),
+              'predictions': np.array([prediction]),
+              'example_weights': np.array([1.0]),
+              'features': {
+                  'example_id_key': np.array(['id_{}'.format(i + 1)]),
+              },
+          }))
+
+    accumulator1 = combiner.add_inputs(combiner.create_accumulator(),
+                                       examples[:3])
+    accumulator2 = combiner.add_input(combiner.create_accumulator(),
+                                      examples[3])
+    accumulator = combiner.merge_accumulators([accumulator1, accumulator2])
+    got_metrics = derived_computation.result(
+        combiner.extract_output(accumulator))
+
+    thresholds_name_part = [0.75, 0.25]
+    matrices_key = metric_types.MetricKey(name='{}_{}'.format(
+        binary_confusion_matrices.BINARY_CONFUSION_MATRICES_NAME,
+        thresholds_name_part))
+    examples_key = metric_types.MetricKey(name='{}_{}'.format(
+        binary_confusion_matrices.BINARY_CONFUSION_EXAMPLES_NAME,
+        thresholds_name_part))
+    self.assertEqual(
+        got_metrics[matrices_key],
+        binary_confusion_matrices.Matrices(
+            thresholds=[0.75, 0.25],
+            tp=[1.0, 2.0],
+            fp=[0.0, 1.0],
+            tn=[2.0, 1.0],
+            fn=[1.0, 0.0]))
+    self.assertEqual(
+        got_metrics[examples_key],
+        binary_confusion_matrices.Examples(
+            thresholds=[0.75, 0.25],
+            tp_examples=[['id_4'], ['id_3']],
+            tn_examples=[['id_1'], ['id_1']],
+            fp_examples=[[], ['id_2']],
+            fn_examples=[['id_3'], []]))
+
+  def testBinaryConfusionMatricesWithWeightedInputs(self):
+    combiner = binary_confusion_matrices.binary_confusion_matrices(
+        thresholds=[0.25, 0.75])[0].combiner
+    examples = []
+    for label, prediction in [(0.0, 0.0), (0.0, 0.5), (1.0, 0.3), (1.0, 0.9)]:
+      examples.append(
+          metric_util.to_standard_metric_inputs({
+              'labels': np.array([label]),
+              'predictions': np.array([prediction]),
+              'example_weights': np.array([1.0]),
+          }))
+    weights = [2, 0, 1, 3]
+
+    got = combiner.add_weighted_inputs(combiner.create_accumulator(), examples,
+                                       weights)
+    expected = combiner.add_inputs(combiner.create_accumulator(), [
+        example for example, weight in zip(examples, weights)
+        for _ in range(weight)
+    ])
+    for got_counts, expected_counts in ((got.tp, expected.tp),
+                                        (got.tn, expected.tn),
+                                        (got.fp, expected.fp),
+                                        (got.fn, expected.fn)):
+      self.assertAllClose(expected_counts, got_counts)
+
 
 if __name__ == '__main__':
   tf.test.main()
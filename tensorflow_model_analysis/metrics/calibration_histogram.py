@@ -18,9 +18,10 @@ import heapq
 import itertools
 import operator
 
-from typing import Dict, Iterable, List, Optional, NamedTuple
+from typing import Dict, Iterable, List, Optional, NamedTuple, Union
 
 import apache_beam as beam
+import numpy as np
 from tensorflow_model_analysis.metrics import metric_types
 from tensorflow_model_analysis.metrics import metric_util
 from tensorflow_model_analysis.proto import config_pb2
@@ -35,6 +36,10 @@ Bucket = NamedTuple('Bucket', [('bucket_id', int), ('weighted_labels', float),
 
 Histogram = List[Bucket]
 
+# When dense calibration histograms are enabled, accumulators with more than
+# this fraction of their buckets occupied are stored as dense arrays.
+_MAX_SPARSE_HISTOGRAM_OCCUPANCY = 0.1
+
 
 def calibration_histogram(
     num_buckets: Optional[int] = None,
@@ -82,6 +87,8 @@ def calibration_histogram(
   Returns:
     MetricComputations for computing the histogram(s).
   """
+  use_dense_accumulator = bool(
+      eval_config and eval_config.options.dense_calibration_histograms.value)
   if num_buckets is None:
     num_buckets = DEFAULT_NUM_BUCKETS
   if left is None:
@@ -112,10 +119,75 @@ def calibration_histogram(
               left=left,
               right=right,
               prediction_based_bucketing=prediction_based_bucketing,
-              fractional_labels=fractional_labels))
+              fractional_labels=fractional_labels,
+              use_dense_accumulator=use_dense_accumulator))
   ]
 
 
+class _DenseHistogramAccumulator:
+  """Calibration histogram accumulator backed by arrays indexed by bucket."""
+  __slots__ = [
+      'weighted_labels', 'weighted_predictions', 'weighted_examples'
+  ]
+
+  def __init__(self, size: int):
+    self.weighted_labels = np.zeros(size, dtype=np.float64)
+    self.weighted_predictions = np.zeros(size, dtype=np.float64)
+    self.weighted_examples = np.zeros(size, dtype=np.float64)
+
+  def add(self, bucket_ids: np.ndarray, weighted_labels: np.ndarray,
+          weighted_predictions: np.ndarray, weighted_examples: np.ndarray):
+    """Adds the weighted values to their associated buckets."""
+    size = len(self.weighted_examples)
+    if len(bucket_ids) < size:
+      np.add.at(self.weighted_labels, bucket_ids, weighted_labels)
+      np.add.at(self.weighted_predictions, bucket_ids, weighted_predictions)
+      np.add.at(self.weighted_examples, bucket_ids, weighted_examples)
+    else:
+      self.weighted_labels += np.bincount(
+          bucket_ids, weights=weighted_labels, minlength=size)
+      self.weighted_predictions += np.bincount(
+          bucket_ids, weights=weighted_predictions, minlength=size)
+      self.weighted_examples += np.bincount(
+          bucket_ids, weights=weighted_examples, minlength=size)
+
+  def add_bucket(self, bucket: Bucket):
+    """Adds the weighted values of a single bucket."""
+    self.weighted_labels[bucket.bucket_id] += bucket.weighted_labels
+    self.weighted_predictions[bucket.bucket_id] += bucket.weighted_predictions
+    self.weighted_examples[bucket.bucket_id] += bucket.weighted_examples
+
+  def add_histogram(self, histogram: Histogram):
+    """Adds the buckets from a (sparse) histogram."""
+    if histogram:
+      values = np.array(histogram, dtype=np.float64)
+      self.add(values[:, 0].astype(np.int64), values[:, 1], values[:, 2],
+               values[:, 3])
+
+  def merge(self, other: '_DenseHistogramAccumulator'):
+    self.weighted_labels += other.weighted_labels
+    self.weighted_predictions += other.weighted_predictions
+    self.weighted_examples += other.weighted_examples
+
+  def occupied_bucket_ids(self) -> np.ndarray:
+    return np.flatnonzero((self.weighted_labels != 0) |
+                          (self.weighted_predictions != 0) |
+                          (self.weighted_examples != 0))
+
+  def to_histogram(self) -> Histogram:
+    """Returns the sparse (list of occupied buckets) form of the histogram."""
+    bucket_ids = self.occupied_bucket_ids()
+    return [
+        Bucket(*bucket) for bucket in zip(
+            bucket_ids.tolist(), self.weighted_labels[bucket_ids].tolist(),
+            self.weighted_predictions[bucket_ids].tolist(),
+            self.weighted_examples[bucket_ids].tolist())
+    ]
+
+
+_HistogramAccumulator = Union[Histogram, _DenseHistogramAccumulator]
+
+
 class _CalibrationHistogramCombiner(beam.CombineFn):
   """Creates histogram from labels, predictions, and example weights."""
 
@@ -125,7 +197,8 @@ class _CalibrationHistogramCombiner(beam.CombineFn):
                class_weights: Optional[Dict[int,
                                             float]], example_weighted: bool,
                num_buckets: int, left: float, right: float,
-               prediction_based_bucketing: bool, fractional_labels: bool):
+               prediction_based_bucketing: bool, fractional_labels: bool,
+               use_dense_accumulator: bool = False):
     self._key = key
     self._eval_config = eval_config
     self._aggregation_type = aggregation_type
@@ -136,6 +209,9 @@ class _CalibrationHistogramCombiner(beam.CombineFn):
     self._range = right - left
     self._fractional_labels = fractional_labels
     self._prediction_based_bucketing = prediction_based_bucketing
+    self._use_dense_accumulator = use_dense_accumulator
+    self._max_sparse_buckets = int(
+        (num_buckets + 2) * _MAX_SPARSE_HISTOGRAM_OCCUPANCY)
 
   def _bucket_index(self, prediction: float) -> int:
     """Returns bucket index given prediction value. Values are truncated."""
@@ -147,6 +223,19 @@ class _CalibrationHistogramCombiner(beam.CombineFn):
       return self._num_buckets + 1
     return int(bucket_index)
 
+  def _bucket_indices(self, values: np.ndarray) -> np.ndarray:
+    """Returns bucket indices given an array of values (see _bucket_index)."""
+    if np.isnan(values).any():
+      raise ValueError(
+          f'NaN values cannot be added to calibration histogram {self._key}')
+    bucket_indices = (values - self._left) / self._range * self._num_buckets + 1
+    return np.clip(bucket_indices, 0, self._num_buckets + 1).astype(np.int64)
+
+  def _to_dense(self, histogram: Histogram) -> _DenseHistogramAccumulator:
+    result = _DenseHistogramAccumulator(self._num_buckets + 2)
+    result.add_histogram(histogram)
+    return result
+
   def create_accumulator(self) -> Histogram:
     # The number of accumulator (histogram) buckets is variable and depends on
     # the number of distinct intervals that are matched during calls to
@@ -154,8 +243,13 @@ class _CalibrationHistogramCombiner(beam.CombineFn):
     # grow size during calls to merge until reaching the final histogram.
     return []
 
-  def add_input(self, accumulator: Histogram,
-                element: metric_types.StandardMetricInputs) -> Histogram:
+  def add_input(self, accumulator: _HistogramAccumulator,
+                element: metric_types.StandardMetricInputs
+               ) -> _HistogramAccumulator:
+    # Single elements only contain a few values so they are added one at a time
+    # (for both accumulator types) instead of through the vectorized path used
+    # by add_inputs for batches.
+    #
     # Note that in the case of top_k, if the aggregation type is not set then
     # the non-top_k predictions will be set to float('-inf'), but the labels
     # will remain unchanged. If aggregation type is set then both the
@@ -181,24 +275,125 @@ class _CalibrationHistogramCombiner(beam.CombineFn):
         bucket_index = self._bucket_index(prediction)
       else:
         bucket_index = self._bucket_index(label)
-      # Check if bucket exists, all bucket values are > 0, so -1 are always less
-      insert_index = bisect.bisect_left(accumulator,
-                                        Bucket(bucket_index, -1, -1, -1))
-      if (insert_index == len(accumulator) or
-          accumulator[insert_index].bucket_id != bucket_index):
-        accumulator.insert(
-            insert_index,
-            Bucket(bucket_index, weighted_label, weighted_prediction,
-                   example_weight))
+      bucket = Bucket(bucket_index, weighted_label, weighted_prediction,
+                      example_weight)
+      if isinstance(accumulator, _DenseHistogramAccumulator):
+        accumulator.add_bucket(bucket)
       else:
-        existing_bucket = accumulator[insert_index]
-        accumulator[insert_index] = Bucket(
-            bucket_index, existing_bucket.weighted_labels + weighted_label,
-            existing_bucket.weighted_predictions + weighted_prediction,
-            existing_bucket.weighted_examples + example_weight)
+        _add_bucket(accumulator, bucket)
+    if (self._use_dense_accumulator and isinstance(accumulator, list) and
+        len(accumulator) > self._max_sparse_buckets):
+      return self._to_dense(accumulator)
     return accumulator
 
-  def merge_accumulators(self, accumulators: Iterable[Histogram]) -> Histogram:
+  def add_inputs(
+      self, accumulator: _HistogramAccumulator,
+      elements: Iterable[metric_types.StandardMetricInputs]
+  ) -> _HistogramAccumulator:
+    if not self._use_dense_accumulator:
+      return super().add_inputs(accumulator, elements)
+    return self._add_weighted_inputs(accumulator, elements, None)
+
+  def add_weighted_inputs(
+      self, accumulator: _HistogramAccumulator,
+      elements: Iterable[metric_types.StandardMetricInputs],
+      weights: Iterable[int]) -> _HistogramAccumulator:
+    """Adds each element to the histogram the given number of times.
+
+    This is equivalent to calling add_inputs with each element repeated by its
+    weight (e.g. the poisson weights of a bootstrap sample), but the weights are
+    applied to the bucket sums instead of processing the copies.
+
+    Args:
+      accumulator: Accumulator.
+      elements: Elements to add.
+      weights: Number of times to add each element.
+
+    Returns:
+      Updated accumulator.
+    """
+    return self._add_weighted_inputs(accumulator, elements, weights)
+
+  def _add_weighted_inputs(
+      self, accumulator: _HistogramAccumulator,
+      elements: Iterable[metric_types.StandardMetricInputs],
+      weights: Optional[Iterable[int]]) -> _HistogramAccumulator:
+    """Adds the weighted elements (weights of 1 if None) to the histogram."""
+    if weights is None:
+      weights = itertools.repeat(1)
+    labels = []
+    predictions = []
+    example_weights = []
+    for element, weight in zip(elements, weights):
+      if not weight:
+        continue
+      for label, prediction, example_weight in (
+          metric_util.to_label_prediction_example_weight(
+              element,
+              eval_config=self._eval_config,
+              model_name=self._key.model_name,
+              output_name=self._key.output_name,
+              sub_key=self._key.sub_key,
+              fractional_labels=self._fractional_labels,
+              flatten=True,
+              aggregation_type=self._aggregation_type,
+              class_weights=self._class_weights,
+              example_weighted=self._example_weighted)):
+        example_weights.append(float(example_weight) * weight)
+        labels.append(float(label))
+        predictions.append(float(prediction))
+    if not labels:
+      return accumulator
+    labels = np.array(labels)
+    predictions = np.array(predictions)
+    example_weights = np.array(example_weights)
+    if self._prediction_based_bucketing:
+      bucket_indices = self._bucket_indices(predictions)
+    else:
+      bucket_indices = self._bucket_indices(labels)
+    weighted_labels = labels * example_weights
+    weighted_predictions = predictions * example_weights
+
+    if isinstance(accumulator, _DenseHistogramAccumulator):
+      accumulator.add(bucket_indices, weighted_labels, weighted_predictions,
+                      example_weights)
+      return accumulator
+
+    # Sum the values within the batch by bucket before updating the sparse
+    # histogram so that only one update is made per distinct bucket.
+    bucket_ids, inverse = np.unique(bucket_indices, return_inverse=True)
+    for bucket in zip(
+        bucket_ids.tolist(),
+        np.bincount(inverse, weights=weighted_labels).tolist(),
+        np.bincount(inverse, weights=weighted_predictions).tolist(),
+        np.bincount(inverse, weights=example_weights).tolist()):
+      _add_bucket(accumulator, Bucket(*bucket))
+    if (self._use_dense_accumulator and
+        len(accumulator) > self._max_sparse_buckets):
+      return self._to_dense(accumulator)
+    return accumulator
+
+  def merge_accumulators(
+      self,
+      accumulators: Iterable[_HistogramAccumulator]) -> _HistogramAccumulator:
+    if self._use_dense_accumulator:
+      accumulators = list(accumulators)
+      if (any(
+          isinstance(accumulator, _DenseHistogramAccumulator)
+          for accumulator in accumulators) or
+          sum(len(accumulator) for accumulator in accumulators
+              if isinstance(accumulator, list)) > self._max_sparse_buckets):
+        # Only the first accumulator may be modified.
+        result = accumulators[0]
+        if not isinstance(result, _DenseHistogramAccumulator):
+          result = self._to_dense(result)
+        for accumulator in accumulators[1:]:
+          if isinstance(accumulator, _DenseHistogramAccumulator):
+            result.merge(accumulator)
+          else:
+            result.add_histogram(accumulator)
+        return result
+
     result = []
     for bucket_id, buckets in itertools.groupby(
         heapq.merge(*accumulators), key=operator.attrgetter('bucket_id')):
@@ -214,11 +409,40 @@ class _CalibrationHistogramCombiner(beam.CombineFn):
                  total_weighted_examples))
     return result
 
+  def compact(self,
+              accumulator: _HistogramAccumulator) -> _HistogramAccumulator:
+    # Switch back to the sparse representation if only a few buckets are
+    # occupied so that less data is shuffled.
+    if (isinstance(accumulator, _DenseHistogramAccumulator) and
+        len(accumulator.occupied_bucket_ids()) <= self._max_sparse_buckets):
+      return accumulator.to_histogram()
+    return accumulator
+
   def extract_output(
-      self, accumulator: Histogram) -> Dict[metric_types.PlotKey, Histogram]:
+      self, accumulator: _HistogramAccumulator
+  ) -> Dict[metric_types.PlotKey, Histogram]:
+    if isinstance(accumulator, _DenseHistogramAccumulator):
+      accumulator = accumulator.to_histogram()
     return {self._key: accumulator}
 
 
+def _add_bucket(histogram: Histogram, bucket: Bucket):
+  """Adds bucket to sorted histogram (combining with existing bucket ids)."""
+  # Check if bucket exists, all bucket values are > 0, so -1 are always less
+  insert_index = bisect.bisect_left(histogram,
+                                    Bucket(bucket.bucket_id, -1, -1, -1))
+  if (insert_index == len(histogram) or
+      histogram[insert_index].bucket_id != bucket.bucket_id):
+    histogram.insert(insert_index, bucket)
+  else:
+    existing_bucket = histogram[insert_index]
+    histogram[insert_index] = Bucket(
+        bucket.bucket_id,
+        existing_bucket.weighted_labels + bucket.weighted_labels,
+        existing_bucket.weighted_predictions + bucket.weighted_predictions,
+        existing_bucket.weighted_examples + bucket.weighted_examples)
+
+
 def rebin(thresholds: List[float],
           histogram: Histogram,
           num_buckets: int = DEFAULT_NUM_BUCKETS,
@@ -242,37 +466,21 @@ def rebin(thresholds: List[float],
     thresholds respectively. Unlike the input histogram empty buckets will be
     returned.
   """
-  buckets = []
-  offset = 0
-  total_weighted_labels = 0.0
-  total_weighted_predictions = 0.0
-  total_weighted_examples = 0.0
-  for bucket in histogram:
-    if bucket.bucket_id == 0:
-      pred = float('-inf')
-    elif bucket.bucket_id >= num_buckets + 1:
-      pred = float('inf')
-    else:
-      pred = (bucket.bucket_id - 1) / num_buckets * (right - left) + left
-    if offset + 1 < len(thresholds) and pred >= thresholds[offset + 1]:
-      buckets.append(
-          Bucket(offset, total_weighted_labels, total_weighted_predictions,
-                 total_weighted_examples))
-      offset += 1
-      total_weighted_labels = 0.0
-      total_weighted_predictions = 0.0
-      total_weighted_examples = 0.0
-      while offset + 1 < len(thresholds) and pred >= thresholds[offset + 1]:
-        buckets.append(Bucket(offset, 0.0, 0.0, 0.0))
-        offset += 1
-    total_weighted_labels += bucket.weighted_labels
-    total_weighted_predictions += bucket.weighted_predictions
-    total_weighted_examples += bucket.weighted_examples
-  buckets.append(
-      Bucket(offset, total_weighted_labels, total_weighted_predictions,
-             total_weighted_examples))
-  offset += 1
-  while offset < len(thresholds):
-    buckets.append(Bucket(offset, 0.0, 0.0, 0.0))
-    offset += 1
-  return buckets
+  values = np.array(histogram, dtype=np.float64).reshape(-1, 4)
+  bucket_ids = values[:, 0]
+  preds = np.where(
+      bucket_ids == 0, float('-inf'),
+      np.where(bucket_ids >= num_buckets + 1, float('inf'),
+               (bucket_ids - 1) / num_buckets * (right - left) + left))
+  # Each bucket is assigned to the last threshold (other than the first) that
+  # is <= its prediction value or to the first threshold if there is none.
+  offsets = np.searchsorted(
+      np.asarray(thresholds[1:], dtype=np.float64), preds, side='right')
+  size = max(len(thresholds), 1)
+  return [
+      Bucket(*bucket) for bucket in zip(
+          range(size),
+          np.bincount(offsets, weights=values[:, 1], minlength=size).tolist(),
+          np.bincount(offsets, weights=values[:, 2], minlength=size).tolist(),
+          np.bincount(offsets, weights=values[:, 3], minlength=size).tolist())
+  ]
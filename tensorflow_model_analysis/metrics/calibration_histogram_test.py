@@ -13,6 +13,8 @@
 # limitations under the License.
 """Tests for calibration histogram."""
 
+from unittest import mock
+
 import apache_beam as beam
 from apache_beam.testing import util
 import numpy as np
@@ -21,6 +23,7 @@ from tensorflow_model_analysis.eval_saved_model import testutil
 from tensorflow_model_analysis.metrics import calibration_histogram
 from tensorflow_model_analysis.metrics import metric_types
 from tensorflow_model_analysis.metrics import metric_util
+from tensorflow_model_analysis.proto import config_pb2
 
 
 class CalibrationHistogramTest(testutil.TensorflowModelAnalysisTest):
@@ -343,6 +346,157 @@ class CalibrationHistogramTest(testutil.TensorflowModelAnalysisTest):
 
       util.assert_that(result, check_result, label='result')
 
+  def testCalibrationHistogramWithDenseAccumulator(self):
+    eval_config = config_pb2.EvalConfig()
+    eval_config.options.dense_calibration_histograms.value = True
+    dense_combiner = calibration_histogram.calibration_histogram(
+        num_buckets=10, eval_config=eval_config,
+        example_weighted=True)[0].combiner
+    sparse_combiner = calibration_histogram.calibration_histogram(
+        num_buckets=10, example_weighted=True)[0].combiner
+
+    examples = []
+    for label, prediction, example_weight in [(0.0, 0.2, 1.0), (1.0, 0.8, 2.0),
+                                              (0.0, 0.5, 3.0), (1.0, -0.1, 4.0),
+                                              (1.0, 0.5, 5.0), (1.0, 0.8, 6.0),
+                                              (0.0, 0.2, 7.0), (1.0, 1.1, 8.0)]:
+      examples.append(
+          metric_util.to_standard_metric_inputs({
+              'labels': np.array([label]),
+              'predictions': np.array([prediction]),
+              'example_weights': np.array([example_weight])
+          }))
+
+    def compute(combiner):
+      accumulator1 = combiner.add_inputs(combiner.create_accumulator(),
+                                         examples[:5])
+      accumulator2 = combiner.create_accumulator()
+      for example in examples[5:]:
+        accumulator2 = combiner.add_input(accumulator2, example)
+      accumulator = combiner.merge_accumulators([
+          combiner.compact(accumulator1),
+          combiner.compact(accumulator2)
+      ])
+      return list(combiner.extract_output(accumulator).values())[0]
+
+    got_histogram = compute(dense_combiner)
+    expected_histogram = compute(sparse_combiner)
+    self.assertLen(got_histogram, 5)
+    self.assertLen(got_histogram, len(expected_histogram))
+    for got, expected in zip(got_histogram, expected_histogram):
+      self.assertSequenceAlmostEqual(got, expected)
+
+  def testDenseAccumulatorAddInput(self):
+    eval_config = config_pb2.EvalConfig()
+    eval_config.options.dense_calibration_histograms.value = True
+    dense_combiner = calibration_histogram.calibration_histogram(
+        num_buckets=10, eval_config=eval_config,
+        example_weighted=True)[0].combiner
+    sparse_combiner = calibration_histogram.calibration_histogram(
+        num_buckets=10, example_weighted=True)[0].combiner
+
+    examples = []
+    for label, prediction, example_weight in [(0.0, 0.15, 1.0),
+                                              (1.0, 0.35, 2.0),
+                                              (0.0, 0.35, 3.0),
+                                              (1.0, 0.75, 4.0)]:
+      examples.append(
+          metric_util.to_standard_metric_inputs({
+              'labels': np.array([label]),
+              'predictions': np.array([prediction]),
+              'example_weights': np.array([example_weight])
+          }))
+
+    # Single inputs are added without going through the vectorized path used
+    # for batches, both before and after switching to a dense accumulator.
+    with mock.patch.object(
+        dense_combiner, '_bucket_indices',
+        side_effect=AssertionError('vectorized path used')):
+      accumulator = dense_combiner.create_accumulator()
+      accumulator = dense_combiner.add_input(accumulator, examples[0])
+      self.assertIsInstance(accumulator, list)
+      for example in examples[1:]:
+        accumulator = dense_combiner.add_input(accumulator, example)
+    self.assertIsInstance(accumulator,
+                          calibration_histogram._DenseHistogramAccumulator)
+
+    expected = sparse_combiner.create_accumulator()
+    for example in examples:
+      expected = sparse_combiner.add_input(expected, example)
+    got_histogram = list(dense_combiner.extract_output(accumulator).values())[0]
+    expected_histogram = list(
+        sparse_combiner.extract_output(expected).values())[0]
+    self.assertLen(got_histogram, 3)
+    self.assertLen(got_histogram, len(expected_histogram))
+    for got_bucket, expected_bucket in zip(got_histogram, expected_histogram):
+      self.assertSequenceAlmostEqual(expected_bucket, got_bucket)
+
+  def testDenseAccumulatorMergeOnlyModifiesFirstAccumulator(self):
+    eval_config = config_pb2.EvalConfig()
+    eval_config.options.dense_calibration_histograms.value = True
+    combiner = calibration_histogram.calibration_histogram(
+        num_buckets=10, eval_config=eval_config,
+        example_weighted=True)[0].combiner
+
+    def make_accumulator(predictions):
+      return combiner.add_inputs(combiner.create_accumulator(), [
+          metric_util.to_standard_metric_inputs({
+              'labels': np.array([1.0]),
+              'predictions': np.array([prediction]),
+              'example_weights': np.array([1.0])
+          }) for prediction in predictions
+      ])
+
+    sparse = make_accumulator([0.5])
+    dense1 = make_accumulator([0.1, 0.3, 0.5])
+    dense2 = make_accumulator([0.2, 0.4, 0.6])
+    self.assertIsInstance(sparse, list)
+    expected_sparse = list(sparse)
+    expected_dense1 = combiner.extract_output(dense1)
+    expected_dense2 = combiner.extract_output(dense2)
+
+    merged = combiner.merge_accumulators([sparse, dense1, dense2])
+    self.assertLen(list(combiner.extract_output(merged).values())[0], 6)
+    self.assertEqual(expected_sparse, sparse)
+    self.assertEqual(expected_dense1, combiner.extract_output(dense1))
+    self.assertEqual(expected_dense2, combiner.extract_output(dense2))
+
+    # A dense first accumulator may be modified, but not the others.
+    combiner.merge_accumulators([dense1, dense2, sparse])
+    self.assertEqual(expected_sparse, sparse)
+    self.assertEqual(expected_dense2, combiner.extract_output(dense2))
+
+  def testCalibrationHistogramWithWeightedInputs(self):
+    examples = []
+    for label, prediction, example_weight in [(0.0, 0.2, 1.0), (1.0, 0.8, 2.0),
+                                              (0.0, 0.5, 3.0), (1.0, 0.5, 4.0)]:
+      examples.append(
+          metric_util.to_standard_metric_inputs({
+              'labels': np.array([label]),
+              'predictions': np.array([prediction]),
+              'example_weights': np.array([example_weight])
+          }))
+    weights = [2, 0, 1, 3]
+
+    for dense in (False, True):
+      eval_config = config_pb2.EvalConfig()
+      eval_config.options.dense_calibration_histograms.value = dense
+      combiner = calibration_histogram.calibration_histogram(
+          num_buckets=10, eval_config=eval_config,
+          example_weighted=True)[0].combiner
+      got = combiner.add_weighted_inputs(combiner.create_accumulator(),
+                                         examples, weights)
+      expected = combiner.add_inputs(combiner.create_accumulator(), [
+          example for example, weight in zip(examples, weights)
+          for _ in range(weight)
+      ])
+      got_histogram = list(combiner.extract_output(got).values())[0]
+      expected_histogram = list(combiner.extract_output(expected).values())[0]
+      self.assertLen(got_histogram, 2)
+      self.assertLen(got_histogram, len(expected_histogram))
+      for got_bucket, expected_bucket in zip(got_histogram, expected_histogram):
+        self.assertSequenceAlmostEqual(expected_bucket, got_bucket)
+
   def testRebin(self):
     # [Bucket(0, -1, -0.01), Bucket(1, 0, 0) ... Bucket(101, 101, 1.01)]
     histogram = [calibration_histogram.Bucket(0, -1, -.01, 1.0)]
@@ -16,10 +16,12 @@
 import collections
 import importlib
 import json
+import pickle
 import re
 
-from typing import Any, Dict, FrozenSet, Iterator, Iterable, List, NamedTuple, Optional, Type, Union, Tuple
+from typing import Any, Dict, FrozenSet, Iterator, Iterable, List, NamedTuple, Optional, Sequence, Type, Union, Tuple
 
+from absl import logging
 import tensorflow as tf
 from tensorflow_model_analysis.metrics import aggregation
 from tensorflow_model_analysis.metrics import binary_confusion_matrices
@@ -34,6 +36,7 @@ from tensorflow_model_analysis.metrics import multi_class_confusion_matrix_plot
 from tensorflow_model_analysis.metrics import tf_metric_wrapper
 from tensorflow_model_analysis.metrics import weighted_example_count
 from tensorflow_model_analysis.proto import config_pb2
+from tensorflow_model_analysis.utils import beam_util
 from tensorflow_model_analysis.utils import model_util
 from tensorflow_metadata.proto.v0 import schema_pb2
 
@@ -787,6 +790,130 @@ def to_computations(
   return computations
 
 
+class _AliasedOutputsCombineFn(beam_util.DelegatingCombineFn):
+  """CombineFn that copies the outputs of a combiner to additional keys."""
+
+  def __init__(self, combine_fn: Any,
+               aliases: Dict[metric_types.MetricKey, metric_types.MetricKey]):
+    super().__init__(combine_fn)
+    self._aliases = aliases
+
+  def add_weighted_inputs(self, accumulator: Any, elements: Sequence[Any],
+                          weights: Sequence[int]) -> Any:
+    return beam_util.add_weighted_inputs(self._combine_fn, accumulator,
+                                         elements, weights)
+
+  def extract_output(self, accumulator: Any) -> Dict[metric_types.MetricKey,
+                                                     Any]:
+    result = dict(self._combine_fn.extract_output(accumulator))
+    for alias, key in self._aliases.items():
+      if key in result:
+        result[alias] = result[key]
+    return result
+
+
+def _canonical_value(value: Any, keys: List[metric_types.MetricKey]) -> Any:
+  """Replaces the names of the computation's keys with positional names."""
+  if isinstance(value, metric_types.MetricKey):
+    if value in keys:
+      return value._replace(name='__computation_key_{}__'.format(
+          keys.index(value)))
+    return value
+  if (isinstance(value, (list, tuple)) and value and
+      all(isinstance(v, metric_types.MetricKey) for v in value)):
+    return type(value)(_canonical_value(v, keys) for v in value)
+  return value
+
+
+def _canonical_state(obj: Any, keys: List[metric_types.MetricKey]) -> Any:
+  """Returns the state of obj with computation key names canonicalized."""
+  if obj is None:
+    return None
+  return (type(obj).__module__, type(obj).__qualname__,
+          [(k, _canonical_value(v, keys)) for k, v in sorted(vars(obj).items())])
+
+
+def _computation_config(
+    computation: metric_types.MetricComputation) -> Optional[bytes]:
+  """Returns the effective configuration of a computation (None if unknown).
+
+  Two computations with the same effective configuration only differ in the
+  names of the keys they output and can therefore share a single combiner. Only
+  key names are ignored: all other key fields (model name, output name, sub key,
+  etc) and all other combiner and preprocessor state must be identical.
+
+  Args:
+    computation: Metric computation.
+  """
+  keys = list(computation.keys or [])
+  canonical_keys = tuple(_canonical_value(k, keys) for k in keys)
+  try:
+    return pickle.dumps(
+        (canonical_keys, _canonical_state(computation.preprocessor, keys),
+         _canonical_state(computation.combiner, keys)))
+  except Exception:  # pylint: disable=broad-except
+    # State that is not picklable (e.g. lambdas) or has no __dict__ cannot be
+    # compared, so the computation is left as is.
+    return None
+
+
+def merge_equivalent_computations(
+    computations: metric_types.MetricComputations
+) -> Tuple[metric_types.MetricComputations, Dict[metric_types.MetricKey,
+                                                 metric_types.MetricKey]]:
+  """Merges metric computations that share the same effective configuration.
+
+  Different metrics often end up creating identical combiners under different
+  names (e.g. calibration histograms with the same bucket settings). This
+  planning pass runs each unique combiner once and copies its outputs to the
+  keys of every computation that was merged into it. Derived and cross slice
+  computations are passed through unchanged. The order of the computations is
+  preserved with merged computations taking the position of the first
+  occurrence so that no computation is moved ahead of its dependencies.
+
+  Args:
+    computations: Metric computations.
+
+  Returns:
+    Tuple of (merged computations, dict mapping each merged key to the key of
+    the computation whose output it is copied from).
+  """
+  result = []
+  # Dict[bytes, Tuple[int, MetricComputation, Dict[MetricKey, MetricKey]]]
+  unique_computations = {}
+  for computation in computations:
+    config = None
+    if isinstance(computation, metric_types.MetricComputation):
+      config = _computation_config(computation)
+    if config is None:
+      result.append(computation)
+      continue
+    if config not in unique_computations:
+      unique_computations[config] = (len(result), computation, {})
+      result.append(computation)
+      continue
+    _, unique_computation, aliases = unique_computations[config]
+    for alias, key in zip(computation.keys, unique_computation.keys):
+      if alias not in unique_computation.keys:
+        aliases[alias] = key
+  merged_keys = {}
+  for index, computation, aliases in unique_computations.values():
+    if not aliases:
+      continue
+    result[index] = metric_types.MetricComputation(
+        keys=list(computation.keys) + list(aliases),
+        preprocessor=computation.preprocessor,
+        combiner=_AliasedOutputsCombineFn(computation.combiner, aliases))
+    merged_keys.update(aliases)
+  if merged_keys:
+    logging.info(
+        'Merged %d metric keys into computations with equivalent '
+        'configurations: %s',
+        len(merged_keys), ', '.join('{} -> {}'.format(alias, key)
+                                    for alias, key in merged_keys.items()))
+  return result, merged_keys
+
+
 def _process_tf_metrics_specs(
     tf_metrics_specs: List[config_pb2.MetricsSpec],
     per_tf_spec_metric_instances: List[List[_TFMetricOrLoss]],
@@ -14,9 +14,13 @@
 """Tests for metric specs."""
 
 import json
+from unittest import mock
+
 import tensorflow as tf
 from tensorflow_model_analysis.metrics import calibration
+from tensorflow_model_analysis.metrics import calibration_histogram
 from tensorflow_model_analysis.metrics import confusion_matrix_metrics
+from tensorflow_model_analysis.metrics import example_count
 from tensorflow_model_analysis.metrics import metric_specs
 from tensorflow_model_analysis.metrics import metric_types
 from tensorflow_model_analysis.proto import config_pb2
@@ -623,6 +627,68 @@ class MetricSpecsTest(tf.test.TestCase):
     # for non-aggregated metrics, and one for metrics associated with class 1)
     self.assertLen(computations, 3)
 
+  def testMergeEquivalentComputations(self):
+    eval_config = config_pb2.EvalConfig()
+    computations = (
+        calibration_histogram.calibration_histogram(
+            num_buckets=10, name='hist_a', eval_config=eval_config) +
+        calibration_histogram.calibration_histogram(
+            num_buckets=10, name='hist_b', eval_config=eval_config) +
+        calibration_histogram.calibration_histogram(
+            num_buckets=20, name='hist_c', eval_config=eval_config) +
+        example_count.example_count(name='count_a') +
+        example_count.example_count(name='count_b') +
+        example_count.example_count(name='count_a') +
+        example_count.example_count(name='count_c', model_names=['model']))
+
+    merged, merged_keys = metric_specs.merge_equivalent_computations(
+        computations)
+
+    self.assertLen(merged, 4)
+    self.assertEqual(
+        merged_keys, {
+            metric_types.MetricKey(name='hist_b'):
+                metric_types.MetricKey(name='hist_a'),
+            metric_types.MetricKey(name='count_b'):
+                metric_types.MetricKey(name='count_a'),
+        })
+    self.assertEqual([
+        metric_types.MetricKey(name='hist_a'),
+        metric_types.MetricKey(name='hist_b')
+    ], merged[0].keys)
+    self.assertEqual([metric_types.MetricKey(name='hist_c')], merged[1].keys)
+    self.assertEqual([
+        metric_types.MetricKey(name='count_a'),
+        metric_types.MetricKey(name='count_b')
+    ], merged[2].keys)
+    self.assertEqual([metric_types.MetricKey(name='count_c', model_name='model')
+                     ], merged[3].keys)
+
+    combiner = merged[2].combiner
+    self.assertEqual(
+        {
+            metric_types.MetricKey(name='count_a'): 0.0,
+            metric_types.MetricKey(name='count_b'): 0.0
+        }, combiner.extract_output(combiner.create_accumulator()))
+
+  def testMergedComputationsUseWrappedAddInputs(self):
+    computations = (
+        example_count.example_count(name='count_a') +
+        example_count.example_count(name='count_b'))
+    merged, _ = metric_specs.merge_equivalent_computations(computations)
+    self.assertLen(merged, 1)
+    combiner = merged[0].combiner
+    wrapped_combiner = combiner._combine_fn  # pylint: disable=protected-access
+    accumulator = combiner.create_accumulator()
+    elements = [metric_types.StandardMetricInputs()]
+    with mock.patch.object(
+        wrapped_combiner, 'add_inputs',
+        return_value=accumulator) as mock_add_inputs, mock.patch.object(
+            wrapped_combiner, 'add_input') as mock_add_input:
+      self.assertIs(accumulator, combiner.add_inputs(accumulator, elements))
+    mock_add_inputs.assert_called_once_with(accumulator, elements)
+    mock_add_input.assert_not_called()
+
 
 if __name__ == '__main__':
   tf.test.main()
@@ -741,8 +741,36 @@ class StandardMetricInputs(util.StandardExtracts):
 
   StandardMetricInputs is a wrapper around Extracts where only the extracts keys
   used by one or more ExtractsPreprocessors will be present.
+
+  The labels, predictions, and example weights prepared by
+  metric_util.to_label_prediction_example_weight are cached on the inputs so
+  that computations sharing the same inputs only prepare them once. Cached
+  values are only reused while the (possibly nested) label, prediction, and
+  example weight values they were prepared from are the same objects. Each
+  caller gets its own copy of the cached arrays. The cache is not serialized.
   """
 
+  def __init__(self, extracts: Optional[types.Extracts] = None, **kwargs):
+    super().__init__(extracts, **kwargs)
+    self._label_prediction_example_weight_cache = {}
+
+  def __getstate__(self) -> Dict[str, Any]:
+    state = self.__dict__.copy()
+    state.pop('_label_prediction_example_weight_cache', None)
+    return state
+
+  def __setstate__(self, state: Dict[str, Any]):
+    self.__dict__.update(state)
+    self._label_prediction_example_weight_cache = {}
+
+  def __setitem__(self, key, value):
+    self._label_prediction_example_weight_cache = {}
+    super().__setitem__(key, value)
+
+  def __delitem__(self, key):
+    self._label_prediction_example_weight_cache = {}
+    super().__delitem__(key)
+
   @property
   def label(self) -> Optional[types.TensorValueMaybeMultiLevelDict]:
     """Same as labels (DEPRECATED - use labels)."""
@@ -372,6 +372,86 @@ def to_label_prediction_example_weight(
   Yields:
     Tuple of (label, prediction, example_weight).
   """
+  # The prepared values are cached on StandardMetricInputs so that they can be
+  # shared by all of the computations that use the same inputs.
+  cache = getattr(inputs, '_label_prediction_example_weight_cache', None)
+  if cache is None:
+    yield from _to_label_prediction_example_weight(
+        inputs, eval_config, model_name, output_name, sub_key,
+        aggregation_type, class_weights, example_weighted, fractional_labels,
+        flatten, squeeze, allow_none, require_single_example_weight)
+    return
+  cache_key = (_get_prediction_and_label_keys(eval_config, model_name),
+               model_name, output_name, sub_key, aggregation_type,
+               tuple(sorted(class_weights.items())) if class_weights else None,
+               example_weighted, fractional_labels, flatten, squeeze,
+               allow_none, require_single_example_weight)
+  # The cached values are only used if they were prepared from the same label,
+  # prediction, and example weight objects (nested values may have been
+  # replaced since they were prepared).
+  source_values = (
+      _leaf_values(inputs.label) + _leaf_values(inputs.prediction) +
+      _leaf_values(inputs.example_weight))
+  cached = cache.get(cache_key)
+  if cached is not None and _are_same_objects(cached[0], source_values):
+    results = cached[1]
+  else:
+    results = tuple(
+        tuple(values) for values in _to_label_prediction_example_weight(
+            inputs, eval_config, model_name, output_name, sub_key,
+            aggregation_type, class_weights, example_weighted,
+            fractional_labels, flatten, squeeze, allow_none,
+            require_single_example_weight))
+    cache[cache_key] = (source_values, results)
+  # The cached arrays are shared by all of the callers, so each caller gets its
+  # own copy that it is free to modify.
+  for values in results:
+    yield tuple(v.copy() if isinstance(v, np.ndarray) else v for v in values)
+
+
+def _leaf_values(value: Any) -> List[Any]:
+  """Returns the leaf values of a (possibly nested) dict."""
+  if isinstance(value, Mapping):
+    return [leaf for v in value.values() for leaf in _leaf_values(v)]
+  return [value]
+
+
+def _are_same_objects(values: List[Any], other_values: List[Any]) -> bool:
+  """Returns true if values and other_values contain the same objects."""
+  return len(values) == len(other_values) and all(
+      v is o for v, o in zip(values, other_values))
+
+
+def _get_prediction_and_label_keys(
+    eval_config: Optional[config_pb2.EvalConfig],
+    model_name: str) -> Tuple[str, str]:
+  """Returns the prediction and label keys from the model's ModelSpec."""
+  if eval_config and eval_config.model_specs:
+    for spec in eval_config.model_specs:
+      # To maintain consistency between settings where single models are used,
+      # always use '' as the model name regardless of whether a name is passed
+      spec_name = spec.name if len(eval_config.model_specs) > 1 else ''
+      if spec_name == model_name:
+        return spec.prediction_key, spec.label_key
+  return '', ''
+
+
+def _to_label_prediction_example_weight(
+    inputs: metric_types.StandardMetricInputs,
+    eval_config: Optional[config_pb2.EvalConfig] = None,
+    model_name: str = '',
+    output_name: str = '',
+    sub_key: Optional[metric_types.SubKey] = None,
+    aggregation_type: Optional[metric_types.AggregationType] = None,
+    class_weights: Optional[Dict[int, float]] = None,
+    example_weighted: bool = False,
+    fractional_labels: bool = False,
+    flatten: bool = True,
+    squeeze: bool = True,
+    allow_none: bool = False,
+    require_single_example_weight: bool = False
+) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+  """Implementation of to_label_prediction_example_weight (without caching)."""
 
   def fn_call_str():
     return (f'to_label_prediction_example_weight(inputs={inputs}, '
@@ -390,17 +470,8 @@ def to_label_prediction_example_weight(
     return value
 
   try:
-    prediction_key = ''
-    label_key = ''
-    if eval_config and eval_config.model_specs:
-      for spec in eval_config.model_specs:
-        # To maintain consistency between settings where single models are used,
-        # always use '' as the model name regardless of whether a name is passed
-        spec_name = spec.name if len(eval_config.model_specs) > 1 else ''
-        if spec_name == model_name:
-          prediction_key = spec.prediction_key
-          label_key = spec.label_key
-          break
+    prediction_key, label_key = _get_prediction_and_label_keys(
+        eval_config, model_name)
 
     label = inputs.label
     if label_key:
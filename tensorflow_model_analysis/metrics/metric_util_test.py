@@ -13,6 +13,9 @@
 # limitations under the License.
 """Tests for metric utils."""
 
+import pickle
+from unittest import mock
+
 import numpy as np
 import tensorflow as tf
 from tensorflow_model_analysis import types
@@ -77,6 +80,82 @@ class UtilTest(tf.test.TestCase):
     self.assertAllClose(got_pred, np.array([0, 0.5, 0.3, 0.9]))
     self.assertAllClose(got_example_weight, np.array([1.0]))
 
+  def testStandardMetricInputsCachesPreparedValues(self):
+    example = metric_types.StandardMetricInputs(
+        labels={'output_name': np.array([2])},
+        predictions={'output_name': np.array([0, 0.5, 0.3, 0.9])},
+        example_weights={'output_name': np.array([1.0])})
+    with mock.patch.object(
+        metric_util,
+        '_to_label_prediction_example_weight',
+        wraps=metric_util._to_label_prediction_example_weight) as prepare:
+      got = list(
+          metric_util.to_label_prediction_example_weight(
+              example, output_name='output_name', flatten=False))
+      got_again = list(
+          metric_util.to_label_prediction_example_weight(
+              example, output_name='output_name', flatten=False))
+      self.assertEqual(1, prepare.call_count)
+      self.assertLen(got, 1)
+      for got_value, got_again_value in zip(got[0], got_again[0]):
+        self.assertAllClose(got_value, got_again_value)
+
+      # Each caller gets its own copy of the values, which can be modified in
+      # place without affecting the inputs or later callers.
+      got_label, got_prediction, _ = got[0]
+      got_prediction[0] = 1.0
+      got_label += 1
+      self.assertAllClose(example['predictions']['output_name'],
+                          np.array([0, 0.5, 0.3, 0.9]))
+      got_label, got_prediction, _ = next(
+          metric_util.to_label_prediction_example_weight(
+              example, output_name='output_name', flatten=False))
+      self.assertAllClose(got_label, np.array([2]))
+      self.assertAllClose(got_prediction, np.array([0, 0.5, 0.3, 0.9]))
+      self.assertEqual(1, prepare.call_count)
+
+      # Different arguments are cached separately.
+      self.assertLen(
+          list(
+              metric_util.to_label_prediction_example_weight(
+                  example, output_name='output_name')), 4)
+      self.assertEqual(2, prepare.call_count)
+
+    # Modifying the inputs clears the cache.
+    example['labels'] = {'output_name': np.array([1])}
+    got_label, _, _ = next(
+        metric_util.to_label_prediction_example_weight(
+            example, output_name='output_name', flatten=False))
+    self.assertAllClose(got_label, np.array([1]))
+
+    # Replacing nested values also invalidates the cached values.
+    example['predictions']['output_name'] = np.array([0.1, 0.2, 0.3, 0.4])
+    example['example_weights']['output_name'] = np.array([2.0])
+    _, got_prediction, got_example_weight = next(
+        metric_util.to_label_prediction_example_weight(
+            example,
+            output_name='output_name',
+            flatten=False,
+            example_weighted=True))
+    self.assertAllClose(got_prediction, np.array([0.1, 0.2, 0.3, 0.4]))
+    self.assertAllClose(got_example_weight, np.array([2.0]))
+    example['example_weights']['output_name'] = np.array([3.0])
+    _, _, got_example_weight = next(
+        metric_util.to_label_prediction_example_weight(
+            example,
+            output_name='output_name',
+            flatten=False,
+            example_weighted=True))
+    self.assertAllClose(got_example_weight, np.array([3.0]))
+
+    # The cache is not serialized.
+    unpickled = pickle.loads(pickle.dumps(example))
+    self.assertEqual({}, unpickled._label_prediction_example_weight_cache)  # pylint: disable=protected-access
+    got_label, _, _ = next(
+        metric_util.to_label_prediction_example_weight(
+            unpickled, output_name='output_name', flatten=False))
+    self.assertAllClose(got_label, np.array([1]))
+
   def testStandardMetricInputsToNumpyWithoutFlattenAndWithSqueeze(self):
     example = metric_types.StandardMetricInputs(
         labels={'output_name': np.array([[2]])},
@@ -17,12 +17,15 @@ Use this library for generating slices from a specification
 (List[SingleSliceSpec]) and input features.
 """
 
+import functools
+import hashlib
 import itertools
 
-from typing import Any, Callable, Dict, Generator, Iterable, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, FrozenSet, Generator, Iterable, List, NamedTuple, Optional, Tuple, Union
 
 import apache_beam as beam
 import numpy as np
+import pyarrow as pa
 import tensorflow as tf
 from tensorflow_model_analysis import constants
 from tensorflow_model_analysis import types
@@ -51,6 +54,17 @@ OVERALL_SLICE_NAME = 'Overall'
 # The slice key for the slice that includes all of the data.
 OVERALL_SLICE_KEY = ()
 
+# Max number of slice key fingerprints cached per process.
+_SLICE_KEY_FINGERPRINT_CACHE_SIZE = 100000
+
+# Max number of compiled slice spec matchers cached per process.
+_SLICE_SPEC_MATCHER_CACHE_SIZE = 1000
+
+# Column name used to mark keys that represent all the slices rolled up from a
+# given finest slice key (see SliceRollupPlan). Real slice keys only contain
+# (column, value) tuples so they never compare equal to a rollup key.
+_SLICE_ROLLUP_KEY_MARKER = '__slice_rollup__'
+
 
 class SingleSliceSpec:
   """Specification for a single slice.
@@ -245,6 +259,179 @@ class SingleSliceSpec:
     for column_part in itertools.product(*column_matches):
       yield tuple(sorted(self._value_matches + list(column_part)))
 
+  def generate_slices_for_record_batch(
+      self,
+      record_batch: pa.RecordBatch,
+      encoded_columns: Optional[Dict[
+          str, Optional['_DictionaryEncodedListColumn']]] = None
+  ) -> Optional[List[List[SliceKeyType]]]:
+    """Generates the slices that match this specification for each row.
+
+    This is the batched equivalent of generate_slices for features stored as
+    list columns of a RecordBatch. The columns are dictionary encoded so that
+    value filters are evaluated once per distinct value (and then applied to
+    all rows as a mask) and slice keys are only built once per distinct
+    combination of values. Rows with the same slice key share the same tuple.
+
+    Args:
+      record_batch: Record batch whose columns contain the features.
+      encoded_columns: Optional dictionary encoded columns of record_batch keyed
+        by column name (None for columns that are not supported). Columns that
+        are not in the dict yet are encoded and added to it, so passing the
+        same dict for multiple specs encodes each column once per batch.
+
+    Returns:
+      A list with the slice keys for each row of the record batch (in the same
+      format as generate_slices) or None if any of the keys used by this
+      specification are not list columns of supported types in the batch.
+    """
+    num_rows = record_batch.num_rows
+    if encoded_columns is None:
+      encoded_columns = {}
+    columns = {}
+    for key in sorted(self._columns | {k for k, _ in self._features}):
+      if key not in encoded_columns:
+        encoded_columns[key] = _DictionaryEncodedListColumn.create(
+            record_batch, key)
+      column = encoded_columns[key]
+      if column is None:
+        return None
+      columns[key] = column
+
+    # Rows that have all the values required by the value matches.
+    mask = np.ones(num_rows, dtype=bool)
+    for key, value in self._features:
+      column = columns[key]
+      mask &= column.rows_with_any(
+          np.array([
+              _is_value_match(value, v) for v in column.dictionary
+          ], dtype=bool))
+    if not self._columns:
+      slice_key = tuple(self._value_matches)
+      return [[slice_key] if m else [] for m in mask]
+
+    slice_columns = [(key, columns[key]) for key in sorted(self._columns)]
+    for _, column in slice_columns:
+      mask &= column.lengths > 0
+    rows = np.flatnonzero(mask)
+    result = [[] for _ in range(num_rows)]
+    if not rows.size:
+      return result
+    key_cache = {}
+
+    def get_slice_key(codes):
+      if codes not in key_cache:
+        key_cache[codes] = tuple(
+            sorted(self._value_matches + [
+                (key, column.decoded_value(key, code))
+                for (key, column), code in zip(slice_columns, codes)
+            ]))
+      return key_cache[codes]
+
+    if all(np.all(column.lengths[rows] == 1) for _, column in slice_columns):
+      # Each row has a single value per column, so there is a single slice per
+      # row which is keyed by the distinct combinations of value codes.
+      row_codes = np.stack(
+          [column.codes[column.starts[rows]] for _, column in slice_columns])
+      unique_codes, inverse = np.unique(
+          row_codes, axis=1, return_inverse=True)
+      slice_keys = [
+          get_slice_key(tuple(codes)) for codes in unique_codes.T.tolist()
+      ]
+      for row, index in zip(rows.tolist(), inverse.reshape(-1).tolist()):
+        result[row].append(slice_keys[index])
+      return result
+
+    for row in rows.tolist():
+      row_codes = [
+          sorted(set(column.codes[column.starts[row]:column.starts[row] +
+                                  column.lengths[row]].tolist()))
+          for _, column in slice_columns
+      ]
+      result[row].extend(
+          get_slice_key(codes) for codes in itertools.product(*row_codes))
+    return result
+
+
+def _is_value_match(value: FeatureValueType, feature_value: Any) -> bool:
+  """Returns True if the feature value matches a SingleSliceSpec value."""
+  # Must be kept consistent with the value matches in generate_slices.
+  if isinstance(value, str):
+    return feature_value == value or feature_value == value.encode()
+  return feature_value == value or feature_value == str(value)
+
+
+class _DictionaryEncodedListColumn:
+  """List column of a RecordBatch with its flattened values dictionary encoded.
+
+  Attributes:
+    dictionary: The distinct values of the column (as python values).
+    codes: The index into the dictionary for each flattened value.
+    starts: The start of the values of each row in codes.
+    lengths: The number of values of each row (0 for null rows).
+  """
+
+  def __init__(self, dictionary: List[Any], codes: np.ndarray,
+               starts: np.ndarray, lengths: np.ndarray):
+    self.dictionary = dictionary
+    self.codes = codes
+    self.starts = starts
+    self.lengths = lengths
+    self._decoded = {}
+
+  @classmethod
+  def create(cls, record_batch: pa.RecordBatch,
+             name: str) -> Optional['_DictionaryEncodedListColumn']:
+    """Returns the encoded column or None if it is missing or not supported."""
+    index = record_batch.schema.get_field_index(name)
+    if index < 0 or name == constants.ARROW_INPUT_COLUMN:
+      return None
+    column = record_batch.column(index)
+    column_type = column.type
+    if not (pa.types.is_list(column_type) or
+            pa.types.is_large_list(column_type)):
+      return None
+    value_type = column_type.value_type
+    if not (pa.types.is_integer(value_type) or
+            pa.types.is_floating(value_type) or
+            pa.types.is_binary(value_type) or
+            pa.types.is_large_binary(value_type) or
+            pa.types.is_string(value_type) or
+            pa.types.is_large_string(value_type)):
+      return None
+    values = column.flatten()
+    if values.null_count:
+      return None
+    offsets = np.asarray(column.offsets)
+    starts = offsets[:-1] - offsets[0]
+    lengths = np.diff(offsets)
+    if column.null_count:
+      lengths = np.where(
+          column.is_null().to_numpy(zero_copy_only=False), 0, lengths)
+    encoded = values.dictionary_encode()
+    return cls(encoded.dictionary.to_pylist(),
+               encoded.indices.to_numpy(zero_copy_only=False), starts, lengths)
+
+  def rows_with_any(self, value_mask: np.ndarray) -> np.ndarray:
+    """Returns a mask of the rows that have any value in the value mask."""
+    rows = np.repeat(np.arange(len(self.lengths)), self.lengths)
+    result = np.zeros(len(self.lengths), dtype=bool)
+    result[rows[value_mask[self.codes]]] = True
+    return result
+
+  def decoded_value(self, name: str, code: int) -> FeatureValueType:
+    """Returns the value for the code (with bytes decoded as text)."""
+    if code not in self._decoded:
+      value = self.dictionary[code]
+      if isinstance(value, bytes):
+        try:
+          value = tf.compat.as_text(value)
+        except UnicodeDecodeError as e:
+          raise ValueError('Found non-UTF8 feature value {} in '
+                           'column "{}"'.format(value, name)) from e
+      self._decoded[code] = value
+    return self._decoded[code]
+
 
 def serialize_slice_key(
     slice_key: SliceKeyType) -> metrics_for_slice_pb2.SliceKey:
@@ -368,6 +555,35 @@ def get_slices_for_features_dicts(
     yield from single_slice_spec.generate_slices(accessor)
 
 
+def get_slices_for_record_batch(
+    record_batch: pa.RecordBatch, slice_spec: List[SingleSliceSpec]
+) -> Tuple[List[List[SliceKeyType]], List[SingleSliceSpec]]:
+  """Generates the slice keys for each row of a record batch.
+
+  Args:
+    record_batch: Record batch whose list columns contain the features.
+    slice_spec: slice specification.
+
+  Returns:
+    Tuple of (the slice keys for each row, the slice specs that could not be
+    generated from the record batch). The remaining slice specs must be
+    generated per example (e.g. using get_slices_for_features_dicts).
+  """
+  slice_keys = [[] for _ in range(record_batch.num_rows)]
+  remaining_slice_spec = []
+  # Columns are encoded once per batch and shared by all the slice specs.
+  encoded_columns = {}
+  for single_slice_spec in slice_spec:
+    spec_slice_keys = single_slice_spec.generate_slices_for_record_batch(
+        record_batch, encoded_columns)
+    if spec_slice_keys is None:
+      remaining_slice_spec.append(single_slice_spec)
+      continue
+    for row_slice_keys, row_spec_slice_keys in zip(slice_keys, spec_slice_keys):
+      row_slice_keys.extend(row_spec_slice_keys)
+  return slice_keys, remaining_slice_spec
+
+
 def stringify_slice_key(slice_key: SliceKeyType) -> str:
   """Stringifies a slice key.
 
@@ -418,19 +634,99 @@ def stringify_slice_key(slice_key: SliceKeyType) -> str:
           separator.join([u'{}'.format(value) for value in values]))
 
 
+class SliceSpecMatcher:
+  """Compiled matcher for checking slice keys against a set of slice specs.
+
+  A slice key matches if any of the slice specs is applicable to it (see
+  SingleSliceSpec.is_slice_applicable). The feature values of the specs are
+  normalized once and the specs are indexed by the set of columns they cover,
+  so each check only normalizes the values of the slice key once and compares
+  them against the specs with the same columns using hash lookups.
+  """
+
+  def __init__(self, slice_specs: Iterable[Union[SingleSliceSpec,
+                                                 config_pb2.SlicingSpec]]):
+    # Dict[FrozenSet[str], List[Dict[str, FeatureValueType]]] containing the
+    # feature values of the specs keyed by all the columns of the spec.
+    self._specs_by_columns = {}
+    self._slice_specs = []
+    for slice_spec in slice_specs:
+      if isinstance(slice_spec, config_pb2.SlicingSpec):
+        slice_spec = SingleSliceSpec(spec=slice_spec)
+      self._slice_specs.append(slice_spec)
+      # pylint: disable=protected-access
+      columns = slice_spec._columns | {k for k, _ in slice_spec._features}
+      self._specs_by_columns.setdefault(columns, []).append(
+          dict(slice_spec._features))
+      # pylint: enable=protected-access
+
+  def matches(self, slice_key: SliceKeyType) -> bool:
+    """Returns True if any of the slice specs is applicable to the slice key."""
+    if not self._specs_by_columns:
+      return False
+    values = {}
+    for singleton_slice_key in slice_key:
+      if len(singleton_slice_key) != 2 or singleton_slice_key[0] in values:
+        # Keys with repeated columns (or of an unknown format) are not indexed.
+        return any(
+            spec.is_slice_applicable(slice_key) for spec in self._slice_specs)
+      values[singleton_slice_key[0]] = _to_type(singleton_slice_key[1])
+    for feature_values in self._specs_by_columns.get(frozenset(values), []):
+      if all(values[k] == v for k, v in feature_values.items()):
+        return True
+    return False
+
+
+class CrossSliceSpecMatcher:
+  """Compiled matcher for checking cross slice keys against a CrossSlicingSpec."""
+
+  def __init__(self, cross_slicing_spec: config_pb2.CrossSlicingSpec):
+    self._baseline_matcher = SliceSpecMatcher([cross_slicing_spec.baseline_spec])
+    self._comparison_matcher = SliceSpecMatcher(
+        cross_slicing_spec.slicing_specs)
+
+  def matches(self, cross_slice_key: CrossSliceKeyType) -> bool:
+    """Returns True if the cross slicing spec is applicable to the key."""
+    baseline_slice_key, comparison_slice_key = cross_slice_key
+    return (self._baseline_matcher.matches(baseline_slice_key) and
+            self._comparison_matcher.matches(comparison_slice_key))
+
+
+@functools.lru_cache(maxsize=_SLICE_SPEC_MATCHER_CACHE_SIZE)
+def _get_cached_slice_spec_matcher(
+    serialized_specs: Tuple[bytes, ...]) -> SliceSpecMatcher:
+  return SliceSpecMatcher(
+      config_pb2.SlicingSpec.FromString(s) for s in serialized_specs)
+
+
+@functools.lru_cache(maxsize=_SLICE_SPEC_MATCHER_CACHE_SIZE)
+def _get_cached_cross_slice_spec_matcher(
+    serialized_spec: bytes) -> CrossSliceSpecMatcher:
+  return CrossSliceSpecMatcher(
+      config_pb2.CrossSlicingSpec.FromString(serialized_spec))
+
+
+def get_slice_spec_matcher(
+    slicing_specs: Iterable[config_pb2.SlicingSpec]) -> SliceSpecMatcher:
+  """Returns a (cached) compiled matcher for the given slicing specs."""
+  return _get_cached_slice_spec_matcher(
+      tuple(
+          spec.SerializeToString(deterministic=True) for spec in slicing_specs))
+
+
+def get_cross_slice_spec_matcher(
+    cross_slicing_spec: config_pb2.CrossSlicingSpec) -> CrossSliceSpecMatcher:
+  """Returns a (cached) compiled matcher for the given cross slicing spec."""
+  return _get_cached_cross_slice_spec_matcher(
+      cross_slicing_spec.SerializeToString(deterministic=True))
+
+
 def is_cross_slice_applicable(
     cross_slice_key: CrossSliceKeyType,
     cross_slicing_spec: config_pb2.CrossSlicingSpec) -> bool:
   """Checks if CrossSlicingSpec is applicable to the CrossSliceKeyType."""
-  baseline_slice_key, comparison_slice_key = cross_slice_key
-
-  if not SingleSliceSpec(spec=cross_slicing_spec.baseline_spec
-                        ).is_slice_applicable(baseline_slice_key):
-    return False
-  return any(
-      SingleSliceSpec(spec=comparison_slicing_spec).is_slice_applicable(
-          comparison_slice_key)
-      for comparison_slicing_spec in cross_slicing_spec.slicing_specs)
+  return get_cross_slice_spec_matcher(cross_slicing_spec).matches(
+      cross_slice_key)
 
 
 def get_slice_key_type(
@@ -499,8 +795,152 @@ def _is_multi_dim_keys(slice_keys: SliceKeyType) -> bool:
   return False
 
 
+def _unique_slice_keys(slice_keys: Any) -> Iterable[SliceKeyType]:
+  """Returns the unique slice keys stored in an (unbatched) extract."""
+  # The query based evaluator will group slices into a multi-dimentional array
+  # with an extra dimension representing the examples matching the query key.
+  # We need to flatten and dedup the slice keys.
+  if _is_multi_dim_keys(slice_keys):
+    arr = np.array(slice_keys)
+    unique_keys = set(arr.flatten())
+    if not unique_keys and arr.shape:
+      # If only the empty overall slice is in array, it is removed by flatten
+      unique_keys.add(())
+    return unique_keys
+  return slice_keys
+
+
+def _fingerprint_value(
+    value: FeatureValueType) -> Union[str, bytes, int, float]:
+  """Normalizes value so that values that compare equal fingerprint equally."""
+  if isinstance(value, bytes):
+    return bytes(value)
+  if isinstance(value, str):
+    return str(value)
+  if isinstance(value, (int, np.integer)):
+    return int(value)
+  value = float(value)
+  if value.is_integer():
+    return int(value)
+  return value
+
+
+@functools.lru_cache(maxsize=_SLICE_KEY_FINGERPRINT_CACHE_SIZE)
+def fingerprint_slice_key(slice_key: SliceKeyType) -> int:
+  """Returns a stable signed 64-bit fingerprint of the given slice key.
+
+  The fingerprint only depends on the contents of the slice key so it can be
+  computed independently by different workers. FanoutSlices can use these
+  fingerprints in place of the slice keys to reduce the size of the keys that
+  are shuffled.
+
+  Args:
+    slice_key: Slice key to fingerprint.
+
+  Returns:
+    Signed 64-bit integer fingerprint.
+  """
+  digest = hashlib.blake2b(
+      repr(tuple((str(column), _fingerprint_value(value))
+                 for column, value in slice_key)).encode('utf-8'),
+      digest_size=8).digest()
+  return int.from_bytes(digest, byteorder='little', signed=True)
+
+
+class SliceRollupPlan(NamedTuple):
+  """Plan for computing coarse slices by merging finer slices.
+
+  Each slice generated by a column only slicing spec whose columns are a subset
+  of finest_columns is the union of the slices of the finest spec that match
+  its values, provided each example has a single value for each of the finest
+  columns. For such examples only the finest slice needs to be combined, the
+  coarser slices can be computed by merging the accumulators of the finest
+  slices afterwards.
+
+  Attributes:
+    finest_columns: Sorted columns of the finest slicing spec.
+    rollup_columns: Sorted columns of each of the slicing specs (including the
+      finest spec) that can be rolled up from the finest slices.
+  """
+  finest_columns: Tuple[str, ...]
+  rollup_columns: FrozenSet[Tuple[str, ...]]
+
+
+def get_slice_rollup_plan(
+    slice_specs: Iterable[SingleSliceSpec]) -> Optional[SliceRollupPlan]:
+  """Returns a plan for rolling up slices or None if nothing can be rolled up.
+
+  Only slicing specs with feature keys (and no feature values) are considered.
+  The finest spec is the one with the most other specs whose columns are a
+  subset of its columns.
+
+  Args:
+    slice_specs: Slice specs used to generate the slice keys.
+  """
+  # pylint: disable=protected-access
+  column_sets = set(
+      spec._columns for spec in slice_specs if not spec._features)
+  # pylint: enable=protected-access
+  best_columns = None
+  best_subsets = []
+  # Sort for determinism between workers.
+  for columns in sorted(column_sets, key=lambda c: (-len(c), sorted(c))):
+    subsets = [c for c in column_sets if c <= columns]
+    if len(subsets) > len(best_subsets):
+      best_columns, best_subsets = columns, subsets
+  if len(best_subsets) < 2:
+    return None
+  return SliceRollupPlan(
+      finest_columns=tuple(sorted(best_columns)),
+      rollup_columns=frozenset(tuple(sorted(c)) for c in best_subsets))
+
+
+def rollup_slice_keys(slice_keys: Iterable[SliceKeyType],
+                      plan: SliceRollupPlan) -> List[Any]:
+  """Replaces the slice keys that can be rolled up with a single rollup key.
+
+  Args:
+    slice_keys: Unique slice keys for a single example.
+    plan: Rollup plan.
+
+  Returns:
+    The slice keys that are not covered by the plan plus a rollup key for the
+    example's finest slice key. If the example does not have exactly one finest
+    slice key (i.e. the finest columns are missing or multivalent), the slice
+    keys are returned as is.
+  """
+  slice_keys = list(slice_keys)
+  finest_key = None
+  result = []
+  for slice_key in slice_keys:
+    columns = tuple(column for column, _ in slice_key)
+    if columns == plan.finest_columns:
+      if finest_key is not None:
+        return slice_keys
+      finest_key = slice_key
+    if columns not in plan.rollup_columns:
+      result.append(slice_key)
+  if finest_key is None:
+    return slice_keys
+  result.append((_SLICE_ROLLUP_KEY_MARKER, finest_key))
+  return result
+
+
+def expand_rollup_slice_key(slice_key: Any,
+                            plan: SliceRollupPlan) -> List[SliceKeyType]:
+  """Returns the slice keys represented by a key output by rollup_slice_keys."""
+  if not slice_key or slice_key[0] != _SLICE_ROLLUP_KEY_MARKER:
+    return [slice_key]
+  finest_key = slice_key[1]
+  return [
+      tuple(k for k in finest_key if k[0] in columns)
+      for columns in plan.rollup_columns
+  ]
+
+
 def slice_key_matches_slice_specs(
-    slice_key: SliceKeyType, slice_specs: Iterable[SingleSliceSpec]) -> bool:
+    slice_key: SliceKeyType, slice_specs: Union[Iterable[SingleSliceSpec],
+                                                SliceSpecMatcher]) -> bool:
   """Checks whether a slice key matches any slice spec.
 
   In this setting, a slice key matches a slice spec if it could have been
@@ -508,12 +948,15 @@ def slice_key_matches_slice_specs(
 
   Args:
     slice_key: The slice key to check for applicability against slice specs.
-    slice_specs: Slice specs against which to check applicability of a slice
-      key.
+    slice_specs: Slice specs (or a SliceSpecMatcher compiled from the specs)
+      against which to check applicability of a slice key. When checking many
+      slice keys against the same specs, a SliceSpecMatcher should be used.
 
   Returns:
     True if the slice_key matches any slice specs, False otherwise.
   """
+  if isinstance(slice_specs, SliceSpecMatcher):
+    return slice_specs.matches(slice_key)
   return any(
       slice_spec.is_slice_applicable(slice_key) for slice_spec in slice_specs)
 
@@ -523,12 +966,22 @@ def slice_key_matches_slice_specs(
 class _FanoutSlicesDoFn(beam.DoFn):
   """A DoFn that performs per-slice key fanout prior to computing aggregates."""
 
-  def __init__(self, key_filter_fn: Callable[[str], bool]):
+  def __init__(self,
+               key_filter_fn: Callable[[str], bool],
+               fingerprint_slice_keys: bool = False,
+               rollup_plan: Optional[SliceRollupPlan] = None):
     self._num_slices_generated_per_instance = beam.metrics.Metrics.distribution(
         constants.METRICS_NAMESPACE, 'num_slices_generated_per_instance')
     self._post_slice_num_instances = beam.metrics.Metrics.counter(
         constants.METRICS_NAMESPACE, 'post_slice_num_instances')
     self._key_filter_fn = key_filter_fn
+    self._fingerprint_slice_keys = fingerprint_slice_keys
+    self._rollup_plan = rollup_plan
+
+  def _output_key(self, slice_key: SliceKeyType) -> Union[SliceKeyType, int]:
+    if self._fingerprint_slice_keys:
+      return fingerprint_slice_key(slice_key)
+    return slice_key
 
   def process(
       self,
@@ -536,22 +989,58 @@ class _FanoutSlicesDoFn(beam.DoFn):
     key_filter_fn = self._key_filter_fn  # Local cache.
     filtered = {k: v for k, v in element.items() if key_filter_fn(k)}
     slice_keys = element.get(constants.SLICE_KEY_TYPES_KEY)
-    # The query based evaluator will group slices into a multi-dimentional array
-    # with an extra dimension representing the examples matching the query key.
-    # We need to flatten and dedup the slice keys.
-    if _is_multi_dim_keys(slice_keys):
-      arr = np.array(slice_keys)
-      unique_keys = set(arr.flatten())
-      if not unique_keys and arr.shape:
-        # If only the empty overall slice is in array, it is removed by flatten
-        unique_keys.add(())
-      slice_keys = unique_keys
-    result = [(slice_key, filtered) for slice_key in slice_keys]
+    if self._rollup_plan and not _is_multi_dim_keys(slice_keys):
+      slice_keys = rollup_slice_keys(slice_keys, self._rollup_plan)
+    else:
+      slice_keys = _unique_slice_keys(slice_keys)
+    result = [(self._output_key(slice_key), filtered)
+              for slice_key in slice_keys]
     self._num_slices_generated_per_instance.update(len(result))
     self._post_slice_num_instances.inc(len(result))
     return result
 
 
+@beam.typehints.with_input_types(types.Extracts)
+@beam.typehints.with_output_types(Tuple[SliceKeyType, types.Extracts])
+class _FanoutBatchedSlicesDoFn(_FanoutSlicesDoFn):
+  """A DoFn that performs per-slice key fanout of batched extracts.
+
+  Each key in the incoming extracts is expected to store a list of values (one
+  per example). Rather than emitting one output per example and slice key, the
+  examples in the batch are grouped by slice key and a single batched extract
+  containing only the matching examples is emitted for each slice key.
+  """
+
+  def process(
+      self,
+      element: types.Extracts) -> List[Tuple[SliceKeyType, types.Extracts]]:
+    key_filter_fn = self._key_filter_fn  # Local cache.
+    filtered = {k: v for k, v in element.items() if key_filter_fn(k)}
+    batch_size = len(element[constants.SLICE_KEY_TYPES_KEY])
+    indices_by_slice_key = {}
+    for i, slice_keys in enumerate(element[constants.SLICE_KEY_TYPES_KEY]):
+      slice_keys = set(slice_keys)
+      if self._rollup_plan:
+        slice_keys = rollup_slice_keys(slice_keys, self._rollup_plan)
+      for slice_key in slice_keys:
+        if slice_key not in indices_by_slice_key:
+          indices_by_slice_key[slice_key] = []
+        indices_by_slice_key[slice_key].append(i)
+      self._num_slices_generated_per_instance.update(len(slice_keys))
+    result = []
+    for slice_key, indices in indices_by_slice_key.items():
+      self._post_slice_num_instances.inc(len(indices))
+      output_key = self._output_key(slice_key)
+      if len(indices) == batch_size:
+        # All examples match (e.g. overall slice), re-use the batch as is.
+        result.append((output_key, filtered))
+      else:
+        result.append((output_key, {
+            k: [v[i] for i in indices] for k, v in filtered.items()
+        }))
+    return result
+
+
 # TODO(cyfoo): Possibly introduce the same telemetry in Lantern to help with
 # evaluating importance of b/111353165 based on actual Lantern usage data.
 @beam.ptransform_fn
@@ -579,16 +1068,50 @@ def _TrackDistinctSliceKeys(  # pylint: disable=invalid-name
 @beam.typehints.with_output_types(Tuple[SliceKeyType, types.Extracts])
 def FanoutSlices(  # pylint: disable=invalid-name
     pcoll: beam.pvalue.PCollection,
-    include_slice_keys_in_output: Optional[bool] = False
+    include_slice_keys_in_output: Optional[bool] = False,
+    batched: bool = False,
+    fingerprint_slice_keys: bool = False,
+    rollup_plan: Optional[SliceRollupPlan] = None
 ) -> beam.pvalue.PCollection:  # pylint: disable=invalid-name
-  """Fan out extracts based on slice keys (slice keys removed by default)."""
+  """Fan out extracts based on slice keys (slice keys removed by default).
+
+  Args:
+    pcoll: PCollection of extracts containing slice keys stored under
+      tfma.SLICE_KEY_TYPES_KEY.
+    include_slice_keys_in_output: True to keep the slice keys in the output.
+    batched: True if the extracts are batched (i.e. each key stores a list of
+      values with one entry per example). In this case one batched extract is
+      output per slice key containing only the examples matching that slice.
+    fingerprint_slice_keys: True to output the fingerprint of each slice key
+      (see fingerprint_slice_key) instead of the slice key itself. Use
+      SliceKeysByFingerprint and TranslateSliceKeyFingerprints to map the
+      fingerprints back to slice keys.
+    rollup_plan: Optional plan for rolling up slices. If set, examples that have
+      a single finest slice key are output once under a rollup key in place of
+      all the slice keys covered by the plan. Use expand_rollup_slice_key to get
+      the slice keys represented by a rollup key. Cannot be combined with
+      fingerprint_slice_keys.
+
+  Returns:
+    PCollection of (slice key, extracts) tuples.
+  """
   if include_slice_keys_in_output:
     key_filter_fn = lambda k: True
   else:
     pruned_keys = (constants.SLICE_KEY_TYPES_KEY, constants.SLICE_KEYS_KEY)
     key_filter_fn = lambda k: k not in pruned_keys
 
-  result = pcoll | 'DoSlicing' >> beam.ParDo(_FanoutSlicesDoFn(key_filter_fn))
+  if fingerprint_slice_keys and rollup_plan:
+    raise ValueError(
+        'fingerprint_slice_keys cannot be used in combination with a '
+        'rollup_plan')
+  if batched:
+    fanout_fn = _FanoutBatchedSlicesDoFn(key_filter_fn, fingerprint_slice_keys,
+                                         rollup_plan)
+  else:
+    fanout_fn = _FanoutSlicesDoFn(key_filter_fn, fingerprint_slice_keys,
+                                  rollup_plan)
+  result = pcoll | 'DoSlicing' >> beam.ParDo(fanout_fn)
 
   # pylint: disable=no-value-for-parameter
   _ = result | 'TrackDistinctSliceKeys' >> _TrackDistinctSliceKeys()
@@ -597,6 +1120,111 @@ def FanoutSlices(  # pylint: disable=invalid-name
   return result
 
 
+class _SliceKeyFingerprintsDoFn(beam.DoFn):
+  """A DoFn that outputs (fingerprint, slice key) for unseen slice keys."""
+
+  def __init__(self, batched: bool):
+    self._batched = batched
+    self._seen_slice_keys = None
+
+  def start_bundle(self):
+    # Only new slice keys are output, duplicates across bundles are removed
+    # downstream.
+    self._seen_slice_keys = set()
+
+  def process(
+      self, element: types.Extracts
+  ) -> Generator[Tuple[int, SliceKeyType], None, None]:
+    slice_keys = element.get(constants.SLICE_KEY_TYPES_KEY)
+    if self._batched:
+      slice_keys = itertools.chain.from_iterable(slice_keys)
+    else:
+      slice_keys = _unique_slice_keys(slice_keys)
+    for slice_key in slice_keys:
+      if slice_key not in self._seen_slice_keys:
+        self._seen_slice_keys.add(slice_key)
+        yield (fingerprint_slice_key(slice_key), slice_key)
+
+
+def _unique_slice_key(slice_keys: Iterable[SliceKeyType]) -> SliceKeyType:
+  """Returns the only slice key in slice_keys (raises on collisions)."""
+  unique_keys = set(slice_keys)
+  if len(unique_keys) != 1:
+    raise ValueError(
+        'slice key fingerprint collision between slice keys: {}'.format(
+            sorted(unique_keys, key=str)))
+  return unique_keys.pop()
+
+
+@beam.ptransform_fn
+@beam.typehints.with_input_types(types.Extracts)
+@beam.typehints.with_output_types(Tuple[int, SliceKeyType])
+def SliceKeysByFingerprint(  # pylint: disable=invalid-name
+    pcoll: beam.pvalue.PCollection,
+    batched: bool = False) -> beam.pvalue.PCollection:
+  """Computes the distinct slice keys keyed by their fingerprints.
+
+  Args:
+    pcoll: PCollection of extracts containing slice keys stored under
+      tfma.SLICE_KEY_TYPES_KEY.
+    batched: True if the extracts are batched.
+
+  Returns:
+    PCollection of (fingerprint, slice key) tuples with one entry per distinct
+    slice key.
+
+  Raises:
+    ValueError: If two distinct slice keys have the same fingerprint.
+  """
+  return (pcoll
+          | 'ExtractSliceKeys' >> beam.ParDo(_SliceKeyFingerprintsDoFn(batched))
+          | 'CombinePerFingerprint' >> beam.CombinePerKey(_unique_slice_key))
+
+
+@beam.ptransform_fn
+@beam.typehints.with_input_types(Tuple[int, Any])
+@beam.typehints.with_output_types(Tuple[SliceKeyType, Any])
+def TranslateSliceKeyFingerprints(  # pylint: disable=invalid-name
+    pcoll: beam.pvalue.PCollection,
+    slice_keys_by_fingerprint: beam.pvalue.AsDict) -> beam.pvalue.PCollection:
+  """Replaces slice key fingerprints with the slice keys they represent.
+
+  Args:
+    pcoll: PCollection of (fingerprint, value) tuples.
+    slice_keys_by_fingerprint: AsDict side input of the output of
+      SliceKeysByFingerprint.
+
+  Returns:
+    PCollection of (slice key, value) tuples.
+  """
+  return pcoll | 'TranslateFingerprints' >> beam.MapTuple(
+      lambda fingerprint, value, slice_keys: (slice_keys[fingerprint], value),
+      slice_keys=slice_keys_by_fingerprint)
+
+
+@beam.ptransform_fn
+@beam.typehints.with_input_types(Tuple[Any, Any])
+@beam.typehints.with_output_types(Tuple[SliceKeyType, Any])
+def ExpandSliceRollups(  # pylint: disable=invalid-name
+    pcoll: beam.pvalue.PCollection,
+    rollup_plan: SliceRollupPlan) -> beam.pvalue.PCollection:
+  """Outputs the value of each rollup key once per slice key it represents.
+
+  Args:
+    pcoll: PCollection of (slice key or rollup key, value) tuples where the
+      rollup keys were created by FanoutSlices using rollup_plan.
+    rollup_plan: Rollup plan passed to FanoutSlices.
+
+  Returns:
+    PCollection of (slice key, value) tuples. Note that the same value object
+    is output for each of the slice keys represented by a rollup key, so values
+    must not be modified downstream.
+  """
+  return pcoll | 'ExpandRollupKeys' >> beam.FlatMapTuple(
+      lambda key, value: [(slice_key, value) for slice_key in
+                          expand_rollup_slice_key(key, rollup_plan)])
+
+
 # TFMA v1 uses Text for its keys while TFMA v2 uses MetricKey
 _MetricsDict = Dict[Any, Any]
 
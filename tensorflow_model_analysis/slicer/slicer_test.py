@@ -13,10 +13,13 @@
 # limitations under the License.
 """Slicer test."""
 
+from unittest import mock
+
 from absl.testing import parameterized
 import apache_beam as beam
 from apache_beam.testing import util
 import numpy as np
+import pyarrow as pa
 import six
 import tensorflow as tf
 from tensorflow_model_analysis import constants
@@ -322,6 +325,72 @@ class SlicerTest(testutil.TensorflowModelAnalysisTest, parameterized.TestCase):
         expected,
         slicer.get_slices_for_features_dicts([features_dict], None, slice_spec))
 
+  def testGetSlicesForRecordBatch(self):
+    record_batch = pa.RecordBatch.from_arrays([
+        pa.array([['f'], ['m'], None, ['f']], type=pa.list_(pa.binary())),
+        pa.array([[5], [6], [5], []], type=pa.list_(pa.int64())),
+        pa.array([['cars', 'dogs'], ['cars'], ['dogs'], ['cars']],
+                 type=pa.list_(pa.binary())),
+        pa.array([[[1]], [[2]], [[3]], [[4]]],
+                 type=pa.list_(pa.list_(pa.int64()))),
+    ], ['gender', 'age', 'interests', 'nested'])
+    slice_spec = [
+        slicer.SingleSliceSpec(),
+        slicer.SingleSliceSpec(columns=['gender', 'age']),
+        slicer.SingleSliceSpec(columns=['interests'], features=[('age', '5')]),
+        slicer.SingleSliceSpec(columns=['nested']),
+    ]
+    slice_keys, remaining_slice_spec = slicer.get_slices_for_record_batch(
+        record_batch, slice_spec)
+    # Nested list columns are not supported.
+    self.assertEqual([slicer.SingleSliceSpec(columns=['nested'])],
+                     remaining_slice_spec)
+    self.assertCountEqual(
+        [(), (('age', 5), ('gender', 'f')), (('age', 5), ('interests', 'cars')),
+         (('age', 5), ('interests', 'dogs'))], slice_keys[0])
+    self.assertCountEqual([(), (('age', 6), ('gender', 'm'))], slice_keys[1])
+    self.assertCountEqual([(), (('age', 5), ('interests', 'dogs'))],
+                          slice_keys[2])
+    self.assertCountEqual([()], slice_keys[3])
+
+    # Rows sliced from a larger batch.
+    slice_keys, _ = slicer.get_slices_for_record_batch(
+        record_batch.slice(1, 2), slice_spec[1:2])
+    self.assertEqual([[(('age', 6), ('gender', 'm'))], []], slice_keys)
+
+  def testGetSlicesForRecordBatchEncodesColumnsOnce(self):
+    record_batch = pa.RecordBatch.from_arrays([
+        pa.array([['f'], ['m']], type=pa.list_(pa.binary())),
+        pa.array([[5], [6]], type=pa.list_(pa.int64())),
+        pa.array([[[1]], [[2]]], type=pa.list_(pa.list_(pa.int64()))),
+    ], ['gender', 'age', 'nested'])
+    slice_spec = [
+        slicer.SingleSliceSpec(columns=['gender']),
+        slicer.SingleSliceSpec(columns=['age']),
+        slicer.SingleSliceSpec(columns=['gender', 'age']),
+        slicer.SingleSliceSpec(columns=['age'], features=[('gender', 'f')]),
+        slicer.SingleSliceSpec(columns=['nested']),
+        slicer.SingleSliceSpec(columns=['nested', 'age']),
+    ]
+    encoded_list_column = slicer._DictionaryEncodedListColumn
+    with mock.patch.object(
+        encoded_list_column, 'create',
+        wraps=encoded_list_column.create) as mock_create:
+      slice_keys, remaining_slice_spec = slicer.get_slices_for_record_batch(
+          record_batch, slice_spec)
+
+    self.assertCountEqual([
+        mock.call(record_batch, 'age'),
+        mock.call(record_batch, 'gender'),
+        mock.call(record_batch, 'nested')
+    ], mock_create.call_args_list)
+    self.assertEqual(slice_spec[4:], remaining_slice_spec)
+    self.assertCountEqual([(('gender', 'f'),), (('age', 5),),
+                           (('age', 5), ('gender', 'f')),
+                           (('age', 5), ('gender', 'f'))], slice_keys[0])
+    self.assertCountEqual([(('gender', 'm'),), (('age', 6),),
+                           (('age', 6), ('gender', 'm'))], slice_keys[1])
+
   def testStringifySliceKey(self):
     test_cases = [
         ('overall', (), 'Overall'),
@@ -336,6 +405,39 @@ class SlicerTest(testutil.TensorflowModelAnalysisTest, parameterized.TestCase):
       self.assertEqual(
           stringified_key, slicer.stringify_slice_key(slice_key), msg=name)
 
+  def testSliceSpecMatcher(self):
+    slice_specs = [
+        slicer.SingleSliceSpec(columns=['age']),
+        slicer.SingleSliceSpec(columns=['gender'], features=[('age', 5)]),
+        config_pb2.SlicingSpec(feature_values={'interest': 'cars'}),
+    ]
+    matcher = slicer.SliceSpecMatcher(slice_specs)
+    slice_keys = [
+        (),
+        (('age', 5),),
+        (('age', '5'),),
+        (('gender', 'f'),),
+        (('age', 5), ('gender', 'f')),
+        (('age', '5'), ('gender', 'f')),
+        (('age', 6), ('gender', 'f')),
+        (('interest', 'cars'),),
+        (('interest', b'cars'),),
+        (('interest', 'dogs'),),
+        (('age', 5), ('age', 5)),
+    ]
+    for slice_key in slice_keys:
+      expected = any(
+          slicer.SingleSliceSpec(spec=spec).is_slice_applicable(slice_key)
+          if isinstance(spec, config_pb2.SlicingSpec) else
+          spec.is_slice_applicable(slice_key) for spec in slice_specs)
+      self.assertEqual(expected, matcher.matches(slice_key), msg=slice_key)
+      self.assertEqual(
+          expected, slicer.slice_key_matches_slice_specs(slice_key, matcher))
+    self.assertTrue(matcher.matches((('age', 6),)))
+    self.assertFalse(matcher.matches(()))
+    self.assertTrue(
+        slicer.get_slice_spec_matcher([config_pb2.SlicingSpec()]).matches(()))
+
   def testIsCrossSliceApplicable(self):
     test_cases = [
         (True, 'overall pass', ((), (('b', 2),)), config_pb2.CrossSlicingSpec(
@@ -583,6 +685,207 @@ class SlicerTest(testutil.TensorflowModelAnalysisTest, parameterized.TestCase):
 
       util.assert_that(result, check_result)
 
+  def testBatchedSlices(self):
+    data = [{
+        'predictions': [[0.1], [0.2], [0.3]],
+        'labels': [[0], [1], [0]],
+        constants.SLICE_KEY_TYPES_KEY: [[(), (('gender', 'f'),)],
+                                        [(), (('gender', 'm'),)],
+                                        [(), (('gender', 'f'),)]]
+    }]
+
+    with beam.Pipeline() as pipeline:
+      result = (
+          pipeline
+          | 'CreateTestInput' >> beam.Create(data, reshuffle=False)
+          | 'FanoutSlices' >> slicer.FanoutSlices(batched=True))
+
+      def check_result(got):
+        try:
+          self.assertLen(got, 3)
+          expected_result = [
+              ((), {
+                  'predictions': [[0.1], [0.2], [0.3]],
+                  'labels': [[0], [1], [0]]
+              }),
+              ((('gender', 'f'),), {
+                  'predictions': [[0.1], [0.3]],
+                  'labels': [[0], [0]]
+              }),
+              ((('gender', 'm'),), {
+                  'predictions': [[0.2]],
+                  'labels': [[1]]
+              }),
+          ]
+          self.assertCountEqual(got, expected_result)
+        except AssertionError as err:
+          raise util.BeamAssertException(err)
+
+      util.assert_that(result, check_result)
+
+  def testFingerprintSliceKey(self):
+    slice_keys = [(), (('gender', 'f'),), (('gender', 'm'),), (('age', 10),),
+                  (('age', 10.5),), (('age', 10), ('gender', 'f'))]
+    fingerprints = [slicer.fingerprint_slice_key(k) for k in slice_keys]
+    self.assertLen(set(fingerprints), len(slice_keys))
+    for fingerprint in fingerprints:
+      self.assertIsInstance(fingerprint, int)
+      self.assertBetween(fingerprint, -2**63, 2**63 - 1)
+    self.assertEqual(fingerprints[1],
+                     slicer.fingerprint_slice_key((('gender', 'f'),)))
+    # Slice keys that compare equal have the same fingerprint.
+    self.assertEqual(fingerprints[3],
+                     slicer.fingerprint_slice_key((('age', 10.0),)))
+    self.assertEqual(fingerprints[3],
+                     slicer.fingerprint_slice_key((('age', np.int64(10)),)))
+
+  @parameterized.named_parameters(('unbatched', False), ('batched', True))
+  def testFanoutSlicesWithFingerprints(self, batched):
+    slice_keys = [[(), (('gender', 'f'),)], [(), (('gender', 'm'),)],
+                  [(), (('gender', 'f'),)]]
+    if batched:
+      data = [{'labels': [0, 1, 0], constants.SLICE_KEY_TYPES_KEY: slice_keys}]
+    else:
+      data = [{
+          'labels': label,
+          constants.SLICE_KEY_TYPES_KEY: keys
+      } for label, keys in zip([0, 1, 0], slice_keys)]
+
+    with beam.Pipeline() as pipeline:
+      extracts = pipeline | 'CreateTestInput' >> beam.Create(
+          data, reshuffle=False)
+      slice_keys_by_fingerprint = beam.pvalue.AsDict(
+          extracts
+          | 'SliceKeysByFingerprint' >> slicer.SliceKeysByFingerprint(
+              batched=batched))
+      fingerprints = (
+          extracts
+          | 'FanoutSlices' >> slicer.FanoutSlices(
+              batched=batched, fingerprint_slice_keys=True))
+      result = (
+          fingerprints
+          | 'TranslateSliceKeyFingerprints' >>
+          slicer.TranslateSliceKeyFingerprints(slice_keys_by_fingerprint))
+
+      def check_fingerprints(got):
+        try:
+          self.assertCountEqual(
+              set(k for k, _ in got),
+              [slicer.fingerprint_slice_key(()),
+               slicer.fingerprint_slice_key((('gender', 'f'),)),
+               slicer.fingerprint_slice_key((('gender', 'm'),))])
+        except AssertionError as err:
+          raise util.BeamAssertException(err)
+
+      def check_result(got):
+        try:
+          if batched:
+            expected_result = [
+                ((), {'labels': [0, 1, 0]}),
+                ((('gender', 'f'),), {'labels': [0, 0]}),
+                ((('gender', 'm'),), {'labels': [1]}),
+            ]
+          else:
+            expected_result = [
+                ((), {'labels': 0}),
+                ((), {'labels': 1}),
+                ((), {'labels': 0}),
+                ((('gender', 'f'),), {'labels': 0}),
+                ((('gender', 'f'),), {'labels': 0}),
+                ((('gender', 'm'),), {'labels': 1}),
+            ]
+          self.assertCountEqual(got, expected_result)
+        except AssertionError as err:
+          raise util.BeamAssertException(err)
+
+      util.assert_that(
+          fingerprints, check_fingerprints, label='check_fingerprints')
+      util.assert_that(result, check_result, label='check_result')
+
+  def testGetSliceRollupPlan(self):
+    plan = slicer.get_slice_rollup_plan([
+        slicer.SingleSliceSpec(),
+        slicer.SingleSliceSpec(columns=['country']),
+        slicer.SingleSliceSpec(columns=['device']),
+        slicer.SingleSliceSpec(columns=['device', 'country']),
+        slicer.SingleSliceSpec(columns=['age']),
+        slicer.SingleSliceSpec(columns=['device'], features=[('age', 5)]),
+    ])
+    self.assertEqual(
+        slicer.SliceRollupPlan(
+            finest_columns=('country', 'device'),
+            rollup_columns=frozenset([(), ('country',), ('device',),
+                                      ('country', 'device')])), plan)
+    self.assertIsNone(
+        slicer.get_slice_rollup_plan([
+            slicer.SingleSliceSpec(columns=['country']),
+            slicer.SingleSliceSpec(columns=['device'])
+        ]))
+
+  def testRollupSliceKeys(self):
+    plan = slicer.SliceRollupPlan(
+        finest_columns=('country', 'device'),
+        rollup_columns=frozenset([(), ('country',), ('device',),
+                                  ('country', 'device')]))
+    single_valued = [(), (('country', 'us'),), (('device', 'a'),),
+                     (('country', 'us'), ('device', 'a')), (('age', 5),)]
+    rolled_up = slicer.rollup_slice_keys(single_valued, plan)
+    self.assertLen(rolled_up, 2)
+    self.assertIn((('age', 5),), rolled_up)
+    self.assertCountEqual(
+        single_valued,
+        [k for key in rolled_up
+         for k in slicer.expand_rollup_slice_key(key, plan)])
+    # Multivalent and missing finest columns are not rolled up.
+    multivalent = [(), (('country', 'us'),), (('device', 'a'),),
+                   (('device', 'b'),), (('country', 'us'), ('device', 'a')),
+                   (('country', 'us'), ('device', 'b'))]
+    self.assertEqual(multivalent, slicer.rollup_slice_keys(multivalent, plan))
+    missing = [(), (('country', 'us'),)]
+    self.assertEqual(missing, slicer.rollup_slice_keys(missing, plan))
+
+  @parameterized.named_parameters(('unbatched', False), ('batched', True))
+  def testFanoutSlicesWithRollups(self, batched):
+    slice_keys = [
+        [(), (('gender', 'f'),)],
+        [(), (('gender', 'm'),)],
+        [(), (('gender', 'f'),)],
+        [()],
+    ]
+    plan = slicer.get_slice_rollup_plan(
+        [slicer.SingleSliceSpec(),
+         slicer.SingleSliceSpec(columns=['gender'])])
+    if batched:
+      data = [{
+          'labels': [0, 1, 0, 1],
+          constants.SLICE_KEY_TYPES_KEY: slice_keys
+      }]
+    else:
+      data = [{
+          'labels': label,
+          constants.SLICE_KEY_TYPES_KEY: keys
+      } for label, keys in zip([0, 1, 0, 1], slice_keys)]
+
+    with beam.Pipeline() as pipeline:
+      result = (
+          pipeline
+          | 'CreateTestInput' >> beam.Create(data, reshuffle=False)
+          | 'FanoutSlices' >> slicer.FanoutSlices(
+              batched=batched, rollup_plan=plan)
+          | 'CountPerSliceKey' >> beam.MapTuple(
+              lambda k, v: (k, len(v['labels']) if batched else 1))
+          | 'ExpandSliceRollups' >> slicer.ExpandSliceRollups(plan)
+          | 'SumPerSliceKey' >> beam.CombinePerKey(sum))
+
+      def check_result(got):
+        try:
+          self.assertCountEqual(got, [((), 4), ((('gender', 'f'),), 2),
+                                      ((('gender', 'm'),), 1)])
+        except AssertionError as err:
+          raise util.BeamAssertException(err)
+
+      util.assert_that(result, check_result)
+
   def testFilterOutSlices(self):
     slice_key_1 = (('slice_key', 'slice1'),)
     slice_key_2 = (('slice_key', 'slice2'),)
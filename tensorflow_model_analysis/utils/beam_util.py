@@ -13,7 +13,8 @@
 # limitations under the License.
 """Utilities for working the Apache Beam APIs."""
 
-from typing import Any, Iterable, TypeVar
+import random
+from typing import Any, Dict, Iterable, Optional, Sequence, Tuple, TypeVar, Union
 
 import apache_beam as beam
 
@@ -51,6 +52,14 @@ class DelegatingCombineFn(beam.CombineFn):
                 element: Any) -> _AccumulatorType:
     return self._combine_fn.add_input(accumulator, element)
 
+  def add_inputs(self, accumulator: _AccumulatorType,
+                 elements: Iterable[Any]) -> _AccumulatorType:
+    # Subclasses that only override add_input must still see every element, so
+    # the elements are only passed through when add_input is not overridden.
+    if type(self).add_input is not DelegatingCombineFn.add_input:
+      return super().add_inputs(accumulator, elements)
+    return self._combine_fn.add_inputs(accumulator, elements)
+
   def merge_accumulators(
       self, accumulators: Iterable[_AccumulatorType]) -> _AccumulatorType:
     return self._combine_fn.merge_accumulators(accumulators)
@@ -63,3 +72,131 @@ class DelegatingCombineFn(beam.CombineFn):
 
   def teardown(self, *args, **kwargs):
     return self._combine_fn.teardown(*args, **kwargs)
+
+
+class AccumulateOnlyCombineFn(DelegatingCombineFn):
+  """A combine_fn wrapper which returns the accumulator as the output value.
+
+  This is intended to allow invoking CombineFns in settings where you might need
+  to subsequently merge the results before calling extract_output. A typical use
+  of an AccumulateOnlyCombineFn might look like:
+
+      c = OtherCombineFn()
+
+      # combine per key, but don't call extract_output()
+      accumulators = p | beam.CombinePerKey(AccumulateOnlyCombineFn(c))
+
+      # re-key and merge the accumulators before extracting the output
+      output = (accumulators
+          | beam.Map(rekey_fn)
+          | beam.CombinePerKey(AccumulatorCombineFn(c)))
+  """
+
+  def add_inputs(self, accumulator: _AccumulatorType,
+                 elements: Iterable[Any]) -> _AccumulatorType:
+    return self._combine_fn.add_inputs(accumulator, elements)
+
+  def extract_output(self, accumulator: _AccumulatorType) -> _AccumulatorType:
+    return self._combine_fn.compact(accumulator)
+
+
+class AccumulatorCombineFn(DelegatingCombineFn):
+  """A CombineFn wrapper that takes accumulators as add_input elements.
+
+  In combination with AccumulateOnlyCombineFn, this makes it possible to
+  operate on a CombineFn's accumulators prior to calling extract input. See the
+  AccumulateOnlyCombineFn docstring for more details.
+
+  Note that the input accumulators are never modified so the same accumulator
+  may be added to multiple keys.
+  """
+
+  def add_input(self, accumulator: _AccumulatorType,
+                element: _AccumulatorType) -> _AccumulatorType:
+    return self._combine_fn.merge_accumulators([accumulator, element])
+
+  def add_inputs(self, accumulator: _AccumulatorType,
+                 elements: Iterable[_AccumulatorType]) -> _AccumulatorType:
+    return self._combine_fn.merge_accumulators([accumulator] + list(elements))
+
+
+def add_weighted_inputs(combine_fn: beam.CombineFn, accumulator: Any,
+                        elements: Sequence[Any],
+                        weights: Sequence[int]) -> Any:
+  """Adds each element to the accumulator the given number of times.
+
+  CombineFns that can apply integer weights to their inputs directly (e.g.
+  histograms) may implement add_weighted_inputs(accumulator, elements, weights).
+  For other CombineFns the elements are repeated and passed to add_inputs.
+
+  Args:
+    combine_fn: CombineFn to add the elements with.
+    accumulator: Accumulator of the combine_fn.
+    elements: Elements to add.
+    weights: Number of times to add each element.
+
+  Returns:
+    Updated accumulator.
+  """
+  if hasattr(combine_fn, 'add_weighted_inputs'):
+    return combine_fn.add_weighted_inputs(accumulator, elements, weights)
+  repeated_elements = [
+      element for element, weight in zip(elements, weights)
+      for _ in range(weight)
+  ]
+  if not repeated_elements:
+    return accumulator
+  return combine_fn.add_inputs(accumulator, repeated_elements)
+
+
+def _hot_key_partition(key_and_value: Tuple[Any, Any], num_partitions: int,
+                       hot_key_fanout: Dict[Any, int]) -> int:
+  del num_partitions
+  return 1 if hot_key_fanout.get(key_and_value[0], 1) > 1 else 0
+
+
+def _add_fanout_key(key: Any, value: Any,
+                    hot_key_fanout: Dict[Any, int]) -> Tuple[Any, Any]:
+  fanout = hot_key_fanout.get(key, 1)
+  return (key, random.randrange(fanout) if fanout > 1 else 0), value
+
+
+@beam.ptransform_fn
+def CombinePerKeyWithHotKeyFanout(  # pylint: disable=invalid-name
+    pcoll: beam.pvalue.PCollection, combine_fn: beam.CombineFn,
+    hot_key_fanout: Optional[Union[int, beam.pvalue.AsDict]]
+) -> beam.pvalue.PCollection:
+  """Combines values per key, spreading hot keys across intermediate keys.
+
+  Args:
+    pcoll: PCollection of (key, value) tuples.
+    combine_fn: CombineFn to apply to the values of each key.
+    hot_key_fanout: Either a fixed fanout to use for every key (see
+      beam.CombinePerKey.with_hot_key_fanout) or an AsDict side input mapping
+      keys to their fanout. In the latter case keys with a fanout greater than
+      one are combined in two stages (first into accumulators per intermediate
+      key and then into the output per key) while all other keys (including
+      keys that are missing from the side input) are combined directly.
+
+  Returns:
+    PCollection of (key, combine_fn output) tuples.
+  """
+  if not isinstance(hot_key_fanout, beam.pvalue.AsDict):
+    return pcoll | 'CombinePerKey' >> beam.CombinePerKey(
+        combine_fn).with_hot_key_fanout(hot_key_fanout)
+  cold, hot = (
+      pcoll
+      | 'PartitionHotKeys' >> beam.Partition(
+          _hot_key_partition, 2, hot_key_fanout=hot_key_fanout))
+  cold_outputs = cold | 'CombineColdKeys' >> beam.CombinePerKey(combine_fn)
+  hot_outputs = (
+      hot
+      | 'AddFanoutKeys' >> beam.MapTuple(
+          _add_fanout_key, hot_key_fanout=hot_key_fanout)
+      | 'PreCombinePerFanoutKey' >> beam.CombinePerKey(
+          AccumulateOnlyCombineFn(combine_fn))
+      | 'RemoveFanoutKeys' >> beam.MapTuple(
+          lambda fanout_key, accumulator: (fanout_key[0], accumulator))
+      | 'CombineHotKeys' >> beam.CombinePerKey(
+          AccumulatorCombineFn(combine_fn)))
+  return (cold_outputs, hot_outputs) | 'FlattenKeys' >> beam.Flatten()
@@ -17,6 +17,7 @@ from unittest import mock
 
 from absl.testing import absltest
 import apache_beam as beam
+from apache_beam.testing import util
 from tensorflow_model_analysis.utils import beam_util
 
 
@@ -44,6 +45,12 @@ class BeamUtilsTest(absltest.TestCase):
                      delegated_combine_fn.add_input(input_acc, input_elem))
     mock_combine_fn.add_input.assert_called_once_with(input_acc, input_elem)
 
+    input_elems = ['elem1', 'elem2']
+    mock_combine_fn.add_inputs.return_value = updated_acc
+    self.assertEqual(updated_acc,
+                     delegated_combine_fn.add_inputs(input_acc, input_elems))
+    mock_combine_fn.add_inputs.assert_called_once_with(input_acc, input_elems)
+
     input_accs = ['acc1', 'acc2']
     merged_acc = 'merged_acc'
     mock_combine_fn.merge_accumulators.return_value = merged_acc
@@ -71,6 +78,52 @@ class BeamUtilsTest(absltest.TestCase):
     mock_combine_fn.teardown.assert_called_once_with(*teardown_args,
                                                      **teardown_kwargs)
 
+  def test_delegated_combine_fn_add_inputs_with_add_input_override(self):
+
+    class AddOneCombineFn(beam_util.DelegatingCombineFn):
+
+      def add_input(self, accumulator, element):
+        return self._combine_fn.add_input(accumulator, element + 1)
+
+    mock_combine_fn = mock.create_autospec(beam.CombineFn, instance=True)
+    mock_combine_fn.add_input.side_effect = lambda acc, elem: acc + [elem]
+    combine_fn = AddOneCombineFn(mock_combine_fn)
+    self.assertEqual([2, 3], combine_fn.add_inputs([], [1, 2]))
+    mock_combine_fn.add_inputs.assert_not_called()
+
+  def test_accumulate_only_and_accumulator_combine_fns(self):
+    combine_fn = beam.combiners.MeanCombineFn()
+    accumulate_only_combine_fn = beam_util.AccumulateOnlyCombineFn(combine_fn)
+    accumulator_combine_fn = beam_util.AccumulatorCombineFn(combine_fn)
+
+    accumulators = []
+    for inputs in ([1.0, 2.0], [3.0], [6.0]):
+      accumulator = accumulate_only_combine_fn.create_accumulator()
+      for x in inputs:
+        accumulator = accumulate_only_combine_fn.add_input(accumulator, x)
+      accumulators.append(
+          accumulate_only_combine_fn.extract_output(accumulator))
+
+    accumulator = accumulator_combine_fn.create_accumulator()
+    for input_accumulator in accumulators:
+      accumulator = accumulator_combine_fn.add_input(accumulator,
+                                                     input_accumulator)
+    self.assertEqual(3.0, accumulator_combine_fn.extract_output(accumulator))
+
+  def test_combine_per_key_with_hot_key_fanout(self):
+    with beam.Pipeline() as pipeline:
+      values = pipeline | 'CreateValues' >> beam.Create(
+          [('a', 1.0)] * 10 + [('b', 2.0), ('b', 4.0), ('c', 5.0)])
+      hot_key_fanout = beam.pvalue.AsDict(
+          pipeline | 'CreateFanouts' >> beam.Create([('a', 4), ('c', 1)]))
+      result = (
+          values
+          | 'CombinePerKey' >> beam_util.CombinePerKeyWithHotKeyFanout(
+              beam.combiners.MeanCombineFn(), hot_key_fanout))
+
+      util.assert_that(result,
+                       util.equal_to([('a', 1.0), ('b', 3.0), ('c', 5.0)]))
+
 
 if __name__ == '__main__':
   absltest.main()
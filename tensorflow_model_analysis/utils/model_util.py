@@ -14,13 +14,18 @@
 """Utils for working with models."""
 
 import collections
+import concurrent.futures
 import copy
 import importlib
 import os
-from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Set, Tuple
 
 from absl import logging
 import apache_beam as beam
+from apache_beam.utils import shared
+from apache_beam.utils.windowed_value import WindowedValue
 import numpy as np
 import pyarrow as pa
 import tensorflow as tf
@@ -69,6 +74,19 @@ _TFLITE_FILE_NAME = 'tflite'
 
 _PREDICT_SIGNATURE_DEF_KEY = 'predict'
 
+# Maximum number of batches in flight (being converted, run, or split) when
+# pipelined inference is used.
+_PIPELINED_INFERENCE_MAX_BATCHES = 4
+
+# Number of calls made at the chosen batch size before the adaptive batch size
+# controller decides whether to try or move to a different batch size.
+_ADAPTIVE_BATCH_SIZE_CALLS_PER_STEP = 4
+# Number of steps after which the throughput measured for batch sizes other
+# than the chosen one are discarded so they will be tried again.
+_ADAPTIVE_BATCH_SIZE_REEXPLORE_STEPS = 16
+# Weight of the latest measurement in the throughput moving averages.
+_ADAPTIVE_BATCH_SIZE_SMOOTHING = 0.25
+
 
 class ModelContents:
   """Class for storing model contents.
@@ -722,18 +740,109 @@ class BatchReducibleDoFnWithModels(DoFnWithModels):
       return result
 
 
+class _AdaptiveBatchSizeController:
+  """Chooses the inference batch size based on the observed throughput.
+
+  The controller starts with the size of the incoming batches and hill climbs by
+  halving or doubling the batch size (up to the largest incoming batch size).
+  The throughput (examples per second) of each batch size is tracked using a
+  moving average. After a few calls at the chosen batch size, the controller
+  moves to the best batch size measured so far or, if the chosen size is the
+  best, tries an unmeasured neighboring size. Batch sizes that run out of
+  resources are treated as having no throughput. Measurements for sizes other
+  than the chosen one are periodically discarded so the choice keeps adapting.
+
+  A single controller is shared by all the threads of a worker using the same
+  DoFn (and hence the same models).
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._batch_size = None
+    self._max_batch_size = 0
+    self._throughput = {}
+    self._num_calls = 0
+    self._num_steps = 0
+
+  def batch_size(self, num_rows: int) -> int:
+    """Returns the batch size to use for a batch of num_rows examples."""
+    with self._lock:
+      self._max_batch_size = max(self._max_batch_size, num_rows)
+      if self._batch_size is None:
+        self._batch_size = num_rows
+      return max(1, min(self._batch_size, num_rows))
+
+  def record_success(self, batch_size: int, seconds: float):
+    """Records the time taken to successfully process batch_size examples."""
+    with self._lock:
+      throughput = batch_size / max(seconds, 1e-9)
+      if self._throughput.get(batch_size):
+        throughput = (_ADAPTIVE_BATCH_SIZE_SMOOTHING * throughput +
+                      (1 - _ADAPTIVE_BATCH_SIZE_SMOOTHING) *
+                      self._throughput[batch_size])
+      self._throughput[batch_size] = throughput
+      if batch_size != self._batch_size:
+        return
+      self._num_calls += 1
+      if self._num_calls < _ADAPTIVE_BATCH_SIZE_CALLS_PER_STEP:
+        return
+      self._num_calls = 0
+      self._num_steps += 1
+      if self._num_steps % _ADAPTIVE_BATCH_SIZE_REEXPLORE_STEPS == 0:
+        self._throughput = {batch_size: self._throughput[batch_size]}
+      best_batch_size = max(self._throughput, key=self._throughput.get)
+      if self._throughput[best_batch_size] > self._throughput[batch_size]:
+        self._batch_size = best_batch_size
+        return
+      for candidate in (batch_size * 2, batch_size // 2):
+        if (1 <= candidate <= self._max_batch_size and
+            candidate not in self._throughput):
+          self._batch_size = candidate
+          return
+
+  def record_failure(self, batch_size: int):
+    """Records that batch_size examples ran out of resources."""
+    with self._lock:
+      self._throughput[batch_size] = 0.0
+      if batch_size == self._batch_size and batch_size > 1:
+        self._batch_size = batch_size // 2
+        self._num_calls = 0
+
+
+def _slice_batched_extract(element: types.Extracts, start: int,
+                           end: int) -> types.Extracts:
+  """Returns the rows [start, end) of a batched extract."""
+  return {
+      key: value.slice(start, end - start)
+      if key == constants.ARROW_RECORD_BATCH_KEY else value[start:end]
+      for key, value in element.items()
+  }
+
+
 @beam.typehints.with_input_types(types.Extracts)
 @beam.typehints.with_output_types(types.Extracts)
 class BatchReducibleBatchedDoFnWithModels(DoFnWithModels):
   """Abstract class for DoFns that need the shared models.
 
   This DoFn operates on batched Arrow RecordBatch as input. This DoFn will try
-  to use a large batch size at first. If a functional failure is caught, an
-  attempt will be made to process the elements serially at batch size 1.
+  to use a large batch size at first. If a functional failure is caught, the
+  batch is split in half and each half is retried recursively so that failing
+  examples are isolated in a logarithmic number of calls while the rest of the
+  examples are still processed using large batch sizes.
+
+  If adaptive_batch_size is used, the incoming batches are re-chunked into
+  batches whose size is tuned at runtime based on the observed throughput.
   """
 
-  def __init__(self, model_loaders: Dict[str, types.ModelLoader]):
+  def __init__(self,
+               model_loaders: Dict[str, types.ModelLoader],
+               adaptive_batch_size: bool = False):
     super().__init__(model_loaders)
+    self._batch_size_controller_handle = (
+        shared.Shared() if adaptive_batch_size else None)
+    self._batch_size_controller = None
+    self._adaptive_batch_size = beam.metrics.Metrics.distribution(
+        constants.METRICS_NAMESPACE, 'adaptive_batch_size')
     self._batch_size = (
         beam.metrics.Metrics.distribution(constants.METRICS_NAMESPACE,
                                           'batch_size'))
@@ -742,37 +851,112 @@ class BatchReducibleBatchedDoFnWithModels(DoFnWithModels):
                                           'batch_size_failed'))
     self._num_instances = beam.metrics.Metrics.counter(
         constants.METRICS_NAMESPACE, 'num_instances')
+    self._num_isolated_instances = beam.metrics.Metrics.counter(
+        constants.METRICS_NAMESPACE, 'num_isolated_instances')
+    self._isolated_instance_depth = beam.metrics.Metrics.distribution(
+        constants.METRICS_NAMESPACE, 'isolated_instance_depth')
+
+  def setup(self):
+    super().setup()
+    if self._batch_size_controller_handle is not None:
+      self._batch_size_controller = self._batch_size_controller_handle.acquire(
+          _AdaptiveBatchSizeController)
 
   def _batch_reducible_process(
       self, batched_extract: types.Extracts) -> Sequence[types.Extracts]:
     raise NotImplementedError('Subclasses are expected to override this.')
 
-  def process(self, element: types.Extracts) -> Sequence[types.Extracts]:
-    batch_size = element[constants.ARROW_RECORD_BATCH_KEY].num_rows
+  def _bisecting_process(self, element: types.Extracts, batch_size: int,
+                         depth: int) -> List[types.Extracts]:
+    """Processes element, splitting it in half on failure."""
+    start_time = time.perf_counter()
     try:
-      result = self._batch_reducible_process(element)
+      result = list(self._batch_reducible_process(element))
+      if self._batch_size_controller is not None:
+        self._batch_size_controller.record_success(
+            batch_size, time.perf_counter() - start_time)
       self._batch_size.update(batch_size)
-      self._num_instances.inc(batch_size)
+      if batch_size == 1 and depth:
+        self._num_isolated_instances.inc()
+        self._isolated_instance_depth.update(depth)
       return result
     except (ValueError, tf.errors.InvalidArgumentError,
             tf.errors.ResourceExhaustedError, RuntimeError) as e:
-      logging.warning(
-          'Large batch_size %s failed with error %s. '
-          'Attempting to run batch through serially. Note that this will '
-          'significantly affect the performance.', batch_size, e)
+      if (self._batch_size_controller is not None and
+          isinstance(e, tf.errors.ResourceExhaustedError)):
+        self._batch_size_controller.record_failure(batch_size)
+      if batch_size == 1:
+        if depth:
+          self._num_isolated_instances.inc()
+          self._isolated_instance_depth.update(depth)
+        raise
+      if not depth:
+        logging.warning(
+            'Large batch_size %s failed with error %s. '
+            'Attempting to run batch through in recursively halved batches. '
+            'Note that this may affect the performance.', batch_size, e)
       self._batch_size_failed.update(batch_size)
-      result = []
-      record_batch = element[constants.ARROW_RECORD_BATCH_KEY]
-      for i in range(batch_size):
-        self._batch_size.update(1)
-        unbatched_element = {
-            key: record_batch.slice(i, 1)
-            if key == constants.ARROW_RECORD_BATCH_KEY else [element[key][i]]
-            for key in element.keys()
-        }
-        result.extend(self._batch_reducible_process(unbatched_element))
-      self._num_instances.inc(len(result))
-      return result
+      middle = batch_size // 2
+      left = _slice_batched_extract(element, 0, middle)
+      right = _slice_batched_extract(element, middle, batch_size)
+      return (self._bisecting_process(left, middle, depth + 1) +
+              self._bisecting_process(right, batch_size - middle, depth + 1))
+
+  def _inference_batches(
+      self, element: types.Extracts) -> Iterator[Tuple[types.Extracts, int]]:
+    """Yields the batches (and their sizes) to run inference on."""
+    batch_size = element[constants.ARROW_RECORD_BATCH_KEY].num_rows
+    chunk_size = batch_size
+    if self._batch_size_controller is not None:
+      chunk_size = self._batch_size_controller.batch_size(batch_size)
+      self._adaptive_batch_size.update(chunk_size)
+    if chunk_size >= batch_size:
+      yield element, batch_size
+      return
+    for start in range(0, batch_size, chunk_size):
+      end = min(start + chunk_size, batch_size)
+      yield _slice_batched_extract(element, start, end), end - start
+
+  def process(self, element: types.Extracts) -> Sequence[types.Extracts]:
+    result = []
+    for batch, batch_size in self._inference_batches(element):
+      result.extend(self._bisecting_process(batch, batch_size, 0))
+    self._num_instances.inc(element[constants.ARROW_RECORD_BATCH_KEY].num_rows)
+    return result
+
+
+class _BatchTensorsCachingAdapter:
+  """Tensor adapter that converts a record batch to tensors only once.
+
+  The tensors converted by the wrapped adapter are shared by all the input specs
+  (of different models and signatures) that are filtered from them.
+  """
+
+  def __init__(self, adapter: tensor_adapter.TensorAdapter):
+    self._adapter = adapter
+    self._record_batch = None
+    self._tensors = None
+
+  def TypeSpecs(self) -> Dict[str, tf.TypeSpec]:  # pylint: disable=invalid-name
+    return self._adapter.TypeSpecs()
+
+  def ToBatchTensors(  # pylint: disable=invalid-name
+      self, record_batch: pa.RecordBatch) -> Dict[str, Any]:
+    if record_batch is not self._record_batch:
+      self._tensors = self._adapter.ToBatchTensors(record_batch)
+      self._record_batch = record_batch
+    return self._tensors
+
+
+class _SignatureCall(NamedTuple):
+  """Signature call prepared for a batch of extracts."""
+  model_name: str
+  extracts_key: str
+  signature_name: str
+  signature: Callable[..., Any]
+  inputs: Any
+  input_specs: Optional[Dict[str, Any]]
+  positional_inputs: bool
 
 
 @beam.typehints.with_input_types(types.Extracts)
@@ -836,13 +1020,19 @@ class ModelSignaturesDoFn(BatchReducibleBatchedDoFnWithModels):
       tensor_adapter_config: Tensor adapter config which specifies how to obtain
         tensors from the Arrow RecordBatch.
     """
-    super().__init__({k: v.model_loader for k, v in eval_shared_models.items()})
+    super().__init__(
+        {k: v.model_loader for k, v in eval_shared_models.items()},
+        adaptive_batch_size=(
+            eval_config.options.adaptive_inference_batch_size.value))
     self._eval_config = eval_config
     self._signature_names = signature_names
     self._default_signature_names = default_signature_names
     self._prefer_dict_outputs = prefer_dict_outputs
     self._tensor_adapter_config = tensor_adapter_config
     self._tensor_adapter = None
+    self._pipelined_inference = eval_config.options.pipelined_inference.value
+    self._pipeline_executors = None
+    self._in_flight_batches = collections.deque()
 
   def setup(self):
     super().setup()
@@ -861,36 +1051,113 @@ class ModelSignaturesDoFn(BatchReducibleBatchedDoFnWithModels):
                 spec.name, self._eval_config))
       loaded_models[model_name] = self._loaded_models[model_name]
     self._loaded_models = loaded_models
+    if self._pipelined_inference:
+      # One single threaded executor per stage (input conversion, model
+      # execution, and output splitting) so that the stages of consecutive
+      # batches overlap while each stage still processes batches in order.
+      self._pipeline_executors = tuple(
+          concurrent.futures.ThreadPoolExecutor(max_workers=1)
+          for _ in range(3))
+
+  def process(
+      self,
+      element: types.Extracts,
+      timestamp=beam.DoFn.TimestampParam,
+      window=beam.DoFn.WindowParam) -> Iterator[types.Extracts]:
+    if self._pipeline_executors is None:
+      yield from super().process(element)
+      return
+    prepare_executor, run_executor, attach_executor = self._pipeline_executors
+    for batch, batch_size in self._inference_batches(element):
+      calls_future = prepare_executor.submit(self._prepare_signature_calls,
+                                             batch)
+      outputs_future = run_executor.submit(self._run_pipelined_calls,
+                                           calls_future, batch_size)
+      future = attach_executor.submit(self._attach_pipelined_outputs, batch,
+                                      outputs_future)
+      self._in_flight_batches.append(
+          (batch, batch_size, future, timestamp, window))
+      while self._in_flight_batches and (
+          len(self._in_flight_batches) > _PIPELINED_INFERENCE_MAX_BATCHES or
+          self._in_flight_batches[0][2].done()):
+        yield from self._finish_oldest_in_flight_batch()
+    self._num_instances.inc(element[constants.ARROW_RECORD_BATCH_KEY].num_rows)
+
+  def _finish_oldest_in_flight_batch(self) -> Iterator[WindowedValue]:
+    """Waits for the oldest in flight batch and yields its results."""
+    batch, batch_size, future, timestamp, window = (
+        self._in_flight_batches.popleft())
+    try:
+      results = future.result()
+      self._batch_size.update(batch_size)
+    except (ValueError, tf.errors.InvalidArgumentError,
+            tf.errors.ResourceExhaustedError, RuntimeError):
+      # Failed batches are re-run synchronously so that failing examples are
+      # isolated (and failures recorded) the same way as without pipelining.
+      results = self._bisecting_process(batch, batch_size, 0)
+    for result in results:
+      yield WindowedValue(result, timestamp, [window])
+
+  def finish_bundle(self) -> Iterator[WindowedValue]:
+    while self._in_flight_batches:
+      yield from self._finish_oldest_in_flight_batch()
+    super().finish_bundle()
+
+  def teardown(self):
+    if self._pipeline_executors is not None:
+      for executor in self._pipeline_executors:
+        executor.shutdown(wait=True)
+      self._pipeline_executors = None
+    super().teardown()
+
+  def _run_pipelined_calls(
+      self, calls_future: concurrent.futures.Future,
+      batch_size: int) -> Dict[str, Dict[str, Dict[str, np.ndarray]]]:
+    calls = calls_future.result()
+    start_time = time.perf_counter()
+    batched_outputs = self._run_signature_calls(calls, batch_size)
+    if self._batch_size_controller is not None:
+      self._batch_size_controller.record_success(
+          batch_size, time.perf_counter() - start_time)
+    return batched_outputs
+
+  def _attach_pipelined_outputs(
+      self, batched_extract: types.Extracts,
+      outputs_future: concurrent.futures.Future) -> List[types.Extracts]:
+    return self._attach_outputs(batched_extract, outputs_future.result())
 
   def _batch_reducible_process(
       self, batched_extract: types.Extracts) -> List[types.Extracts]:
-
-    def maybe_expand_dims(arr):
-      if not hasattr(arr, 'shape') or not arr.shape:
-        return np.expand_dims(arr, axis=0)
-      else:
-        return arr
-
-    def to_dense(t):
-      if isinstance(t, tf.SparseTensor):
-        return tf.sparse.to_dense(t)
-      elif isinstance(t, tf.RaggedTensor):
-        return t.to_tensor()
-      else:
-        return t
-
-    def check_shape(t, batch_size, key=None):
-      if t.shape[0] != batch_size:
-        raise ValueError(
-            'First dimension does not correspond with batch size. '
-            f'Batch size: {batch_size}, Dimensions: {t.shape}, Key: {key}.')
-
-    result = copy.copy(batched_extract)
+    """Calls the model signatures and stores their outputs in the extracts."""
+    calls = self._prepare_signature_calls(batched_extract)
+    batched_outputs = self._run_signature_calls(
+        calls, batched_extract[constants.ARROW_RECORD_BATCH_KEY].num_rows)
+    return self._attach_outputs(batched_extract, batched_outputs)
+
+  def _prepare_signature_calls(
+      self, batched_extract: types.Extracts) -> List[_SignatureCall]:
+    """Looks up the signatures to call and converts their inputs."""
     record_batch = batched_extract[constants.ARROW_RECORD_BATCH_KEY]
     serialized_examples = batched_extract[constants.INPUT_KEY]
-    for extracts_key in self._signature_names.keys():
-      if extracts_key not in result or not result[extracts_key]:
-        result[extracts_key] = [None] * record_batch.num_rows
+    # Inputs converted from the record batch keyed by the input specs (and
+    # adapter) used so that models and signatures with the same inputs share a
+    # single conversion. Inputs for different specs converted by the same
+    # adapter are filtered from a single conversion of the record batch.
+    inputs_by_specs = {}
+    caching_adapters = {}
+
+    def get_cached_inputs(input_specs, adapter=None):
+      key = (id(adapter) if adapter is not None else None,
+             tuple((k, repr(v)) for k, v in sorted(input_specs.items())))
+      if key not in inputs_by_specs:
+        if adapter is not None:
+          if id(adapter) not in caching_adapters:
+            caching_adapters[id(adapter)] = _BatchTensorsCachingAdapter(adapter)
+          adapter = caching_adapters[id(adapter)]
+        inputs_by_specs[key] = get_inputs(record_batch, input_specs, adapter)
+      return inputs_by_specs[key]
+
+    calls = []
     for model_name, model in self._loaded_models.items():
       for extracts_key, signature_names in self._signature_names.items():
         for signature_name in (signature_names[model_name] or
@@ -909,7 +1176,7 @@ class ModelSignaturesDoFn(BatchReducibleBatchedDoFnWithModels):
                   input_name: type_spec for input_name, type_spec in zip(
                       input_names, signature.input_signature)
               }
-              inputs = get_inputs(record_batch, input_specs)
+              inputs = get_cached_inputs(input_specs)
               positional_inputs = True
             except AttributeError as e:
               logging.warning(
@@ -922,8 +1189,7 @@ class ModelSignaturesDoFn(BatchReducibleBatchedDoFnWithModels):
             # If input_specs exist then try to filter the inputs by the input
             # names (unlike estimators, keras does not accept unknown inputs).
             if input_specs:
-              inputs = get_inputs(record_batch, input_specs,
-                                  self._tensor_adapter)
+              inputs = get_cached_inputs(input_specs, self._tensor_adapter)
           if not inputs:
             # Assume serialized examples
             assert serialized_examples is not None, 'Raw examples not found.'
@@ -939,57 +1205,112 @@ class ModelSignaturesDoFn(BatchReducibleBatchedDoFnWithModels):
               continue
             raise ValueError('Unable to find %s function needed to update %s' %
                              (signature_name, extracts_key))
-          try:
-            if isinstance(inputs, dict):
-              if hasattr(signature, 'structured_input_signature'):
-                outputs = signature(**inputs)
-              elif positional_inputs:
-                outputs = signature(*inputs.values())
-              else:
-                outputs = signature(inputs)
-            else:
-              outputs = signature(tf.constant(inputs, dtype=tf.string))
-          except (TypeError, tf.errors.InvalidArgumentError) as e:
-            raise ValueError(
-                """Fail to call signature func with signature_name: {}.
-                the inputs are:\n {}.
-                The input_specs are:\n {}.""".format(signature_name, inputs,
-                                                     input_specs)) from e
-
-          dense_outputs = {}
-          if isinstance(outputs, dict):
-            for k, v in outputs.items():
-              dense_outputs[k] = to_dense(v)
-              check_shape(dense_outputs[k], record_batch.num_rows, key=k)
+          calls.append(
+              _SignatureCall(
+                  model_name=model_name,
+                  extracts_key=extracts_key,
+                  signature_name=signature_name,
+                  signature=signature,
+                  inputs=inputs,
+                  input_specs=input_specs,
+                  positional_inputs=positional_inputs))
+    return calls
+
+  def _run_signature_calls(
+      self, calls: List[_SignatureCall],
+      batch_size: int) -> Dict[str, Dict[str, Dict[str, np.ndarray]]]:
+    """Calls the signatures and converts their outputs to numpy once per batch.
+
+    Args:
+      calls: Signature calls.
+      batch_size: Batch size.
+
+    Returns:
+      Batched outputs keyed by extracts key, model name and output name.
+    """
+
+    def to_batched_array(t):
+      arr = t.numpy() if hasattr(t, 'numpy') else np.asarray(t)
+      # Each row of a 1D output is stored as an array of shape [1].
+      return arr.reshape(-1, 1) if arr.ndim == 1 else arr
+
+    def to_dense(t):
+      if isinstance(t, tf.SparseTensor):
+        return tf.sparse.to_dense(t)
+      elif isinstance(t, tf.RaggedTensor):
+        return t.to_tensor()
+      else:
+        return t
+
+    def check_shape(t, batch_size, key=None):
+      if t.shape[0] != batch_size:
+        raise ValueError(
+            'First dimension does not correspond with batch size. '
+            f'Batch size: {batch_size}, Dimensions: {t.shape}, Key: {key}.')
+
+    batched_outputs = {}
+    for call in calls:
+      signature = call.signature
+      inputs = call.inputs
+      try:
+        if isinstance(inputs, dict):
+          if hasattr(signature, 'structured_input_signature'):
+            outputs = signature(**inputs)
+          elif call.positional_inputs:
+            outputs = signature(*inputs.values())
           else:
-            dense_outputs = to_dense(outputs)
-            check_shape(dense_outputs, record_batch.num_rows)
-
-          for i in range(record_batch.num_rows):
-            if isinstance(dense_outputs, dict):
-              output = {
-                  k: maybe_expand_dims(v[i].numpy())
-                  for k, v in dense_outputs.items()
-              }
-            else:
-              output = {
-                  signature_name:
-                      maybe_expand_dims(np.asarray(dense_outputs)[i])
-              }
-            if result[extracts_key][i] is None:
-              result[extracts_key][i] = collections.defaultdict(dict)
-            result[extracts_key][i][model_name].update(output)  # pytype: disable=unsupported-operands
-    for i in range(len(result[extracts_key])):
-      # PyType doesn't recognize isinstance(..., dict).
-      # pytype: disable=attribute-error,unsupported-operands
-      if isinstance(result[extracts_key][i], dict):
-        for model_name, output in result[extracts_key][i].items():
-          if not self._prefer_dict_outputs and len(output) == 1:
-            result[extracts_key][i][model_name] = list(output.values())[0]
+            outputs = signature(inputs)
+        else:
+          outputs = signature(tf.constant(inputs, dtype=tf.string))
+      except (TypeError, tf.errors.InvalidArgumentError) as e:
+        raise ValueError(
+            """Fail to call signature func with signature_name: {}.
+            the inputs are:\n {}.
+            The input_specs are:\n {}.""".format(call.signature_name, inputs,
+                                                 call.input_specs)) from e
+
+      dense_outputs = {}
+      if isinstance(outputs, dict):
+        for k, v in outputs.items():
+          dense_outputs[k] = to_dense(v)
+          check_shape(dense_outputs[k], batch_size, key=k)
+      else:
+        dense_outputs = to_dense(outputs)
+        check_shape(dense_outputs, batch_size)
+
+      if isinstance(dense_outputs, dict):
+        output = {k: to_batched_array(v) for k, v in dense_outputs.items()}
+      else:
+        output = {call.signature_name: to_batched_array(dense_outputs)}
+      outputs_by_model = batched_outputs.setdefault(call.extracts_key, {})
+      outputs_by_model.setdefault(call.model_name, {}).update(output)
+    return batched_outputs
+
+  def _attach_outputs(
+      self, batched_extract: types.Extracts,
+      batched_outputs: Dict[str, Dict[str, Dict[str, np.ndarray]]]
+  ) -> List[types.Extracts]:
+    """Splits the batched outputs into rows and stores them in the extracts."""
+    result = copy.copy(batched_extract)
+    num_rows = batched_extract[constants.ARROW_RECORD_BATCH_KEY].num_rows
+    for extracts_key in self._signature_names.keys():
+      if extracts_key not in result or not result[extracts_key]:
+        result[extracts_key] = [None] * num_rows
+    for extracts_key, outputs_by_model in batched_outputs.items():
+      values = result[extracts_key]
+      for i in range(num_rows):
+        if values[i] is None:
+          values[i] = collections.defaultdict(dict)
+        # PyType doesn't recognize isinstance(..., dict).
+        # pytype: disable=attribute-error,unsupported-operands
+        for model_name, outputs in outputs_by_model.items():
+          values[i][model_name].update({k: v[i] for k, v in outputs.items()})
+          if not self._prefer_dict_outputs and len(values[i][model_name]) == 1:
+            values[i][model_name] = list(values[i][model_name].values())[0]
         # If only one model, the output is stored without using a dict
         if len(self._eval_config.model_specs) == 1:
-          result[extracts_key][i] = list(result[extracts_key][i].values())[0]
-      # pytype: enable=attribute-error,unsupported-operands
+          values[i] = list(values[i].values())[0]
+        # pytype: enable=attribute-error,unsupported-operands
     return [result]
 
 
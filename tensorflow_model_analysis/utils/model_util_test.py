@@ -13,12 +13,16 @@
 # limitations under the License.
 """Tests for model_util."""
 
+import collections
 import tempfile
+import threading
 import unittest
+from unittest import mock
 
 from absl.testing import parameterized
 import apache_beam as beam
 from apache_beam.testing import util
+from apache_beam.transforms import window as beam_window
 import numpy as np
 import pyarrow as pa
 import tensorflow as tf
@@ -45,6 +49,39 @@ def _record_batch_to_extracts(record_batch):
   }
 
 
+def _per_row_outputs(calls_and_outputs, num_rows, num_models,
+                     prefer_dict_outputs):
+  """Splits signature outputs into rows the way it was done row by row."""
+
+  def maybe_expand_dims(arr):
+    if not hasattr(arr, 'shape') or not arr.shape:
+      return np.expand_dims(arr, axis=0)
+    else:
+      return arr
+
+  result = [None] * num_rows
+  for call, outputs in calls_and_outputs:
+    for i in range(num_rows):
+      if isinstance(outputs, dict):
+        output = {
+            k: maybe_expand_dims(v[i].numpy()) for k, v in outputs.items()
+        }
+      else:
+        output = {
+            call.signature_name: maybe_expand_dims(np.asarray(outputs)[i])
+        }
+      if result[i] is None:
+        result[i] = collections.defaultdict(dict)
+      result[i][call.model_name].update(output)
+  for i in range(num_rows):
+    for model_name, output in result[i].items():
+      if not prefer_dict_outputs and len(output) == 1:
+        result[i][model_name] = list(output.values())[0]
+    if num_models == 1:
+      result[i] = list(result[i].values())[0]
+  return result
+
+
 class ModelUtilTest(testutil.TensorflowModelAnalysisTest,
                     parameterized.TestCase):
 
@@ -167,6 +204,15 @@ class ModelUtilTest(testutil.TensorflowModelAnalysisTest,
       tf.saved_model.save(model, export_path, signatures=signatures)
     return export_path
 
+  def predictWithMultipleDenseInputs(self, export_path, inputs):
+    model = tf.keras.models.load_model(export_path)
+    return model({
+        'input_1': np.array([[input_1] for input_1, _ in inputs],
+                            dtype=np.float32),
+        'input_2': np.array([[input_2] for _, input_2 in inputs],
+                            dtype=np.float32)
+    }).numpy()
+
   def createModelWithInvalidOutputShape(self):
     input1 = tf.keras.layers.Input(shape=(1,), name='input_1')
     input2 = tf.keras.layers.Input(shape=(1,), name='input_2')
@@ -861,6 +907,161 @@ class ModelUtilTest(testutil.TensorflowModelAnalysisTest,
 
       util.assert_that(result, check_result, label='result')
 
+  @unittest.skipIf(_TF_MAJOR_VERSION < 2,
+                   'not all signatures supported for TF1')
+  def testModelSignaturesDoFnWithPipelinedInference(self):
+    export_path = self.createModelWithMultipleDenseInputs(True)
+    signature_names = {constants.PREDICTIONS_KEY: {'': [None]}}
+    eval_shared_models = {
+        '':
+            self.createTestEvalSharedModel(
+                eval_saved_model_path=export_path,
+                tags=[tf.saved_model.SERVING])
+    }
+    eval_config = config_pb2.EvalConfig(model_specs=[config_pb2.ModelSpec()])
+    eval_config.options.pipelined_inference.value = True
+    schema = self.createDenseInputsSchema()
+    tfx_io = tf_example_record.TFExampleBeamRecord(
+        physical_format='text',
+        schema=schema,
+        raw_record_column_name=constants.ARROW_INPUT_COLUMN)
+    tensor_adapter_config = tensor_adapter.TensorAdapterConfig(
+        arrow_schema=tfx_io.ArrowSchema(),
+        tensor_representations=tfx_io.TensorRepresentations())
+
+    inputs = [(float(i), float(i + 1)) for i in range(10)]
+    examples = [
+        self._makeExample(input_1=input_1, input_2=input_2)
+        for input_1, input_2 in inputs
+    ]
+    example_indices = {
+        e.SerializeToString(): i for i, e in enumerate(examples)
+    }
+    expected_predictions = self.predictWithMultipleDenseInputs(
+        export_path, inputs)
+
+    with beam.Pipeline() as pipeline:
+      # pylint: disable=no-value-for-parameter
+      result = (
+          pipeline
+          | 'Create' >> beam.Create([e.SerializeToString() for e in examples])
+          | 'BatchExamples' >> tfx_io.BeamSource(batch_size=2)
+          | 'ToExtracts' >> beam.Map(_record_batch_to_extracts)
+          | 'ModelSignatures' >> beam.ParDo(
+              model_util.ModelSignaturesDoFn(
+                  eval_config=eval_config,
+                  eval_shared_models=eval_shared_models,
+                  signature_names=signature_names,
+                  default_signature_names=None,
+                  prefer_dict_outputs=False,
+                  tensor_adapter_config=tensor_adapter_config)))
+
+      # pylint: enable=no-value-for-parameter
+
+      def check_result(got):
+        try:
+          self.assertLen(got, 5)
+          got_indices = []
+          for extracts in got:
+            self.assertLen(extracts[constants.PREDICTIONS_KEY],
+                           len(extracts[constants.INPUT_KEY]))
+            for serialized, prediction in zip(
+                extracts[constants.INPUT_KEY],
+                extracts[constants.PREDICTIONS_KEY]):
+              index = example_indices[serialized]
+              got_indices.append(index)
+              self.assertAllClose(expected_predictions[index], prediction)
+          self.assertCountEqual(range(10), got_indices)
+        except AssertionError as err:
+          raise util.BeamAssertException(err)
+
+      util.assert_that(result, check_result, label='result')
+
+  @unittest.skipIf(_TF_MAJOR_VERSION < 2,
+                   'not all signatures supported for TF1')
+  def testModelSignaturesDoFnWithPipelinedInferenceKeepsInputOrder(self):
+    export_path = self.createModelWithMultipleDenseInputs(True)
+    eval_shared_models = {
+        '':
+            self.createTestEvalSharedModel(
+                eval_saved_model_path=export_path,
+                tags=[tf.saved_model.SERVING])
+    }
+    eval_config = config_pb2.EvalConfig(model_specs=[config_pb2.ModelSpec()])
+    eval_config.options.pipelined_inference.value = True
+    do_fn = model_util.ModelSignaturesDoFn(
+        eval_config=eval_config,
+        eval_shared_models=eval_shared_models,
+        signature_names={constants.PREDICTIONS_KEY: {
+            '': [None]
+        }},
+        prefer_dict_outputs=False)
+
+    inputs = [(float(i), float(i + 1)) for i in range(8)]
+    serialized_examples = [
+        self._makeExample(input_1=input_1,
+                          input_2=input_2).SerializeToString()
+        for input_1, input_2 in inputs
+    ]
+    expected_predictions = self.predictWithMultipleDenseInputs(
+        export_path, inputs)
+
+    def make_element(start, end):
+      return {
+          # Only need the num_rows from RecordBatch so use fake array of same
+          # len.
+          constants.ARROW_RECORD_BATCH_KEY:
+              pa.RecordBatch.from_arrays(
+                  [pa.array([[i] for i in range(start, end)])], ['dummy']),
+          constants.INPUT_KEY:
+              np.array(serialized_examples[start:end], dtype=object),
+      }
+
+    # Model execution is blocked after the first two batches so that the
+    # following batches are still in flight when the bundle finishes.
+    unblock_batches = threading.Event()
+    run_pipelined_calls = do_fn._run_pipelined_calls
+    num_runs = []
+
+    def blocking_run_pipelined_calls(calls_future, batch_size):
+      num_runs.append(batch_size)
+      if len(num_runs) > 2:
+        unblock_batches.wait()
+      return run_pipelined_calls(calls_future, batch_size)
+
+    with mock.patch.object(model_util, '_PIPELINED_INFERENCE_MAX_BATCHES', 2):
+      with mock.patch.object(
+          do_fn,
+          '_run_pipelined_calls',
+          side_effect=blocking_run_pipelined_calls):
+        do_fn.setup()
+        processed = []
+        for start in range(0, 8, 2):
+          processed.extend(
+              do_fn.process(
+                  make_element(start, start + 2),
+                  timestamp=0,
+                  window=beam_window.GlobalWindow()))
+        self.assertLen(do_fn._in_flight_batches, 2)
+        unblock_batches.set()
+        flushed = list(do_fn.finish_bundle())
+        do_fn.teardown()
+
+    self.assertLen(processed, 2)
+    self.assertLen(flushed, 2)
+    got = [windowed_value.value for windowed_value in processed + flushed]
+    self.assertEqual(
+        serialized_examples,
+        [serialized for extracts in got
+         for serialized in extracts[constants.INPUT_KEY]])
+    got_predictions = [
+        prediction for extracts in got
+        for prediction in extracts[constants.PREDICTIONS_KEY]
+    ]
+    self.assertLen(got_predictions, 8)
+    for expected, prediction in zip(expected_predictions, got_predictions):
+      self.assertAllClose(expected, prediction)
+
   def testModelSignaturesDoFnError(self):
     export_path = self.createModelWithInvalidOutputShape()
     signature_names = {constants.PREDICTIONS_KEY: {'': [None]}}
@@ -905,6 +1106,253 @@ class ModelUtilTest(testutil.TensorflowModelAnalysisTest,
                     prefer_dict_outputs=False,
                     tensor_adapter_config=tensor_adapter_config)))
 
+  @parameterized.named_parameters(
+      ('1d_output', [''], {
+          '': np.array([0.1, 0.2, 0.3])
+      }, False),
+      ('2d_output', [''], {
+          '': np.array([[0.1, 0.9], [0.2, 0.8], [0.3, 0.7]])
+      }, False),
+      ('dict_output', [''], {
+          '': {
+              'output_1': np.array([1, 2, 3]),
+              'output_2': np.array([[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]])
+          }
+      }, False),
+      ('single_entry_dict_output', [''], {
+          '': {
+              'output_1': np.array([1, 2, 3])
+          }
+      }, False),
+      ('prefer_dict_outputs', [''], {
+          '': np.array([0.1, 0.2, 0.3])
+      }, True),
+      ('multi_model', ['model1', 'model2'], {
+          'model1': np.array([0.1, 0.2, 0.3]),
+          'model2': {
+              'output_1': np.array([[1], [2], [3]]),
+              'output_2': np.array([[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]])
+          }
+      }, False),
+  )
+  def testModelSignaturesDoFnOutputsMatchPerRowOutputs(self, model_names,
+                                                       outputs_by_model,
+                                                       prefer_dict_outputs):
+    eval_config = config_pb2.EvalConfig(model_specs=[
+        config_pb2.ModelSpec(name=model_name) for model_name in model_names
+    ])
+    do_fn = model_util.ModelSignaturesDoFn(
+        eval_config=eval_config,
+        eval_shared_models={},
+        signature_names={
+            constants.PREDICTIONS_KEY: {
+                model_name: ['serving_default'] for model_name in model_names
+            }
+        },
+        prefer_dict_outputs=prefer_dict_outputs)
+    calls_and_outputs = [(model_util._SignatureCall(
+        model_name=model_name,
+        extracts_key=constants.PREDICTIONS_KEY,
+        signature_name='serving_default',
+        signature=lambda inputs, outputs=outputs: outputs,
+        inputs={'input': tf.constant([1, 2, 3])},
+        input_specs=None,
+        positional_inputs=False), outputs)
+                         for model_name, outputs in tf.nest.map_structure(
+                             tf.constant, outputs_by_model).items()]
+    batched_extract = {
+        constants.ARROW_RECORD_BATCH_KEY:
+            pa.RecordBatch.from_arrays([pa.array([[1], [2], [3]])],
+                                       ['input']),
+    }
+
+    batched_outputs = do_fn._run_signature_calls(
+        [call for call, _ in calls_and_outputs], 3)
+    got = do_fn._attach_outputs(batched_extract, batched_outputs)
+
+    self.assertLen(got, 1)
+    expected = _per_row_outputs(calls_and_outputs, 3, len(model_names),
+                                prefer_dict_outputs)
+    self.assertLen(got[0][constants.PREDICTIONS_KEY], 3)
+    for got_row, expected_row in zip(got[0][constants.PREDICTIONS_KEY],
+                                     expected):
+      self.assertEqual(
+          isinstance(expected_row, dict), isinstance(got_row, dict))
+      self.assertAllClose(expected_row, got_row)
+
+  @parameterized.named_parameters(
+      ('same_input_specs', ['input_1', 'input_2'], ['input_1', 'input_2'], 1),
+      ('different_input_specs', ['input_1'], ['input_2'], 2),
+  )
+  def testModelSignaturesDoFnSharesInputConversions(self, model1_inputs,
+                                                    model2_inputs,
+                                                    expected_get_inputs_calls):
+    input_specs = {
+        'input_1': tf.TensorSpec(shape=(None, 1), dtype=tf.float32),
+        'input_2': tf.TensorSpec(shape=(None, 1), dtype=tf.float32),
+    }
+    input_specs_by_model = {
+        'model1': {k: input_specs[k] for k in model1_inputs},
+        'model2': {k: input_specs[k] for k in model2_inputs},
+    }
+    record_batch = pa.RecordBatch.from_arrays(
+        [pa.array([[1.0], [2.0]]),
+         pa.array([[3.0], [4.0]])], ['input_1', 'input_2'])
+    tensor_adapter_config = tensor_adapter.TensorAdapterConfig(
+        arrow_schema=record_batch.schema,
+        tensor_representations=model_util
+        .input_specs_to_tensor_representations(input_specs))
+    eval_config = config_pb2.EvalConfig(model_specs=[
+        config_pb2.ModelSpec(name='model1'),
+        config_pb2.ModelSpec(name='model2')
+    ])
+    do_fn = model_util.ModelSignaturesDoFn(
+        eval_config=eval_config,
+        eval_shared_models={},
+        signature_names={
+            constants.PREDICTIONS_KEY: {
+                'model1': ['serving_default'],
+                'model2': ['serving_default']
+            }
+        },
+        tensor_adapter_config=tensor_adapter_config)
+    # Set up the state normally created in setup without loading models.
+    do_fn._tensor_adapter = tensor_adapter.TensorAdapter(tensor_adapter_config)
+    do_fn._loaded_models = {'model1': 'model1', 'model2': 'model2'}
+
+    with mock.patch.object(
+        model_util,
+        'get_input_specs',
+        side_effect=lambda model, *args: input_specs_by_model[model]
+    ), mock.patch.object(
+        model_util, 'get_callable', return_value=lambda inputs: inputs
+    ), mock.patch.object(
+        model_util, 'get_inputs', wraps=model_util.get_inputs
+    ) as mock_get_inputs, mock.patch.object(
+        tensor_adapter.TensorAdapter,
+        'ToBatchTensors',
+        autospec=True,
+        side_effect=tensor_adapter.TensorAdapter.ToBatchTensors
+    ) as mock_to_batch_tensors:
+      calls = do_fn._prepare_signature_calls({
+          constants.ARROW_RECORD_BATCH_KEY: record_batch,
+          constants.INPUT_KEY: None
+      })
+
+    self.assertEqual(expected_get_inputs_calls, mock_get_inputs.call_count)
+    # Record batches are only converted once per adapter.
+    self.assertEqual(1, mock_to_batch_tensors.call_count)
+    self.assertLen(calls, 2)
+    inputs_by_model = {call.model_name: call.inputs for call in calls}
+    self.assertCountEqual(model1_inputs, inputs_by_model['model1'].keys())
+    self.assertCountEqual(model2_inputs, inputs_by_model['model2'].keys())
+    if expected_get_inputs_calls == 1:
+      self.assertIs(inputs_by_model['model1'], inputs_by_model['model2'])
+    self.assertAllClose([[1.0], [2.0]], inputs_by_model['model1']['input_1'])
+    self.assertAllClose([[3.0], [4.0]], inputs_by_model['model2']['input_2'])
+
+  def testBatchReducibleBatchedDoFnWithModelsBisectsFailedBatches(self):
+
+    class _FailingDoFn(model_util.BatchReducibleBatchedDoFnWithModels):
+
+      def __init__(self):
+        super().__init__({})
+        self.batch_sizes = []
+
+      def _batch_reducible_process(self, element):
+        inputs = list(element[constants.INPUT_KEY])
+        self.batch_sizes.append(len(inputs))
+        # Fails for any batch containing the large input (except on its own).
+        if b'large' in inputs and len(inputs) > 1:
+          raise tf.errors.ResourceExhaustedError(None, None, 'OOM')
+        return [element]
+
+    inputs = [b'example'] * 8
+    inputs[5] = b'large'
+    element = {
+        constants.ARROW_RECORD_BATCH_KEY:
+            pa.RecordBatch.from_arrays([pa.array([[i] for i in range(8)])],
+                                       ['feature']),
+        constants.INPUT_KEY:
+            np.array(inputs, dtype=object),
+    }
+
+    do_fn = _FailingDoFn()
+    result = do_fn.process(element)
+
+    self.assertEqual([8, 4, 4, 2, 1, 1, 2], do_fn.batch_sizes)
+    self.assertEqual([4, 1, 1, 2], [
+        extracts[constants.ARROW_RECORD_BATCH_KEY].num_rows
+        for extracts in result
+    ])
+    self.assertEqual(inputs, [
+        i for extracts in result for i in extracts[constants.INPUT_KEY]
+    ])
+    self.assertEqual(
+        list(range(8)),
+        [i for extracts in result for [i] in extracts[
+            constants.ARROW_RECORD_BATCH_KEY].column(0).to_pylist()])
+
+  def testAdaptiveBatchSizeController(self):
+    controller = model_util._AdaptiveBatchSizeController()
+
+    def latency(batch_size):
+      # Per example cost increases for batch sizes above 256.
+      return 0.01 + 0.0001 * batch_size * max(1.0, batch_size / 256)**2
+
+    batch_sizes = []
+    for _ in range(50):
+      batch_size = controller.batch_size(1024)
+      batch_sizes.append(batch_size)
+      for start in range(0, 1024, batch_size):
+        size = min(batch_size, 1024 - start)
+        controller.record_success(size, latency(size))
+
+    self.assertEqual(1024, batch_sizes[0])
+    self.assertEqual(256, batch_sizes[-1])
+
+  def testAdaptiveBatchSizeControllerWithFailures(self):
+    controller = model_util._AdaptiveBatchSizeController()
+    self.assertEqual(1000, controller.batch_size(1000))
+    controller.record_failure(1000)
+    self.assertEqual(500, controller.batch_size(1000))
+    # Batch sizes larger than the incoming batches are not used.
+    self.assertEqual(100, controller.batch_size(100))
+
+  def testBatchReducibleBatchedDoFnWithModelsWithAdaptiveBatchSize(self):
+
+    class _OutOfMemoryDoFn(model_util.BatchReducibleBatchedDoFnWithModels):
+
+      def __init__(self):
+        super().__init__({}, adaptive_batch_size=True)
+        self.batch_sizes = []
+
+      def _batch_reducible_process(self, element):
+        batch_size = element[constants.ARROW_RECORD_BATCH_KEY].num_rows
+        self.batch_sizes.append(batch_size)
+        if batch_size > 4:
+          raise tf.errors.ResourceExhaustedError(None, None, 'OOM')
+        return [element]
+
+    def make_element():
+      return {
+          constants.ARROW_RECORD_BATCH_KEY:
+              pa.RecordBatch.from_arrays([pa.array([[i] for i in range(8)])],
+                                         ['feature']),
+          constants.INPUT_KEY:
+              np.array([b'example'] * 8, dtype=object),
+      }
+
+    do_fn = _OutOfMemoryDoFn()
+    do_fn.setup()
+    self.assertLen(do_fn.process(make_element()), 2)
+    self.assertEqual([8, 4, 4], do_fn.batch_sizes)
+
+    # The failed batch size is no longer used for the following batches.
+    do_fn.batch_sizes = []
+    self.assertLen(do_fn.process(make_element()), 2)
+    self.assertEqual([4, 4], do_fn.batch_sizes)
+
   def testHasRubberStamp(self):
     # Model agnostic.
     self.assertFalse(model_util.has_rubber_stamp(None))
@@ -0,0 +1,416 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Persistent cache of model outputs keyed by model and example fingerprints.
+
+The cache is stored as parquet files under a directory named after the
+fingerprint of the models and settings used to compute the outputs. Each file
+contains a column with the fingerprints of the serialized examples and typed
+columns with the outputs computed for those examples. Each (possibly nested)
+output value is stored as a list column with its flattened values and a list
+column with its shape, named after the path of the value in the outputs. Files
+are only ever added (one set of files per bundle that computed new outputs), so
+concurrent writers never conflict.
+
+Lookups are done by joining the fingerprints of the examples with the stored
+outputs, so the batches themselves are never shuffled and the size of the cache
+is not limited by the memory of the workers.
+"""
+
+import copy
+import hashlib
+import json
+import os
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Sequence, Tuple
+import uuid
+
+from absl import logging
+import apache_beam as beam
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import tensorflow as tf
+from tensorflow_model_analysis import constants
+from tensorflow_model_analysis import types
+
+_EXAMPLE_FINGERPRINT_COLUMN = 'example_fingerprint'
+_VALUES_COLUMN_SUFFIX = '.values'
+_SHAPE_COLUMN_SUFFIX = '.shape'
+_FILE_SUFFIX = '.parquet'
+_TEMP_FILE_SUFFIX = '.tmp'
+# Maximum number of new outputs buffered by a worker before they are written.
+_MAX_BUFFERED_OUTPUTS = 100000
+# SavedModel variable shards are checksummed in the variables index so hashing
+# the index is sufficient (and much cheaper than hashing the shards).
+_VARIABLES_INDEX_FILE_NAME = 'variables.index'
+_VARIABLES_DATA_FILE_PREFIX = 'variables.data'
+# Row aligned fingerprints of the serialized examples of the batched extracts
+# whose outputs are looked up in (and added to) the cache.
+_EXAMPLE_FINGERPRINTS_KEY = '_example_fingerprints'
+_CACHED_OUTPUTS = 'cached_outputs'
+_REQUESTS = 'requests'
+_CACHED_TAG = 'cached'
+_UNCACHED_TAG = 'uncached'
+
+
+def model_fingerprint(model_path: str) -> str:
+  """Returns a fingerprint of the contents of the model at model_path."""
+  hasher = hashlib.sha256()
+  if not tf.io.gfile.isdir(model_path):
+    with tf.io.gfile.GFile(model_path, 'rb') as f:
+      hasher.update(f.read())
+    return hasher.hexdigest()
+  for dir_name, _, file_names in sorted(tf.io.gfile.walk(model_path)):
+    has_variables_index = _VARIABLES_INDEX_FILE_NAME in file_names
+    for file_name in sorted(file_names):
+      if (has_variables_index and
+          file_name.startswith(_VARIABLES_DATA_FILE_PREFIX)):
+        continue
+      path = os.path.join(dir_name, file_name)
+      hasher.update(os.path.relpath(path, model_path).encode())
+      with tf.io.gfile.GFile(path, 'rb') as f:
+        hasher.update(f.read())
+  return hasher.hexdigest()
+
+
+def cache_fingerprint(model_paths: Dict[str, str], settings: Any) -> str:
+  """Returns the fingerprint of the models and settings used for outputs.
+
+  Args:
+    model_paths: Model paths keyed by model name.
+    settings: JSON serializable settings that affect the outputs (e.g. the
+      signature names used).
+  """
+  return hashlib.sha256(
+      json.dumps(
+          {
+              'models': {
+                  name: model_fingerprint(path)
+                  for name, path in model_paths.items()
+              },
+              'settings': settings,
+          },
+          sort_keys=True,
+          default=str).encode()).hexdigest()
+
+
+def example_fingerprints(serialized_examples: Iterable[bytes]) -> List[bytes]:
+  """Returns the fingerprints of the given serialized examples."""
+  return [
+      hashlib.blake2b(example, digest_size=16).digest()
+      for example in serialized_examples
+  ]
+
+
+def _take_batched_extract(element: types.Extracts,
+                          indices: Sequence[int]) -> types.Extracts:
+  """Returns the given rows of a batched extract."""
+  result = {}
+  for key, value in element.items():
+    if key == constants.ARROW_RECORD_BATCH_KEY:
+      result[key] = value.take(pa.array(indices, pa.int64()))
+    elif isinstance(value, np.ndarray):
+      result[key] = value[list(indices)]
+    else:
+      result[key] = [value[i] for i in indices]
+  return result
+
+
+def _flatten_outputs(
+    outputs: Any,
+    path: Tuple[Any, ...] = ()) -> Iterator[Tuple[Tuple[Any, ...], np.ndarray]]:
+  """Yields the (path, value) of each array in the (nested) outputs."""
+  if isinstance(outputs, Mapping):
+    for key in sorted(outputs):
+      yield from _flatten_outputs(outputs[key], path + (key,))
+  else:
+    yield path, np.asarray(outputs)
+
+
+def _column_names(path: Tuple[Any, ...]) -> Tuple[str, str]:
+  """Returns the names of the values and shape columns for an output path."""
+  name = json.dumps(path)
+  return name + _VALUES_COLUMN_SUFFIX, name + _SHAPE_COLUMN_SUFFIX
+
+
+def _encode_outputs(fingerprints: Sequence[bytes],
+                    outputs: Sequence[Dict[str, Any]]) -> pa.RecordBatch:
+  """Encodes the outputs computed for each example as typed Arrow columns.
+
+  Args:
+    fingerprints: Fingerprints of the examples.
+    outputs: Row aligned (possibly nested) dicts of the outputs computed for the
+      examples. The outputs of all rows must have the same structure.
+
+  Returns:
+    RecordBatch with the example fingerprints and the values and shapes of each
+    output.
+
+  Raises:
+    ValueError: If the outputs can not be stored as typed columns.
+  """
+  flat_outputs = [dict(_flatten_outputs(output)) for output in outputs]
+  paths = list(flat_outputs[0]) if flat_outputs else []
+  arrays = [pa.array(fingerprints, pa.binary())]
+  names = [_EXAMPLE_FINGERPRINT_COLUMN]
+  if any(flat_output.keys() != flat_outputs[0].keys()
+         for flat_output in flat_outputs):
+    raise ValueError('outputs of all examples must have the same structure')
+  for path in paths:
+    values = [flat_output[path] for flat_output in flat_outputs]
+    offsets = np.zeros(len(values) + 1, dtype=np.int32)
+    np.cumsum([v.size for v in values], out=offsets[1:])
+    try:
+      flat_values = pa.array(np.concatenate([v.ravel() for v in values]))
+    except pa.ArrowException as e:
+      raise ValueError(f'unsupported output type: path={path}') from e
+    arrays.append(
+        pa.ListArray.from_arrays(pa.array(offsets, pa.int32()), flat_values))
+    arrays.append(
+        pa.array([v.shape for v in values], pa.list_(pa.int64())))
+    names.extend(_column_names(path))
+  return pa.RecordBatch.from_arrays(arrays, names)
+
+
+def _decode_outputs(
+    table: pa.Table) -> Iterator[Tuple[bytes, Dict[str, Any]]]:
+  """Yields the (example fingerprint, outputs) stored in the table."""
+  columns = []
+  for name in table.column_names:
+    if not name.endswith(_VALUES_COLUMN_SUFFIX):
+      continue
+    path = tuple(json.loads(name[:-len(_VALUES_COLUMN_SUFFIX)]))
+    values_name, shape_name = _column_names(path)
+    values = table.column(values_name).combine_chunks()
+    # The list offsets are relative to the (unsliced) flattened values.
+    flat_values = values.values.to_numpy(zero_copy_only=False, writable=True)
+    columns.append((path, flat_values, values.offsets.to_numpy(),
+                    table.column(shape_name).to_pylist()))
+  for i, fingerprint in enumerate(
+      table.column(_EXAMPLE_FINGERPRINT_COLUMN).to_pylist()):
+    outputs = {}
+    for path, flat_values, offsets, shapes in columns:
+      value = flat_values[offsets[i]:offsets[i + 1]].reshape(shapes[i])
+      parent = outputs
+      for key in path[:-1]:
+        parent = parent.setdefault(key, {})
+      # Scalars are stored with an empty shape.
+      parent[path[-1]] = value if shapes[i] else value[()]
+    yield fingerprint, outputs
+
+
+def _add_example_fingerprints(batched_extract: types.Extracts,
+                              extracts_keys: Sequence[str]) -> types.Extracts:
+  """Adds the fingerprints of the serialized examples to a batched extract.
+
+  Batches without serialized examples or that already contain values for the
+  extracts_keys bypass the cache (no fingerprints are added).
+
+  Args:
+    batched_extract: Batched extract.
+    extracts_keys: Extracts keys whose values are cached.
+
+  Returns:
+    Batched extract with the example fingerprints.
+  """
+  serialized_examples = batched_extract.get(constants.INPUT_KEY)
+  if serialized_examples is None or any(
+      batched_extract.get(k) for k in extracts_keys):
+    return batched_extract
+  result = copy.copy(batched_extract)
+  result[_EXAMPLE_FINGERPRINTS_KEY] = example_fingerprints(serialized_examples)
+  return result
+
+
+def _fingerprint_requests(
+    batched_extract: types.Extracts) -> Iterator[Tuple[bytes, None]]:
+  for fingerprint in set(batched_extract.get(_EXAMPLE_FINGERPRINTS_KEY, [])):
+    yield fingerprint, None
+
+
+def _requested_outputs(
+    fingerprint_and_groups: Tuple[bytes, Dict[str, List[Any]]]
+) -> Iterator[Tuple[bytes, Dict[str, Any]]]:
+  fingerprint, groups = fingerprint_and_groups
+  # Concurrent runs may have stored the same outputs more than once.
+  outputs = next(iter(groups[_CACHED_OUTPUTS]), None)
+  if outputs is not None and list(groups[_REQUESTS]):
+    yield fingerprint, outputs
+
+
+@beam.typehints.with_input_types(types.Extracts)
+@beam.typehints.with_output_types(types.Extracts)
+class _SplitCachedRowsDoFn(beam.DoFn):
+  """Splits batches into rows with cached outputs and rows to compute."""
+
+  def __init__(self, extracts_keys: Sequence[str]):
+    self._extracts_keys = extracts_keys
+    self._num_prediction_cache_hits = beam.metrics.Metrics.counter(
+        constants.METRICS_NAMESPACE, 'num_prediction_cache_hits')
+
+  def process(self, batched_extract: types.Extracts,
+              cached_outputs: Mapping[bytes, Dict[str, Any]]) -> Iterator[Any]:
+    fingerprints = batched_extract.get(_EXAMPLE_FINGERPRINTS_KEY)
+    if fingerprints is None:
+      yield beam.pvalue.TaggedOutput(_UNCACHED_TAG, batched_extract)
+      return
+    hits = [i for i, f in enumerate(fingerprints) if f in cached_outputs]
+    if not hits:
+      yield beam.pvalue.TaggedOutput(_UNCACHED_TAG, batched_extract)
+      return
+    self._num_prediction_cache_hits.inc(len(hits))
+    misses = [i for i, f in enumerate(fingerprints) if f not in cached_outputs]
+    if misses:
+      yield beam.pvalue.TaggedOutput(
+          _UNCACHED_TAG, _take_batched_extract(batched_extract, misses))
+    result = (
+        copy.copy(batched_extract)
+        if not misses else _take_batched_extract(batched_extract, hits))
+    del result[_EXAMPLE_FINGERPRINTS_KEY]
+    # The cached outputs may be shared by multiple rows (and batches) so each
+    # row gets its own copy.
+    outputs = [copy.deepcopy(cached_outputs[fingerprints[i]]) for i in hits]
+    for extracts_key in self._extracts_keys:
+      result[extracts_key] = [output[extracts_key] for output in outputs]
+    yield result
+
+
+@beam.typehints.with_input_types(types.Extracts)
+@beam.typehints.with_output_types(types.Extracts)
+class _WriteNewOutputsDoFn(beam.DoFn):
+  """Removes the example fingerprints and writes the new outputs to the cache.
+
+  The new outputs are buffered and written to a new file in the cache directory
+  at the end of each bundle (or once too many outputs are buffered).
+  """
+
+  def __init__(self, cache_dir: str, extracts_keys: Sequence[str]):
+    self._cache_dir = cache_dir
+    self._extracts_keys = extracts_keys
+    self._new_outputs = []
+    self._num_buffered_outputs = 0
+    self._num_prediction_cache_misses = beam.metrics.Metrics.counter(
+        constants.METRICS_NAMESPACE, 'num_prediction_cache_misses')
+
+  def start_bundle(self):
+    self._new_outputs = []
+    self._num_buffered_outputs = 0
+
+  def process(self, batched_extract: types.Extracts) -> Iterator[Any]:
+    if _EXAMPLE_FINGERPRINTS_KEY not in batched_extract:
+      yield batched_extract
+      return
+    result = copy.copy(batched_extract)
+    fingerprints = result.pop(_EXAMPLE_FINGERPRINTS_KEY)
+    self._num_prediction_cache_misses.inc(len(fingerprints))
+    try:
+      new_outputs = _encode_outputs(fingerprints, [
+          {k: result[k][i] for k in self._extracts_keys}
+          for i in range(len(fingerprints))
+      ])
+    except ValueError as e:
+      logging.log_every_n(logging.WARNING,
+                          'Outputs will not be cached: %s', 100, e)
+    else:
+      self._new_outputs.append(new_outputs)
+      self._num_buffered_outputs += new_outputs.num_rows
+      if self._num_buffered_outputs >= _MAX_BUFFERED_OUTPUTS:
+        self._write_new_outputs()
+    yield result
+
+  def finish_bundle(self):
+    self._write_new_outputs()
+
+  def _write_new_outputs(self):
+    """Writes the buffered outputs (one file per distinct schema)."""
+    new_outputs_by_schema = {}
+    for new_outputs in self._new_outputs:
+      new_outputs_by_schema.setdefault(new_outputs.schema.to_string(),
+                                       []).append(new_outputs)
+    self._new_outputs = []
+    self._num_buffered_outputs = 0
+    if not new_outputs_by_schema:
+      return
+    tf.io.gfile.makedirs(self._cache_dir)
+    for batches in new_outputs_by_schema.values():
+      path = os.path.join(self._cache_dir, uuid.uuid4().hex)
+      # Files are written under a temporary name first so that partially
+      # written files are never read.
+      with tf.io.gfile.GFile(path + _TEMP_FILE_SUFFIX, 'wb') as f:
+        pq.write_table(pa.Table.from_batches(batches), f)
+      tf.io.gfile.rename(path + _TEMP_FILE_SUFFIX, path + _FILE_SUFFIX)
+
+
+@beam.ptransform_fn
+@beam.typehints.with_input_types(types.Extracts)
+@beam.typehints.with_output_types(types.Extracts)
+def ComputeWithCache(  # pylint: disable=invalid-name
+    extracts: beam.pvalue.PCollection, compute: beam.PTransform,
+    cache_dir: str, extracts_keys: Sequence[str]) -> beam.pvalue.PCollection:
+  """Computes the extracts_keys of batched extracts using a persistent cache.
+
+  The fingerprints of the serialized examples (tfma.INPUT_KEY) are joined with
+  the outputs stored in cache_dir. Rows with stored outputs are served from the
+  cache while the remaining rows of each batch are passed to compute and their
+  outputs are added to the cache. Only the fingerprints and the stored outputs
+  are shuffled, the batches themselves are processed where they are.
+
+  Args:
+    extracts: PCollection of batched extracts.
+    compute: PTransform that adds the values for extracts_keys to batched
+      extracts. Keys it does not know about are expected to be passed through
+      (and sliced along with the batch).
+    cache_dir: Directory of the cache (e.g. named after the cache_fingerprint
+      of the models used by compute).
+    extracts_keys: Extracts keys whose values are cached. The values must be
+      (possibly nested dicts of) numeric, boolean or string arrays.
+
+  Returns:
+    PCollection of batched extracts updated with the values for extracts_keys.
+    The rows of a batch may be split across multiple extracts.
+  """
+  extracts = extracts | 'AddExampleFingerprints' >> beam.Map(
+      _add_example_fingerprints, extracts_keys=extracts_keys)
+  file_pattern = os.path.join(cache_dir, '*' + _FILE_SUFFIX)
+  cached = None
+  if tf.io.gfile.glob(file_pattern):
+    cached_outputs = (
+        extracts.pipeline
+        | 'ReadCachedOutputs' >> beam.io.ReadFromParquetBatched(file_pattern)
+        | 'DecodeCachedOutputs' >> beam.FlatMap(_decode_outputs))
+    requested_outputs = ({
+        _REQUESTS:
+            extracts
+            | 'FingerprintRequests' >> beam.FlatMap(_fingerprint_requests),
+        _CACHED_OUTPUTS:
+            cached_outputs
+    }
+                         | 'JoinCachedOutputs' >> beam.CoGroupByKey()
+                         | 'RequestedOutputs' >> beam.FlatMap(
+                             _requested_outputs))
+    split = (
+        extracts
+        | 'SplitCachedRows' >> beam.ParDo(
+            _SplitCachedRowsDoFn(extracts_keys),
+            cached_outputs=beam.pvalue.AsDict(requested_outputs)).with_outputs(
+                _UNCACHED_TAG, main=_CACHED_TAG))
+    cached, extracts = split[_CACHED_TAG], split[_UNCACHED_TAG]
+  computed = (
+      extracts
+      | 'Compute' >> compute
+      | 'WriteNewOutputs' >> beam.ParDo(
+          _WriteNewOutputsDoFn(cache_dir, extracts_keys)))
+  if cached is None:
+    return computed
+  return ((cached, computed)
+          | 'FlattenCachedAndComputed' >> beam.Flatten())
@@ -0,0 +1,239 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for prediction_cache."""
+
+import copy
+import os
+
+import apache_beam as beam
+from apache_beam.testing import util
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import tensorflow as tf
+from tensorflow_model_analysis import constants
+from tensorflow_model_analysis.utils import prediction_cache
+
+
+class PredictionCacheTest(tf.test.TestCase):
+
+  def _write_file(self, path, contents):
+    tf.io.gfile.makedirs(os.path.dirname(path))
+    with tf.io.gfile.GFile(path, 'wb') as f:
+      f.write(contents)
+
+  def testModelFingerprint(self):
+    model_path = self.create_tempdir().full_path
+    self._write_file(os.path.join(model_path, 'saved_model.pb'), b'graph')
+    self._write_file(
+        os.path.join(model_path, 'variables', 'variables.index'), b'index')
+    data_path = os.path.join(model_path, 'variables',
+                             'variables.data-00000-of-00001')
+    self._write_file(data_path, b'data')
+    fingerprint = prediction_cache.model_fingerprint(model_path)
+
+    # Variable shards are covered by the checksums in the variables index.
+    self._write_file(data_path, b'other data')
+    self.assertEqual(fingerprint,
+                     prediction_cache.model_fingerprint(model_path))
+
+    self._write_file(os.path.join(model_path, 'saved_model.pb'), b'new graph')
+    self.assertNotEqual(fingerprint,
+                        prediction_cache.model_fingerprint(model_path))
+
+  def testExampleFingerprints(self):
+    fingerprints = prediction_cache.example_fingerprints(
+        [b'ex1', b'ex2', b'ex1'])
+    self.assertLen(fingerprints, 3)
+    self.assertNotEqual(fingerprints[0], fingerprints[1])
+    self.assertEqual(fingerprints[0], fingerprints[2])
+
+  def _assert_predictions_with_cache(self, cache_dir, serialized_examples,
+                                     label, expected_predictions):
+
+    def add_predictions(batched_extract):
+      result = copy.copy(batched_extract)
+      result[constants.PREDICTIONS_KEY] = [
+          label + b':' + example
+          for example in batched_extract[constants.INPUT_KEY]
+      ]
+      return result
+
+    batched_extract = {
+        constants.ARROW_RECORD_BATCH_KEY:
+            pa.RecordBatch.from_arrays([pa.array(serialized_examples)],
+                                       ['example']),
+        constants.INPUT_KEY:
+            np.array(serialized_examples, dtype=object),
+    }
+
+    with beam.Pipeline() as pipeline:
+      result = (
+          pipeline
+          | 'Create' >> beam.Create([batched_extract])
+          | 'ComputeWithCache' >> prediction_cache.ComputeWithCache(
+              compute=beam.Map(add_predictions),
+              cache_dir=cache_dir,
+              extracts_keys=[constants.PREDICTIONS_KEY]))
+
+      def check_result(got):
+        try:
+          predictions = {}
+          for extracts in got:
+            self.assertCountEqual([
+                constants.ARROW_RECORD_BATCH_KEY, constants.INPUT_KEY,
+                constants.PREDICTIONS_KEY
+            ], extracts.keys())
+            examples = extracts[constants.ARROW_RECORD_BATCH_KEY].column(
+                0).to_pylist()
+            self.assertEqual(examples, list(extracts[constants.INPUT_KEY]))
+            predictions.update(
+                zip(examples, extracts[constants.PREDICTIONS_KEY]))
+          self.assertEqual(expected_predictions, predictions)
+        except AssertionError as err:
+          raise util.BeamAssertException(err)
+
+      util.assert_that(result, check_result)
+
+  def testComputeWithCache(self):
+    cache_dir = self.create_tempdir().full_path
+    self._assert_predictions_with_cache(cache_dir, [b'ex1', b'ex2', b'ex3'],
+                                        b'first', {
+                                            b'ex1': b'first:ex1',
+                                            b'ex2': b'first:ex2',
+                                            b'ex3': b'first:ex3'
+                                        })
+    # Only the rows without stored outputs are computed.
+    self._assert_predictions_with_cache(cache_dir, [b'ex2', b'ex4', b'ex3'],
+                                        b'second', {
+                                            b'ex2': b'first:ex2',
+                                            b'ex4': b'second:ex4',
+                                            b'ex3': b'first:ex3'
+                                        })
+    self._assert_predictions_with_cache(cache_dir, [b'ex1', b'ex4'], b'third',
+                                        {
+                                            b'ex1': b'first:ex1',
+                                            b'ex4': b'second:ex4'
+                                        })
+
+    # Outputs stored in different cache directories are not shared.
+    self._assert_predictions_with_cache(
+        os.path.join(cache_dir, 'other'), [b'ex1'], b'other',
+        {b'ex1': b'other:ex1'})
+
+
+  def testEncodeAndDecodeOutputs(self):
+    outputs = [{
+        constants.PREDICTIONS_KEY: {
+            'output1': np.array([0.5, 1.5], dtype=np.float32),
+            'output2': np.int64(1),
+            'output3': np.array([b'hello', b'multi byte'], dtype=object),
+        }
+    }, {
+        constants.PREDICTIONS_KEY: {
+            'output1': np.array([2.5, 3.5], dtype=np.float32),
+            'output2': np.int64(2),
+            'output3': np.array([b'', b'x'], dtype=object),
+        }
+    }]
+    record_batch = prediction_cache._encode_outputs([b'f1', b'f2'], outputs)
+    self.assertEqual(
+        pa.list_(pa.float32()),
+        record_batch.schema.field('["predictions", "output1"].values').type)
+    self.assertEqual(
+        pa.list_(pa.int64()),
+        record_batch.schema.field('["predictions", "output2"].values').type)
+    self.assertEqual(
+        pa.list_(pa.binary()),
+        record_batch.schema.field('["predictions", "output3"].values').type)
+
+    # Decoding a slice of the table only returns the rows of the slice.
+    table = pa.Table.from_batches([record_batch, record_batch]).slice(1, 2)
+    decoded = list(prediction_cache._decode_outputs(table))
+    self.assertEqual([b'f2', b'f1'], [f for f, _ in decoded])
+    for (_, got), expected in zip(decoded, [outputs[1], outputs[0]]):
+      got = got[constants.PREDICTIONS_KEY]
+      expected = expected[constants.PREDICTIONS_KEY]
+      self.assertCountEqual(expected.keys(), got.keys())
+      self.assertEqual(np.float32, got['output1'].dtype)
+      np.testing.assert_array_equal(expected['output1'], got['output1'])
+      self.assertIsInstance(got['output2'], np.int64)
+      self.assertEqual(expected['output2'], got['output2'])
+      self.assertEqual(list(expected['output3']), list(got['output3']))
+      # Decoded arrays can be modified in place.
+      got['output1'] += 1
+
+  def testEncodeOutputsWithDifferentStructures(self):
+    with self.assertRaises(ValueError):
+      prediction_cache._encode_outputs([b'f1', b'f2'], [{
+          constants.PREDICTIONS_KEY: {
+              'output1': 1.0
+          }
+      }, {
+          constants.PREDICTIONS_KEY: {
+              'output2': 1.0
+          }
+      }])
+
+  def testComputeWithCacheStoresTypedColumns(self):
+    cache_dir = self.create_tempdir().full_path
+    serialized_examples = [b'ex1', b'ex2']
+    batched_extract = {
+        constants.INPUT_KEY: np.array(serialized_examples, dtype=object),
+    }
+
+    def add_predictions(batched_extract):
+      result = copy.copy(batched_extract)
+      result[constants.PREDICTIONS_KEY] = [{
+          'output1': np.array([len(example), 1], dtype=np.float32)
+      } for example in batched_extract[constants.INPUT_KEY]]
+      return result
+
+    def fail(batched_extract):
+      raise AssertionError(
+          f'unexpected computation: {batched_extract[constants.INPUT_KEY]}')
+
+    for compute in (add_predictions, fail):
+      with beam.Pipeline() as pipeline:
+        result = (
+            pipeline
+            | 'Create' >> beam.Create([batched_extract])
+            | 'ComputeWithCache' >> prediction_cache.ComputeWithCache(
+                compute=beam.Map(compute),
+                cache_dir=cache_dir,
+                extracts_keys=[constants.PREDICTIONS_KEY]))
+
+        def check_result(got):
+          try:
+            self.assertLen(got, 1)
+            self.assertEqual(serialized_examples,
+                             list(got[0][constants.INPUT_KEY]))
+            for prediction in got[0][constants.PREDICTIONS_KEY]:
+              self.assertEqual(np.float32, prediction['output1'].dtype)
+              np.testing.assert_array_equal([3.0, 1.0],
+                                            prediction['output1'])
+          except AssertionError as err:
+            raise util.BeamAssertException(err)
+
+        util.assert_that(result, check_result)
+
+    [cache_file] = tf.io.gfile.glob(os.path.join(cache_dir, '*.parquet'))
+    table = pq.read_table(cache_file)
+    self.assertEqual(
+        pa.list_(pa.float32()),
+        table.schema.field('["predictions", "output1"].values').type)
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -18,7 +18,7 @@ import inspect
 import sys
 import traceback
 
-from typing import Any, List, Mapping, MutableMapping, Optional, Union
+from typing import Any, List, Mapping, MutableMapping, Optional, Sequence, Union
 
 import numpy as np
 import six
@@ -510,18 +510,7 @@ def merge_extracts(extracts: List[types.Extracts]) -> types.Extracts:
           [tf.expand_dims(to_tensorflow_tensor(t), 0) for t in target], 0)
       return to_tensor_value(t)
     else:
-      arr = np.array(target)
-      # Flatten values that were originally single item lists into a single list
-      # e.g. [[1], [2], [3]] -> [1, 2, 3]
-      if len(arr.shape) == 2 and arr.shape[1] == 1:
-        return arr.squeeze(axis=1)
-      # Special case for empty slice arrays since numpy treats empty tuples as
-      # arrays with dimension 0.
-      # e.g. [[()], [()], [()]] -> [(), (), ()]
-      elif len(arr.shape) == 3 and arr.shape[1] == 1 and arr.shape[2] == 0:
-        return arr.squeeze(axis=1)
-      else:
-        return arr
+      return _squeeze_merged_array(np.array(target))
 
   result = {}
   for x in extracts:
@@ -530,6 +519,68 @@ def merge_extracts(extracts: List[types.Extracts]) -> types.Extracts:
   return merge_lists(result)
 
 
+def _squeeze_merged_array(arr: np.ndarray) -> np.ndarray:
+  """Squeezes the per-example dimension of merged single item values."""
+  # Flatten values that were originally single item lists into a single list
+  # e.g. [[1], [2], [3]] -> [1, 2, 3]
+  if len(arr.shape) == 2 and arr.shape[1] == 1:
+    return arr.squeeze(axis=1)
+  # Special case for empty slice arrays since numpy treats empty tuples as
+  # arrays with dimension 0.
+  # e.g. [[()], [()], [()]] -> [(), (), ()]
+  elif len(arr.shape) == 3 and arr.shape[1] == 1 and arr.shape[2] == 0:
+    return arr.squeeze(axis=1)
+  else:
+    return arr
+
+
+def merge_batched_extract(batched_extract: types.Extracts) -> types.Extracts:
+  """Merges a batched extract into a single extract with multi-dimentional data.
+
+  The result has the same structure as calling merge_extracts on the per-example
+  extracts of the batch, but NumPy values are sliced or stacked directly
+  (keeping their dtypes) instead of being converted to lists and back. Values
+  that cannot be stacked (e.g. sparse values or values of different shapes) are
+  merged the same way as merge_extracts.
+
+  Args:
+    batched_extract: Batched extract (i.e. each key stores a list of values with
+      one entry per example).
+
+  Returns:
+    Merged extract.
+  """
+
+  def merge_values(values: Sequence[Any]) -> Any:
+    """Merges a list of per-example values."""
+    if values and all(isinstance(v, Mapping) for v in values):
+      keys = {}
+      for v in values:
+        keys.update(dict.fromkeys(v))
+      return {k: merge_values([v[k] for v in values if k in v]) for k in keys}
+    if (values and all(isinstance(v, np.ndarray) for v in values) and
+        all(v.shape == values[0].shape for v in values)):
+      return _squeeze_merged_array(np.stack(values))
+    return merge_extracts([{'value': v} for v in values])['value']
+
+  def merge_batched_value(value: Any) -> Any:
+    """Merges a batched value."""
+    if isinstance(value, Mapping):
+      return {k: merge_batched_value(v) for k, v in value.items()}
+    if isinstance(value, np.ndarray) and value.ndim:
+      return _squeeze_merged_array(value)
+    return merge_values(list(value))
+
+  result = {}
+  for key, value in batched_extract.items():
+    try:
+      result[key] = merge_batched_value(value)
+    except Exception as e:
+      raise RuntimeError(
+          'Failed to convert value for key "{}"'.format(key)) from e
+  return result
+
+
 def split_extracts(extracts: types.Extracts) -> List[types.Extracts]:
   """Splits extracts into a list of extracts along the batch dimension."""
   results = []
@@ -637,6 +637,59 @@ class UtilTest(tf.test.TestCase):
         RuntimeError, lambda exc: isinstance(exc.__cause__, RuntimeError)):
       util.merge_extracts(extracts)
 
+  def testMergeBatchedExtract(self):
+    batched_extract = {
+        'features': [{
+            'feature_1': np.array([1.0, 2.0]),
+            'feature_2': np.array([b'a'], dtype=object)
+        }, {
+            'feature_1': np.array([3.0, 4.0]),
+            'feature_2': np.array([b'b'], dtype=object)
+        }],
+        'labels': np.array([[1.0], [0.0]], dtype=np.float32),
+        'example_weights': [np.array(0.0), np.array(0.5)],
+        'predictions': {
+            'model1': np.array([[0.1, 0.2], [0.3, 0.4]]),
+            'model2': [np.array([0.1]), np.array([0.3])]
+        },
+        '_slice_key_types': [[()], [()]]
+    }
+
+    expected = util.merge_extracts([{
+        'features': {
+            'feature_1': np.array([1.0, 2.0]),
+            'feature_2': np.array([b'a'], dtype=object)
+        },
+        'labels': np.array([1.0], dtype=np.float32),
+        'example_weights': np.array(0.0),
+        'predictions': {
+            'model1': np.array([0.1, 0.2]),
+            'model2': np.array([0.1])
+        },
+        '_slice_key_types': [()]
+    }, {
+        'features': {
+            'feature_1': np.array([3.0, 4.0]),
+            'feature_2': np.array([b'b'], dtype=object)
+        },
+        'labels': np.array([0.0], dtype=np.float32),
+        'example_weights': np.array(0.5),
+        'predictions': {
+            'model1': np.array([0.3, 0.4]),
+            'model2': np.array([0.3])
+        },
+        '_slice_key_types': [()]
+    }])
+    got = util.merge_batched_extract(batched_extract)
+    self.assertAllClose(
+        {k: v for k, v in got.items() if k != 'features'},
+        {k: v for k, v in expected.items() if k != 'features'})
+    self.assertAllClose(got['features']['feature_1'],
+                        expected['features']['feature_1'])
+    self.assertEqual([b'a', b'b'], got['features']['feature_2'].tolist())
+    # Dtypes of batched values are kept.
+    self.assertEqual(np.float32, got['labels'].dtype)
+
   def testSplitExtracts(self):
     extracts = {
         'features': {
@@ -27,7 +27,6 @@ from tensorflow_model_analysis import constants
 from tensorflow_model_analysis import types
 from tensorflow_model_analysis.evaluators import evaluator
 from tensorflow_model_analysis.evaluators import metrics_validator
-from tensorflow_model_analysis.metrics import metric_specs
 from tensorflow_model_analysis.metrics import metric_types
 from tensorflow_model_analysis.post_export_metrics import metric_keys
 from tensorflow_model_analysis.proto import config_pb2
@@ -134,10 +133,12 @@ def load_and_deserialize_metrics(
   if output_file_format:
     pattern = f'{pattern}.{output_file_format}'
   paths = tf.io.gfile.glob(pattern)
+  slice_spec_matcher = (
+      slicer.SliceSpecMatcher(slice_specs) if slice_specs else None)
   for value in _raw_value_iterator(paths, output_file_format):
     metrics = metrics_for_slice_pb2.MetricsForSlice.FromString(value)
-    if slice_specs and not slicer.slice_key_matches_slice_specs(
-        slicer.deserialize_slice_key(metrics.slice_key), slice_specs):
+    if slice_spec_matcher and not slice_spec_matcher.matches(
+        slicer.deserialize_slice_key(metrics.slice_key)):
       continue
     yield metrics
 
@@ -166,10 +167,12 @@ def load_and_deserialize_plots(
   if output_file_format:
     pattern = f'{pattern}.{output_file_format}'
   paths = tf.io.gfile.glob(pattern)
+  slice_spec_matcher = (
+      slicer.SliceSpecMatcher(slice_specs) if slice_specs else None)
   for value in _raw_value_iterator(paths, output_file_format):
     plots = metrics_for_slice_pb2.PlotsForSlice.FromString(value)
-    if slice_specs and not slicer.slice_key_matches_slice_specs(
-        slicer.deserialize_slice_key(plots.slice_key), slice_specs):
+    if slice_spec_matcher and not slice_spec_matcher.matches(
+        slicer.deserialize_slice_key(plots.slice_key)):
       continue
     yield plots
 
@@ -198,10 +201,12 @@ def load_and_deserialize_attributions(
   if output_file_format:
     pattern = f'{pattern}.{output_file_format}'
   paths = tf.io.gfile.glob(pattern)
+  slice_spec_matcher = (
+      slicer.SliceSpecMatcher(slice_specs) if slice_specs else None)
   for value in _raw_value_iterator(paths, output_file_format):
     attributions = metrics_for_slice_pb2.AttributionsForSlice.FromString(value)
-    if slice_specs and not slicer.slice_key_matches_slice_specs(
-        slicer.deserialize_slice_key(attributions.slice_key), slice_specs):
+    if slice_spec_matcher and not slice_spec_matcher.matches(
+        slicer.deserialize_slice_key(attributions.slice_key)):
       continue
     yield attributions
 
@@ -583,6 +588,10 @@ class CombineValidations(beam.CombineFn):
                rubber_stamp: bool = False):
     self._eval_config = eval_config
     self._rubber_stamp = rubber_stamp
+    self._threshold_index = None
+
+  def setup(self):
+    self._threshold_index = metrics_validator.ThresholdIndex(self._eval_config)
 
   def create_accumulator(self) -> None:
     return
@@ -622,15 +631,17 @@ class CombineValidations(beam.CombineFn):
     # Verification fails if there is empty input.
     if not accumulator:
       accumulator = validation_result_pb2.ValidationResult(validation_ok=False)
-    thresholds = metric_specs.metric_thresholds_from_metrics_specs(
-        self._eval_config.metrics_specs, eval_config=self._eval_config)
-    if not thresholds:
+    if self._threshold_index is None:
+      self._threshold_index = metrics_validator.ThresholdIndex(
+          self._eval_config)
+    if not self._threshold_index.thresholds:
       # Default is to validation NOT ok when not rubber stamping.
       accumulator.validation_ok = self._rubber_stamp
       # Default is to missing thresholds when not rubber stamping.
       accumulator.missing_thresholds = not self._rubber_stamp
     if missing := metrics_validator.get_missing_slices(
-        accumulator.validation_details.slicing_details, self._eval_config):
+        accumulator.validation_details.slicing_details, self._eval_config,
+        self._threshold_index):
       missing_slices = []
       missing_cross_slices = []
       for m in missing: